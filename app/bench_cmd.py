@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+#
+# 压测命令：fas bench
+# 1. 启动方式：进程内（通过ASGI直接调用应用）、子进程（uvicorn启动应用）或者指定已经启动的服务地址
+# 2. 按指定的并发数请求指定的路由，统计吞吐量及耗时分位数（p50/p95/p99/p999）
+# 3. 异常响应按响应中的code统计，并通过接口/status/code（即get_status()）映射为异常信息
+# 4. 结果可以保存为JSON文件，并与之前的结果（如上一个提交）对比，用于发现性能退化
+# Author: caiyingyao
+# Email: cyy0523xc@gmail.com
+# Created Time: 2026-10-18
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import platform
+import importlib
+import subprocess
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import parse_qsl
+
+from .utils import shell
+
+# 等待应用启动及预热完成的最长时间（秒）
+READY_TIMEOUT = 30
+
+
+def bench(routes: Union[str, List[str], Tuple[str, ...]] = '/version', concurrency: int = 10,
+          requests: int = 1000, duration: float = 0, warmup: int = 100, mode: str = 'inprocess',
+          url: str = '', app: str = 'main:app', app_dir: str = '.', timeout: float = 10,
+          output: str = '', baseline: str = '', upstream: str = ''):
+    """对项目的接口进行压测（需要在项目的app目录下执行）
+
+    Examples:
+        fas bench --routes=/version,/test/{i} --concurrency=50 --requests=10000
+        # 使用uvicorn子进程启动应用，压测30秒，并保存结果
+        fas bench --routes=/captcha/image/{i} --mode=subprocess --duration=30 --output=bench.json
+        # 与之前的结果对比
+        fas bench --routes=/version --baseline=bench.json
+        # 压测已经启动的服务
+        fas bench --routes=/version --url=http://127.0.0.1:8000
+        # 同时在9000端口启动模拟上游服务（common/mock_upstream.py），应用配置中的上游地址指向该端口
+        fas bench --routes=/predict --upstream="port=9000&latency=exp:0.05&error_rate=0.01"
+    Args:
+        routes str: 压测的路由，多个路由用英文逗号分隔，请求时轮流使用，路由前可以加上请求方法（如"POST /test"，默认为GET）
+            路由中的{i}会替换为请求的序号
+        concurrency int: 并发数
+        requests int: 总请求数（不包括预热的请求）
+        duration float: 压测时长（秒），大于0时忽略requests参数
+        warmup int: 预热的请求数，不计入统计
+        mode str: 应用的启动方式：inprocess（进程内）或者subprocess（uvicorn子进程），指定了url时忽略
+            进程内方式没有网络开销，但是压测客户端与应用共享事件循环，适合对比不同提交之间的差异
+        url str: 已经启动的服务地址
+        app str: 应用的路径，格式为module:attr
+        app_dir str: 应用所在的目录
+        timeout float: 单个请求的超时时间（秒）
+        output str: 结果保存的JSON文件
+        baseline str: 用于对比的结果文件（之前保存的output）
+        upstream str: 模拟上游服务的参数（查询字符串格式，包括port及common/mock_upstream.py中的参数），为空时不启动
+    """
+    if isinstance(routes, str):
+        routes = routes.split(',')
+    targets = [_parse_route(route) for route in routes if route.strip()]
+    if mode not in ('inprocess', 'subprocess'):
+        raise Exception(f'不支持的启动方式: {mode}')
+    mock = _start_upstream(upstream, os.path.abspath(app_dir)) if upstream else None
+    try:
+        result = asyncio.run(_bench(targets, concurrency, requests, duration, warmup,
+                                    'url' if url else mode, url, app, os.path.abspath(app_dir), timeout))
+    finally:
+        if mock is not None:
+            mock.stop_thread()
+    result['meta'] = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'commit': shell('git rev-parse --short HEAD 2>/dev/null'),
+        'python': platform.python_version(),
+        'mode': 'url' if url else mode,
+        'concurrency': concurrency,
+        'routes': [f'{method} {path}' for method, path in targets],
+    }
+    if mock is not None:
+        result['upstream'] = mock.stats
+    print_result(result)
+    if baseline:
+        with open(baseline, encoding='utf8') as f:
+            print_compare(json.load(f), result)
+    if output:
+        with open(output, 'w', encoding='utf8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f'\n结果已保存: {output}')
+
+
+def _start_upstream(options: str, app_dir: str):
+    """在独立线程中启动项目中的模拟上游服务"""
+    sys.path.insert(0, app_dir)
+    from common.mock_upstream import MockUpstream
+    params = dict(parse_qsl(options))
+    mock = MockUpstream(port=int(params.pop('port', 9000)), **params).start_in_thread()
+    print(f'模拟上游服务: {mock.url}')
+    return mock
+
+
+def _parse_route(route: str) -> Tuple[str, str]:
+    parts = route.strip().split(maxsplit=1)
+    if len(parts) == 2:
+        return parts[0].upper(), parts[1]
+    return 'GET', parts[0]
+
+
+async def _bench(targets: List[Tuple[str, str]], concurrency: int, requests: int, duration: float,
+                 warmup: int, mode: str, url: str, app: str, app_dir: str, timeout: float) -> Dict:
+    import httpx
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    if mode == 'inprocess':
+        os.chdir(app_dir)     # 应用中的相对路径（如静态文件目录）相对于app目录
+        sys.path.insert(0, app_dir)
+        module_name, attr = app.split(':')
+        asgi_app = getattr(importlib.import_module(module_name), attr)
+        async with asgi_app.router.lifespan_context(asgi_app):
+            # 与真实服务一致，接口异常时返回500而不是抛出异常
+            transport = httpx.ASGITransport(app=asgi_app, raise_app_exceptions=False)
+            async with httpx.AsyncClient(transport=transport, base_url='http://bench',
+                                         timeout=timeout) as client:
+                return await _run(client, targets, concurrency, requests, duration, warmup)
+
+    process = None
+    if mode == 'subprocess':
+        port = _free_port()
+        url = f'http://127.0.0.1:{port}'
+        process = subprocess.Popen([sys.executable, '-m', 'uvicorn', app, '--port', str(port),
+                                    '--log-level', 'warning'], cwd=app_dir)
+    try:
+        async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=limits) as client:
+            return await _run(client, targets, concurrency, requests, duration, warmup)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+async def _run(client, targets: List[Tuple[str, str]], concurrency: int, requests: int,
+               duration: float, warmup: int) -> Dict:
+    await _wait_ready(client)
+    codes = await _status_codes(client)
+    if warmup > 0:
+        await _drive(client, targets, concurrency, warmup, 0, {})
+    stats: Dict[str, Dict] = {f'{method} {path}': _new_stats() for method, path in targets}
+    start = time.perf_counter()
+    await _drive(client, targets, concurrency, requests, duration, stats)
+    seconds = time.perf_counter() - start
+    total = _new_stats()
+    for item in stats.values():
+        total['latencies'] += item['latencies']
+        total['errors'] += item['errors']
+        for key in ('status', 'codes'):
+            for code, cnt in item[key].items():
+                total[key][code] = total[key].get(code, 0) + cnt
+    return {
+        'seconds': round(seconds, 3),
+        'total': _summary(total, seconds, codes),
+        'routes': {name: _summary(item, seconds, codes) for name, item in stats.items()},
+    }
+
+
+async def _drive(client, targets: List[Tuple[str, str]], concurrency: int, requests: int,
+                 duration: float, stats: Dict[str, Dict]):
+    """按并发数发送请求，duration大于0时按时长，否则按请求数"""
+    counter = iter(range(sys.maxsize))
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        for i in counter:
+            if (duration > 0 and time.perf_counter() >= deadline) or (duration <= 0 and i >= requests):
+                return
+            method, path = targets[i % len(targets)]
+            name = f'{method} {path}'
+            start = time.perf_counter()
+            try:
+                resp = await client.request(method, path.replace('{i}', str(i)))
+                status, code = resp.status_code, _error_code(resp)
+            except Exception as e:
+                status, code = type(e).__name__, None
+            if name not in stats:     # 预热
+                continue
+            item = stats[name]
+            item['latencies'].append(time.perf_counter() - start)
+            item['status'][str(status)] = item['status'].get(str(status), 0) + 1
+            if not (isinstance(status, int) and status < 400):
+                item['errors'] += 1
+            if code is not None:
+                item['codes'][code] = item['codes'].get(code, 0) + 1
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+
+
+def _error_code(resp) -> Optional[str]:
+    """异常响应中的code（见ErrorResponse）"""
+    if resp.status_code < 400 or 'json' not in resp.headers.get('content-type', ''):
+        return None
+    try:
+        code = resp.json().get('code')
+    except (ValueError, AttributeError):
+        return None
+    return None if code is None else str(code)
+
+
+async def _wait_ready(client):
+    """等待应用启动及预热完成：/health/ready返回200；没有该接口的旧项目只需要能响应请求"""
+    deadline = time.perf_counter() + READY_TIMEOUT
+    while True:
+        try:
+            resp = await client.get('/health/ready')
+            if resp.status_code in (200, 404):
+                return
+        except Exception:
+            resp = None
+        if time.perf_counter() > deadline:
+            if resp is None:
+                raise Exception(f'应用在{READY_TIMEOUT}秒内没有启动')
+            print(f'警告：应用在{READY_TIMEOUT}秒内没有就绪：{resp.text}')
+            return
+        await asyncio.sleep(0.2)
+
+
+async def _status_codes(client) -> Dict[str, str]:
+    """应用的异常状态码及说明（get_status()）"""
+    try:
+        resp = await client.get('/status/code')
+        return {str(item['code']): item['message'] for item in resp.json()}
+    except Exception:
+        return {}
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _new_stats() -> Dict:
+    return {'latencies': [], 'errors': 0, 'status': {}, 'codes': {}}
+
+
+def percentile(values: List[float], p: float) -> float:
+    """分位数（最近秩法），values需要已经排序"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(len(values) * p / 100 + 0.5) - 1))
+    return values[index]
+
+
+def _summary(item: Dict, seconds: float, codes: Dict[str, str]) -> Dict:
+    latencies = sorted(item['latencies'])
+    count = len(latencies)
+    ms = {f'p{name}': round(percentile(latencies, p) * 1000, 3)
+          for name, p in (('50', 50), ('95', 95), ('99', 99), ('999', 99.9))}
+    return {
+        'requests': count,
+        'errors': item['errors'],
+        'rps': round(count / seconds, 1) if seconds > 0 else 0,
+        'latency_ms': dict(ms, mean=round(sum(latencies) / count * 1000, 3) if count else 0,
+                           max=round(latencies[-1] * 1000, 3) if count else 0),
+        'status': item['status'],
+        'error_codes': {code: {'count': cnt, 'message': codes.get(code, '')}
+                        for code, cnt in sorted(item['codes'].items())},
+    }
+
+
+def print_result(result: Dict):
+    print(f"\n耗时: {result['seconds']}s, 并发数: {result['meta']['concurrency']}, "
+          f"提交: {result['meta']['commit'] or '-'}")
+    print(f"{'route':<40} {'requests':>9} {'errors':>7} {'rps':>9} "
+          f"{'p50':>8} {'p95':>8} {'p99':>8} {'p999':>8} (ms)")
+    rows = list(result['routes'].items())
+    if len(rows) > 1:
+        rows.append(('total', result['total']))
+    for name, item in rows:
+        ms = item['latency_ms']
+        print(f"{name:<40} {item['requests']:>9} {item['errors']:>7} {item['rps']:>9} "
+              f"{ms['p50']:>8} {ms['p95']:>8} {ms['p99']:>8} {ms['p999']:>8}")
+    for code, info in result['total']['error_codes'].items():
+        print(f"  异常状态码 {code}: {info['count']}次 {info['message']}")
+    if 'upstream' in result:
+        print(f"  模拟上游服务: {result['upstream']}")
+
+
+def print_compare(base: Dict, result: Dict):
+    """与之前的结果对比吞吐量及耗时的变化"""
+    print(f"\n对比 {base['meta'].get('commit') or '-'} -> {result['meta']['commit'] or '-'}:")
+    for name, item in list(result['routes'].items()) + [('total', result['total'])]:
+        old = base['total'] if name == 'total' else base['routes'].get(name)
+        if old is None:
+            continue
+        changes = [f"rps {_change(old['rps'], item['rps'])}"]
+        for key in ('p50', 'p99'):
+            changes.append(f"{key} {_change(old['latency_ms'][key], item['latency_ms'][key])}")
+        print(f"{name:<40} " + ', '.join(changes))
+
+
+def _change(old: float, new: float) -> str:
+    if not old:
+        return f'{old} -> {new}'
+    return f'{old} -> {new} ({(new - old) / old * 100:+.1f}%)'
@@ -8,7 +8,7 @@ import os
 from os.path import join
 import shutil
 from .settings import package_path
-from .utils import init_file, parse_git_uri, shell
+from .utils import init_file, parse_git_uri, shell, compress_file
 from .config_cmd import get_config
 
 # 项目名字规范
@@ -41,7 +41,8 @@ class Project:
         elif re.match(name_pattern, name):
             print("project name check ok")
         else:
-            raise Exception(f'project name check error: "{name_pattern}"，支持小写字母、数字、连接符-等，必须以字母开头，长度限制3-100个字符')
+            raise Exception(f'project name check error: "{name_pattern}"，'
+                            '支持小写字母、数字、连接符-等，必须以字母开头，长度限制3-100个字符')
         project_init(name, title=title, desc=desc)
 
     def create(self, name: str, title: str = '', desc: str = ''):
@@ -130,8 +131,10 @@ def project_init(project_name: str, title: str = '', desc: str = ''):
     src_path = join(package_path, 'project', 'static')
     dst_path = join('app', 'static')
     os.mkdir(dst_path)
-    shutil.copy(join(src_path, 'swagger-ui.css'), dst_path)
-    shutil.copy(join(src_path, 'swagger-ui-bundle.js'), dst_path)
+    for filename in ['swagger-ui.css', 'swagger-ui-bundle.js']:
+        shutil.copy(join(src_path, filename), dst_path)
+        # 生成预先压缩的文件（.gz，安装了brotli时还会生成.br），请求时直接输出压缩后的文件
+        compress_file(join(dst_path, filename))
     print('--> ok.')
     print(f'init project: {project_name} ok.')
 
@@ -139,7 +142,8 @@ def project_init(project_name: str, title: str = '', desc: str = ''):
     print('\nUsage:')
     print('  cd app')
     print('  cp settings-example.py settings.py')
-    print('  uvicorn main:app')
+    print('  uvicorn main:app --reload    # 开发环境')
+    print('  fas serve                     # 生产环境')
 
 
 def clone(uri):
@@ -12,6 +12,8 @@ from .file_cmd import File
 from .module_cmd import Module
 from .check_cmd import CodeCheck
 from .database_cmd import Database
+from .serve_cmd import serve
+from .bench_cmd import bench
 
 
 def version() -> str:
@@ -30,6 +32,8 @@ def main():
         'database': Database(),
         'file': File(),
         'check': CodeCheck(),
+        'serve': serve,            # 生产环境启动http服务
+        'bench': bench,            # 接口压测
     })
 
 
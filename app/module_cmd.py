@@ -113,7 +113,7 @@ def module_new(module_name: str, title: str = '', desc: str = '', src_module: st
     cfg = get_config()
     replaces = {'title': title if title else module_name,
                 'module_name': module_name,
-                'desc': desc,}
+                'desc': desc}
     project_path = os.path.dirname(os.path.realpath(__file__))
 
     print('copy and parse app files...')
@@ -132,3 +132,5 @@ def module_new(module_name: str, title: str = '', desc: str = '', src_module: st
     print('\n在入口文件(main.py)中加入引用代码：')
     print(f'from {module_name}_module.router import router as {module_name}_router')
     print(f'app.include_router({module_name}_router, prefix="/{module_name}", tags=["{title}"])')
+    print('\n或者在配置文件(settings.py)的ROUTER_MODULES中加入模块名，由init_app自动加载：')
+    print(f'ROUTER_MODULES = ["{module_name}_module"]')
@@ -4,62 +4,144 @@
 # Author: caiyingyao
 # Email: cyy0523xc@gmail.com
 # Created Time: 2021-06-16
+from typing import AsyncIterator, Dict, Optional
+
 # redis连接在公共模块里
-from redis import Redis
+from common.connections import get_async_redis
+from .store import BaseStore, RedisStore, MemoryStore
 
 # 验证码配置
 cfg = {
+    'backend': 'redis',  # 验证码存储：redis或者memory（进程内存储，只适合单节点部署）
+    'memory_max_size': 100000,   # 进程内存储的最大验证码数量
     'prefix': 'ctc',   # redis key前缀
     'expire': 5 * 60,    # 过期时间
+    'render_workers': 2,    # 生成验证码图像的线程数
+    'pool_size': 0,         # 预生成验证码池的容量，0表示不启用
+    'pool_concurrency': 2,  # 验证码池补充时同时生成的数量
+    'pool_low_water': None,  # 验证码池的低水位，默认为容量的一半
 }
 
+# 进程内存储，backend为memory时使用
+_memory_store: Optional[MemoryStore] = None
+
 
-def config(expire=5 * 60, prefix='ctc'):
+def config(expire=5 * 60, prefix='ctc', render_workers=2,
+           pool_size=0, pool_concurrency=2, pool_low_water=None,
+           backend='redis', memory_max_size=100000):
     """配置redis
     Args:
         expire int: 过期秒数
         prefix str: 验证码key前缀
+        render_workers int: 生成验证码图像的线程数，需要在第一次生成图像之前配置
+        pool_size int: 预生成验证码池的容量，大于0时启用，应用启动时开始生成
+        pool_concurrency int: 验证码池补充时同时生成的数量
+        pool_low_water int: 池中数量低于该值时开始补充，默认为容量的一半
+        backend str: 验证码存储，redis或者memory。memory为进程内存储，不需要redis，只适合单节点（单进程）部署及测试
+        memory_max_size int: 进程内存储的最大验证码数量，超过时优先淘汰最早过期的验证码
     """
-    global cfg
+    global cfg, _memory_store
+    if backend not in ('redis', 'memory'):
+        raise Exception(f'不支持的验证码存储: {backend}')
     cfg['expire'] = expire
     cfg['prefix'] = prefix
+    cfg['render_workers'] = render_workers
+    cfg['pool_size'] = pool_size
+    cfg['pool_concurrency'] = pool_concurrency
+    cfg['pool_low_water'] = pool_low_water
+    cfg['backend'] = backend
+    cfg['memory_max_size'] = memory_max_size
+    _memory_store = None
 
 
-def check_code(redis: Redis, token: str, code: str) -> bool:
-    """校验验证码"""
-    token = f"{cfg['prefix']}_{token}"
-    code = code.lower().strip()
-    saved_code = redis.get(token)
-    if saved_code is None:
-        return False
-    redis.delete(token)   # 验证码只能用一次
-    saved_code = str(saved_code, encoding='utf8')
-    # print(f'{saved_code} == {code}')
-    return saved_code == code
+async def get_store() -> AsyncIterator[BaseStore]:
+    """获取验证码存储（依赖项），由config中的backend决定"""
+    global _memory_store
+    if cfg['backend'] == 'memory':
+        if _memory_store is None:
+            _memory_store = MemoryStore(max_size=cfg['memory_max_size'])
+        yield _memory_store
+        return
+    async for redis in get_async_redis():
+        yield RedisStore(redis)
+
 
+async def check_code(store: BaseStore, token: str, code: str) -> bool:
+    """校验验证码
+    验证码只能用一次：读取和删除是原子执行的，并发校验同一个token时只有一个能成功
+    """
+    saved_code = await store.pop(_key(token))
+    return _match(saved_code, code)
 
-def set_captcha(redis: Redis, token: str, code: str):
+
+async def check_code_batch(store: BaseStore, codes: Dict[str, str]) -> Dict[str, bool]:
+    """批量校验验证码（redis使用pipeline，一次往返）
+    Args:
+        codes Dict[str, str]: {token: code}
+    Returns:
+        Dict[str, bool]: {token: 是否校验通过}
+    """
+    saved_codes = await store.pop_many([_key(token) for token in codes])
+    return {token: _match(saved_code, code)
+            for (token, code), saved_code in zip(codes.items(), saved_codes)}
+
+
+async def set_captcha(store: BaseStore, token: str, code: str):
     """设置验证码"""
-    token = f"{cfg['prefix']}_{token}"
-    code = code.lower()
-    return redis.set(token, code, ex=cfg['expire'])
+    return await store.set(_key(token), code.lower(), cfg['expire'])
+
+
+async def set_captcha_batch(store: BaseStore, codes: Dict[str, str]) -> bool:
+    """批量设置验证码（redis使用pipeline，一次往返）
+    Args:
+        codes Dict[str, str]: {token: code}
+    """
+    items = {_key(token): code.lower() for token, code in codes.items()}
+    return await store.set_many(items, cfg['expire'])
+
+
+def _key(token: str) -> str:
+    return f"{cfg['prefix']}_{token}"
+
+
+def _match(saved_code: Optional[str], code: str) -> bool:
+    if saved_code is None:
+        return False
+    # print(f'{saved_code} == {code}')
+    return saved_code == code.lower().strip()
 
 
 if __name__ == '__main__':
-    # python api.py 192.168.1.242
+    # 在项目目录下执行
+    # 使用进程内存储：python -m captcha_module.api
+    # 使用redis存储：python -m captcha_module.api 192.168.1.242
     import sys
-    import os
-    sys.path.insert(0, os.path.split(sys.path[0])[0])
+    import asyncio
+    from common.connections import init_redis
+    if len(sys.argv) > 1:
+        init_redis(host=sys.argv[1])
+    else:
+        config(backend='memory')
+
+    async def main():
+        async for store in get_store():
+            code = '23kf'
+            await set_captcha(store, 'test', code)
+            assert await check_code(store, 'test', 'test') is False
+            assert await check_code(store, 'test', code) is False
+
+            await set_captcha(store, 'test', code)
+            assert await check_code(store, 'test', code) is True
+            assert await check_code(store, 'test', code) is False
 
-    from common.connections import init_redis, get_redis
-    init_redis(host=sys.argv[1])
-    redis = next(get_redis())
+            # 并发校验同一个验证码，只有一个能成功
+            await set_captcha(store, 'test', code)
+            res = await asyncio.gather(*[check_code(store, 'test', code) for _ in range(5)])
+            assert res.count(True) == 1
 
-    code = '23kf'
-    set_captcha(redis, 'test', code)
-    assert check_code(redis, 'test', 'test') is False
-    assert check_code(redis, 'test', code) is False
+            # 批量操作
+            assert await set_captcha_batch(store, {'t1': 'ab12', 't2': 'cd34'})
+            res = await check_code_batch(store, {'t1': 'AB12', 't2': 'xxxx', 't3': 'ef56'})
+            assert res == {'t1': True, 't2': False, 't3': False}
 
-    set_captcha(redis, 'test', code)
-    assert check_code(redis, 'test', code) is True
-    assert check_code(redis, 'test', code) is False
+    asyncio.run(main())
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+#
+# 预生成的验证码池
+# 后台任务维持一个有上限的(验证码, 图像)池，请求时直接从池中取出，
+# 池中数量低于低水位时唤醒后台任务进行补充，池为空时退化为实时生成
+# Author: caiyingyao
+# Email: cyy0523xc@gmail.com
+# Created Time: 2021-06-16
+import asyncio
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+from common.logger import logger
+from .render import random_code, render_async
+
+
+class CaptchaPool:
+    """验证码池"""
+    def __init__(self, size: int, concurrency: int = 2, low_water: Optional[int] = None) -> None:
+        """
+        :param size 池的最大容量
+        :param concurrency 补充时同时生成的图像数量
+        :param low_water 低水位，池中数量低于该值时开始补充，默认为容量的一半
+        """
+        self.size = size
+        self.concurrency = concurrency
+        self.low_water = size // 2 if low_water is None else low_water
+        self._items: Deque[Tuple[str, bytes]] = deque()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # 统计
+        self.hits = 0                # 从池中取到验证码
+        self.misses = 0              # 池为空，调用方需要实时生成
+        self.low_water_events = 0    # 取出之后低于低水位的次数
+        self.rendered = 0            # 后台生成的验证码数量
+
+    def start(self):
+        """启动后台补充任务（需要在事件循环中调用）"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._refill())
+
+    async def stop(self):
+        """停止后台补充任务"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def pop(self) -> Optional[Tuple[str, bytes]]:
+        """取出一个(验证码, PNG图像)，池为空时返回None"""
+        if not self._items:
+            self.misses += 1
+            self._wakeup.set()
+            return None
+        item = self._items.popleft()
+        self.hits += 1
+        if len(self._items) < self.low_water:
+            self.low_water_events += 1
+            self._wakeup.set()
+        return item
+
+    def stats(self) -> dict:
+        """验证码池的统计信息"""
+        return {
+            'available': len(self._items),
+            'size': self.size,
+            'low_water': self.low_water,
+            'hits': self.hits,
+            'misses': self.misses,
+            'low_water_events': self.low_water_events,
+            'rendered': self.rendered,
+        }
+
+    async def _refill(self):
+        while True:
+            while len(self._items) < self.size:
+                num = min(self.concurrency, self.size - len(self._items))
+                try:
+                    items = await asyncio.gather(*[self._render() for _ in range(num)])
+                except Exception as e:
+                    logger.error(f"验证码池补充异常 : {e}")
+                    await asyncio.sleep(1)
+                    continue
+                self._items.extend(items)
+                self.rendered += num
+            self._wakeup.clear()
+            if len(self._items) >= self.low_water:
+                await self._wakeup.wait()
+
+    @staticmethod
+    async def _render() -> Tuple[str, bytes]:
+        code = random_code()
+        return code, await render_async(code)
+
+
+# 验证码池，在config中配置了pool_size之后，应用启动时创建
+captcha_pool: Optional[CaptchaPool] = None
+
+
+def get_pool_stats() -> Optional[dict]:
+    """获取验证码池的统计信息，没有启用验证码池时返回None"""
+    return captcha_pool.stats() if captcha_pool is not None else None
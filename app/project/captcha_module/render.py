@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+# 验证码图像生成
+# 图像生成是CPU密集型操作，放到独立的线程池中执行，避免阻塞事件循环；
+# 每个工作线程复用一个ImageCaptcha对象，字体只在线程第一次生成图像时加载一次
+# captcha.image（依赖PIL）延迟到第一次生成图像时才导入，减少应用的启动时间
+# Author: caiyingyao
+# Email: cyy0523xc@gmail.com
+# Created Time: 2021-06-16
+import random
+import string
+import asyncio
+import threading
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from common.lazy import lazy_import
+from .api import cfg
+
+captcha_image = lazy_import('captcha.image')
+
+# 验证码所有字符
+char_all = string.ascii_letters + string.digits
+
+# 每个工作线程的ImageCaptcha对象（PIL的字体对象不保证线程安全，所以不在线程间共享）
+_local = threading.local()
+_import_lock = threading.Lock()    # 延迟导入不保证线程安全，多个线程第一次使用时需要加锁
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_captcha():
+    captcha = getattr(_local, 'captcha', None)
+    if captcha is None:
+        with _import_lock:
+            image_captcha = captcha_image.ImageCaptcha
+        captcha = _local.captcha = image_captcha()
+    return captcha
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=cfg['render_workers'],
+                                               thread_name_prefix='captcha')
+    return _executor
+
+
+def shutdown_executor():
+    """关闭生成验证码的线程池（应用关闭时调用），未开始执行的任务会被取消，再次使用时重新创建"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+
+def random_code(length: int = 4) -> str:
+    """生成随机的验证码字符串"""
+    return ''.join(random.sample(char_all, length))
+
+
+def render(code: str) -> bytes:
+    """生成验证码的PNG图像（同步执行）"""
+    return _get_captcha().generate(code, format='png').getvalue()
+
+
+async def render_async(code: str) -> bytes:
+    """在线程池中生成验证码的PNG图像"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), render, code)
@@ -4,18 +4,16 @@
 # Author: caiyingyao
 # Email: cyy0523xc@gmail.com
 # Created Time: 2021-06-16
-import random
-import string
-import tempfile
-from redis import Redis
 from fastapi import APIRouter, Path, Depends
 from fastapi import status, HTTPException
-from starlette.responses import FileResponse
-from captcha.image import ImageCaptcha
+from fastapi.responses import Response
 
-from common.connections import get_redis
 from schema import MessageResp     # 通用schema
-from .api import set_captcha
+from . import pool
+from .api import cfg, set_captcha, get_store
+from .pool import CaptchaPool
+from .render import random_code, render_async, shutdown_executor
+from .store import BaseStore
 
 """
 在系统入口main.py文件中加入:
@@ -24,8 +22,23 @@ app.include_router(captcha_router, prefix="/captcha", tags=["验证码"])
 """
 router = APIRouter()
 
-# 验证码所有字符
-char_all = string.ascii_letters + string.digits
+
+@router.on_event("startup")
+async def startup_captcha_pool():
+    """配置了验证码池时，启动后台生成任务"""
+    if cfg['pool_size'] > 0 and pool.captcha_pool is None:
+        pool.captcha_pool = CaptchaPool(cfg['pool_size'], concurrency=cfg['pool_concurrency'],
+                                        low_water=cfg['pool_low_water'])
+        pool.captcha_pool.start()
+
+
+@router.on_event("shutdown")
+async def shutdown_captcha_pool():
+    """停止验证码池，并关闭生成验证码的线程池"""
+    if pool.captcha_pool is not None:
+        await pool.captcha_pool.stop()
+        pool.captcha_pool = None
+    shutdown_executor()
 
 
 @router.get("/", summary='模块测试API',
@@ -35,8 +48,14 @@ async def test_api():
     return {'message': 'ok'}
 
 
+@router.get("/status/pool", include_in_schema=False)
+async def pool_stats_api():
+    """验证码池的统计信息（当前进程），没有启用验证码池时返回null"""
+    return pool.get_pool_stats()
+
+
 @router.get("/image/{token}", summary='生成验证码图像',
-            response_class=FileResponse,
+            response_class=Response,
             responses={
                 200: {"content": {"image/png": {}}},
                 500: {"description": "生成验证码异常"},
@@ -44,19 +63,19 @@ async def test_api():
 async def captcha_image_api(
     token: str = Path(..., regex='^[0-9a-z]+$', title='表单唯一值，用于标识表单',
                       description='表单唯一值，用于标识表单'),
-    redis: Redis = Depends(get_redis)
+    store: BaseStore = Depends(get_store)
 ):
     """生成验证码图像\n
     表单在生成之前通常会生成一个唯一字符串token，该token值可以用于避免重复提交，也用于请求验证码。\n
     验证码不区分大小写。\n
     该接口返回一个图像文件。
     """
-    code = ''.join(random.sample(char_all, 4))
+    item = pool.captcha_pool.pop() if pool.captcha_pool is not None else None
+    code, image = item if item is not None else (random_code(), None)
     # print('captcha: ', code)
-    if not set_captcha(redis, token, code):
+    if not await set_captcha(store, token, code):
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                             detail='生成验证码失败')
-    image = ImageCaptcha().generate_image(code)
-    with tempfile.NamedTemporaryFile(mode='w+b', suffix='.png', delete=False) as outfile:
-        image.save(outfile)
-        return FileResponse(outfile.name, media_type='image/png')
+    if image is None:    # 没有启用验证码池，或者池已经取空
+        image = await render_async(code)
+    return Response(image, media_type='image/png', headers={'Cache-Control': 'no-store'})
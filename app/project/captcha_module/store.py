@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# 验证码存储
+# 1. RedisStore: 基于redis，适合多节点部署
+# 2. MemoryStore: 进程内存储，适合单节点部署及压测，不需要依赖外部服务
+# Author: caiyingyao
+# Email: cyy0523xc@gmail.com
+# Created Time: 2021-06-16
+import time
+import heapq
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+from redis.asyncio import Redis
+from redis.commands.core import AsyncScript
+
+from common.timing import phase
+
+
+class BaseStore(ABC):
+    """验证码存储接口
+    pop需要保证读取和删除是原子的，验证码只能被使用一次
+    """
+    @abstractmethod
+    async def set(self, key: str, value: str, expire: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def pop(self, key: str) -> Optional[str]:
+        """读取并删除"""
+        ...
+
+    @abstractmethod
+    async def set_many(self, items: Dict[str, str], expire: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def pop_many(self, keys: List[str]) -> List[Optional[str]]:
+        ...
+
+
+# 获取并删除（原子操作，一次往返）
+# 相当于redis 6.2的GETDEL命令，使用脚本是为了兼容更低版本的redis
+_getdel_script = """
+local code = redis.call('GET', KEYS[1])
+if code then
+    redis.call('DEL', KEYS[1])
+end
+return code
+"""
+
+
+class RedisStore(BaseStore):
+    """基于redis的存储（每个请求创建一个实例，脚本在进程内只注册一次）"""
+    _getdel: Optional[AsyncScript] = None
+
+    def __init__(self, redis: Redis) -> None:
+        self.redis = redis
+        if RedisStore._getdel is None:
+            # 执行时使用EVALSHA，redis中不存在该脚本时自动重新加载
+            RedisStore._getdel = redis.register_script(_getdel_script)
+
+    async def set(self, key: str, value: str, expire: int) -> bool:
+        with phase('redis'):
+            return bool(await self.redis.set(key, value, ex=expire))
+
+    async def pop(self, key: str) -> Optional[str]:
+        with phase('redis'):
+            return self._decode(await self._getdel(keys=[key], client=self.redis))
+
+    async def set_many(self, items: Dict[str, str], expire: int) -> bool:
+        with phase('redis'):
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for key, value in items.items():
+                    pipe.set(key, value, ex=expire)
+                res = await pipe.execute()
+        return all(res)
+
+    async def pop_many(self, keys: List[str]) -> List[Optional[str]]:
+        with phase('redis'):
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    await self._getdel(keys=[key], client=pipe)
+                res = await pipe.execute()
+        return [self._decode(value) for value in res]
+
+    @staticmethod
+    def _decode(value) -> Optional[str]:
+        return None if value is None else str(value, encoding='utf8')
+
+
+class MemoryStore(BaseStore):
+    """进程内存储
+    过期时间使用最小堆管理，每次写入时清理已经过期的数据；
+    数据量超过上限时，优先淘汰最早过期的数据，保证内存占用有上限。
+    所有操作都在事件循环所在线程中同步完成，天然是原子的。
+    """
+    def __init__(self, max_size: int = 100000) -> None:
+        self.max_size = max_size
+        self._data: Dict[str, Tuple[str, float]] = {}     # key: (value, 过期时间)
+        self._heap: List[Tuple[float, str]] = []          # (过期时间, key)
+
+    async def set(self, key: str, value: str, expire: int) -> bool:
+        self._set(key, value, expire)
+        return True
+
+    async def pop(self, key: str) -> Optional[str]:
+        return self._pop(key)
+
+    async def set_many(self, items: Dict[str, str], expire: int) -> bool:
+        for key, value in items.items():
+            self._set(key, value, expire)
+        return True
+
+    async def pop_many(self, keys: List[str]) -> List[Optional[str]]:
+        return [self._pop(key) for key in keys]
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _set(self, key: str, value: str, expire: int):
+        now = time.monotonic()
+        self._purge(now)
+        while len(self._data) >= self.max_size and key not in self._data:
+            self._evict()
+        expire_at = now + expire
+        self._data[key] = (value, expire_at)
+        heapq.heappush(self._heap, (expire_at, key))
+        # 同一个key被覆盖时，堆中会残留旧的记录，残留过多时重建堆
+        if len(self._heap) > 2 * len(self._data) + 64:
+            self._heap = [(expire_at, key) for key, (_, expire_at) in self._data.items()]
+            heapq.heapify(self._heap)
+
+    def _pop(self, key: str) -> Optional[str]:
+        item = self._data.pop(key, None)
+        if item is None or item[1] <= time.monotonic():
+            return None
+        return item[0]
+
+    def _purge(self, now: float):
+        """清理已经过期的数据"""
+        while self._heap and self._heap[0][0] <= now:
+            self._evict()
+
+    def _evict(self):
+        """淘汰堆顶（最早过期）的数据"""
+        expire_at, key = heapq.heappop(self._heap)
+        item = self._data.get(key)
+        if item is not None and item[1] == expire_at:
+            del self._data[key]
+
+
+if __name__ == '__main__':
+    import asyncio
+
+    async def main():
+        store = MemoryStore(max_size=3)
+        await store.set('a', '1', 10)
+        assert await store.pop('a') == '1'
+        assert await store.pop('a') is None
+        await store.set('b', '2', 0)          # 立即过期
+        assert await store.pop('b') is None
+        await store.set_many({'c': '3', 'd': '4', 'e': '5', 'f': '6'}, 10)
+        assert len(store) == 3                # 超过上限，最早过期的c被淘汰
+        assert await store.pop_many(['c', 'd', 'f']) == [None, '4', '6']
+
+    asyncio.run(main())
+
+    class IncompleteStore(BaseStore):
+        async def set(self, key: str, value: str, expire: int) -> bool:
+            return True
+
+    try:
+        IncompleteStore()      # 没有实现全部接口时不能实例化
+        raise AssertionError('IncompleteStore should not be instantiable')
+    except TypeError:
+        pass
+    print('ok')
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+#
+# 准入控制（过载保护）
+# 限制同时处理的请求数，超出的请求进入有界的等待队列：
+# 1. 队列已满，或者排队超过ADMISSION_QUEUE_TIMEOUT秒时，立即拒绝请求，响应503（status.HTTP_503_SERVICE_UNAVAILABLE）及Retry-After
+# 2. 过载时快速失败，已经接受的请求可以在正常的时间内完成，而不是所有请求一起超时
+#
+# 全局限流：配置ADMISSION_ENABLED为True时，在init_app中注册中间件，健康检查等接口（ADMISSION_EXCLUDE_PATHS）不受限制
+# 按路由限流：在ROUTER_MODULES的配置中指定admission，或者手动注册依赖项：
+#     ROUTER_MODULES = [{'name': 'captcha_module', 'admission': {'max_concurrency': 10, 'max_queue': 20}}]
+#     limiter = get_limiter('captcha', max_concurrency=10)
+#     app.include_router(router, prefix="/captcha", dependencies=[Depends(limiter)])
+# 处理中及排队中的请求数、拒绝的请求数见接口/status/admission，开启监控指标时也会输出到/metrics
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import time
+import asyncio
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List
+
+from fastapi import FastAPI
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from settings import ADMISSION_MAX_CONCURRENCY, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT
+from settings import ADMISSION_RETRY_AFTER, ADMISSION_EXCLUDE_PATHS
+from exceptions import InternalException, ErrorResponse, status
+from common.metrics import observe_admission
+from common.timing import record
+
+
+class OverloadedException(InternalException):
+    """过载时拒绝请求：503及Retry-After"""
+    def __init__(self, limiter: str, reason: str, retry_after: int) -> None:
+        super().__init__(status.HTTP_503_SERVICE_UNAVAILABLE, detail=f'{limiter}: {reason}',
+                         headers={'Retry-After': str(retry_after)})
+
+
+class AdmissionLimiter:
+    """并发限制器（只在事件循环线程中使用，不需要加锁）
+    也可以作为FastAPI的依赖项使用：Depends(limiter)
+    Args:
+        name str: 名称，用于统计
+        max_concurrency int: 最大并发数
+        max_queue int: 等待队列的长度，0表示不排队
+        queue_timeout float: 最长排队时间（秒）
+        retry_after int: 拒绝时响应头Retry-After的值（秒）
+    """
+    def __init__(self, name: str, max_concurrency: int = ADMISSION_MAX_CONCURRENCY,
+                 max_queue: int = ADMISSION_MAX_QUEUE, queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+                 retry_after: int = ADMISSION_RETRY_AFTER) -> None:
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed: Dict[str, int] = {'queue_full': 0, 'queue_timeout': 0}
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    async def acquire(self):
+        """获取处理的名额，过载时抛出OverloadedException"""
+        if self.in_flight < self.max_concurrency and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            observe_admission(self.name, in_flight=1)
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._reject('queue_full')
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        observe_admission(self.name, queued=1)
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(fut, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if fut.done() and not fut.cancelled():     # 超时（或者取消）的同时已经获得了名额
+                if isinstance(e, asyncio.CancelledError):
+                    self.release()
+                    raise
+            else:
+                if fut in self._waiters:
+                    self._waiters.remove(fut)
+                    observe_admission(self.name, queued=-1)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self._reject('queue_timeout')
+        finally:
+            record('queue', time.perf_counter() - start)
+
+    def release(self):
+        """释放名额：有排队的请求时直接交给队首的请求"""
+        while self._waiters:
+            fut = self._waiters.popleft()
+            observe_admission(self.name, queued=-1)
+            if not fut.done():
+                fut.set_result(None)
+                self.admitted += 1
+                return
+        self.in_flight -= 1
+        observe_admission(self.name, in_flight=-1)
+
+    def stats(self) -> dict:
+        return {'name': self.name, 'max_concurrency': self.max_concurrency, 'max_queue': self.max_queue,
+                'in_flight': self.in_flight, 'queue_depth': len(self._waiters),
+                'admitted': self.admitted, 'shed': dict(self.shed)}
+
+    def _reject(self, reason: str):
+        self.shed[reason] += 1
+        observe_admission(self.name, shed=reason)
+        raise OverloadedException(self.name, reason, self.retry_after)
+
+    async def __call__(self) -> AsyncIterator[None]:
+        """作为依赖项使用：接口处理完成之后释放名额"""
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+_limiters: Dict[str, AdmissionLimiter] = {}
+
+
+def get_limiter(name: str, **kwargs) -> AdmissionLimiter:
+    """获取（或者创建）指定名称的限制器，参数见AdmissionLimiter"""
+    if name not in _limiters:
+        _limiters[name] = AdmissionLimiter(name, **kwargs)
+    return _limiters[name]
+
+
+def get_limiter_stats() -> List[dict]:
+    return [limiter.stats() for limiter in _limiters.values()]
+
+
+class AdmissionMiddleware:
+    """全局准入控制中间件，拒绝的请求直接响应，不经过路由及异常处理"""
+    def __init__(self, app: ASGIApp, limiter: AdmissionLimiter,
+                 exclude_paths: List[str] = ADMISSION_EXCLUDE_PATHS) -> None:
+        self.app = app
+        self.limiter = limiter
+        self.exclude_paths = tuple(p.rstrip('/') for p in exclude_paths)
+        self._exclude_prefixes = tuple(p + '/' for p in self.exclude_paths)
+
+    def is_excluded(self, path: str) -> bool:
+        """按完整路径段匹配：/status排除/status及/status/xxx，但不排除/statusx"""
+        return path in self.exclude_paths or path.startswith(self._exclude_prefixes)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or self.is_excluded(scope['path']):
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.limiter.acquire()
+        except OverloadedException as e:
+            response = ErrorResponse(e.code, message=e.message, detail=e.detail, headers=e.headers)
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limiter.release()
+
+
+def init_admission(app: FastAPI, enabled: bool = False):
+    """注册准入控制
+    Args:
+        enabled bool: 是否开启全局的并发限制，按路由的限制不受该参数影响
+    """
+    if enabled:
+        app.add_middleware(AdmissionMiddleware, limiter=get_limiter('global'))
+
+    @app.get("/status/admission", include_in_schema=False)
+    async def admission_stats_api():
+        """各个限制器的处理中、排队中及拒绝的请求数（当前进程）"""
+        return get_limiter_stats()
+
+
+if __name__ == '__main__':
+    # 在项目目录下执行：python -m common.admission
+    from fastapi import Depends
+    from fastapi.testclient import TestClient
+    from exceptions import init_exception
+
+    async def main():
+        limiter = AdmissionLimiter('test', max_concurrency=2, max_queue=2, queue_timeout=0.2)
+
+        async def job(seconds: float) -> str:
+            try:
+                await limiter.acquire()
+            except OverloadedException as e:
+                return e.detail.split(': ')[1]
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                limiter.release()
+            return 'ok'
+
+        # 2个处理中，2个排队（其中1个在处理的请求完成后获得名额），其余拒绝
+        results = await asyncio.gather(*[job(0.15) for _ in range(5)])
+        assert sorted(results) == ['ok', 'ok', 'ok', 'ok', 'queue_full'], results
+        results = await asyncio.gather(job(0.5), job(0.5), job(0.01))
+        assert results == ['ok', 'ok', 'queue_timeout'], results
+        assert limiter.in_flight == 0 and not limiter._waiters
+        print(limiter.stats())
+
+    asyncio.run(main())
+
+    app = FastAPI()
+    init_exception(app)
+    slow = get_limiter('slow', max_concurrency=1, max_queue=0)
+
+    @app.get('/slow', dependencies=[Depends(slow)])
+    async def slow_api():
+        return {'ok': True}
+
+    slow.in_flight = 1     # 模拟满载
+    resp = TestClient(app).get('/slow')
+    assert resp.status_code == 503 and resp.headers['retry-after'] == str(ADMISSION_RETRY_AFTER), resp.text
+    slow.in_flight = 0
+    assert TestClient(app).get('/slow').status_code == 200 and slow.in_flight == 0
+
+    middleware = AdmissionMiddleware(app, slow, exclude_paths=['/status', '/debug/'])
+    assert middleware.is_excluded('/status') and middleware.is_excluded('/status/logs')
+    assert middleware.is_excluded('/debug') and middleware.is_excluded('/debug/profiles')
+    assert not middleware.is_excluded('/statusx') and not middleware.is_excluded('/debugger')
+    print('ok')
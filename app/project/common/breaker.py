@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# 上游服务熔断器
+# 每个上游host一个熔断器，状态：
+# 1. closed: 正常状态，连续失败次数达到阈值后转为open
+# 2. open: 熔断状态，请求直接失败，经过恢复时间后转为half_open
+# 3. half_open: 半开状态，只放行少量试探请求，成功则恢复closed，失败则重新open
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import time
+import threading
+from typing import Dict, List, Optional
+
+from common.logger import logger
+
+
+class CircuitBreaker:
+    """熔断器（线程安全，同步和异步请求共用）"""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30,
+                 half_open_calls: int = 1) -> None:
+        """
+        :param name 熔断器名称，通常是上游服务的host
+        :param failure_threshold 连续失败多少次之后熔断
+        :param recovery_timeout 熔断多少秒之后进入半开状态
+        :param half_open_calls 半开状态下允许同时进行的试探请求数
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_calls = half_open_calls
+        self.state = self.CLOSED
+        self.failures = 0           # 连续失败次数
+        self.opened_at = 0.0        # 最近一次熔断的时间
+        self.open_count = 0         # 累计熔断次数
+        self.rejected = 0           # 累计被拒绝的请求数
+        self._trials = 0            # 半开状态下正在进行的试探请求数
+        self._half_open_id = 0      # 进入半开状态的次数，用于区分试探请求属于哪一次半开
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """是否允许发起请求"""
+        return self.acquire() is not None
+
+    def acquire(self) -> Optional[int]:
+        """申请发起请求，拒绝时返回None，否则返回放行凭证：
+        试探请求为本次半开的编号，普通请求为0；请求没有结果时需要把凭证传给release
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.recovery_timeout:
+                    self.rejected += 1
+                    return None
+                self._half_open_id += 1
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._trials >= self.half_open_calls:
+                    self.rejected += 1
+                    return None
+                self._trials += 1
+                return self._half_open_id
+            return 0
+
+    def record_success(self):
+        """请求成功"""
+        with self._lock:
+            self.failures = 0
+            if self.state == self.HALF_OPEN:
+                self._trials = 0
+                self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        """请求失败（超时，连接异常，5XX等）"""
+        with self._lock:
+            self.failures += 1
+            # 已经熔断时不再刷新熔断时间，否则熔断前发出的请求陆续失败会推迟恢复
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED
+                                                and self.failures >= self.failure_threshold):
+                self.open_count += 1
+                self._trials = 0
+                self.opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def release(self, token: int):
+        """请求没有结果（如被取消）：只释放当前半开状态下的试探名额，不影响熔断状态
+        Args:
+            token int: acquire返回的放行凭证，普通请求（0）及之前半开状态的试探请求不占用当前的名额
+        """
+        with self._lock:
+            if token and token == self._half_open_id and self.state == self.HALF_OPEN and self._trials > 0:
+                self._trials -= 1
+
+    def info(self) -> dict:
+        """熔断器当前状态"""
+        return {
+            'name': self.name,
+            'state': self.state,
+            'failures': self.failures,
+            'open_count': self.open_count,
+            'rejected': self.rejected,
+        }
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            logger.warning(f"熔断器状态变化 : {self.name} : {self.state} -> {state}")
+            self.state = state
+
+
+# 熔断器注册表，key为上游服务的host
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name: str, **kwargs) -> CircuitBreaker:
+    """获取熔断器，不存在则创建
+    Args:
+        name (str): 熔断器名称，通常是上游服务的host
+        **kwargs: 创建熔断器时的参数，见CircuitBreaker
+    """
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(name, CircuitBreaker(name, **kwargs))
+    return breaker
+
+
+def get_breaker_states() -> List[dict]:
+    """获取所有熔断器的状态，可用于监控或者排查问题"""
+    return [breaker.info() for breaker in list(_breakers.values())]
+
+
+if __name__ == '__main__':
+    breaker = CircuitBreaker('test', failure_threshold=2, recovery_timeout=0.1)
+    assert breaker.allow()
+    normal = breaker.acquire()            # 熔断前发出的请求
+    assert normal == 0
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    opened_at = breaker.opened_at
+    breaker.record_failure()              # 已经熔断，不刷新熔断时间
+    assert breaker.opened_at == opened_at and breaker.open_count == 1
+    assert breaker.allow() is False
+    time.sleep(0.1)
+    trial = breaker.acquire()             # 半开状态，放行一个试探请求
+    assert trial and breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow() is False
+    breaker.release(normal)               # 普通请求被取消，不释放试探名额
+    assert breaker.allow() is False
+    breaker.release(trial)                # 试探请求被取消，名额可以再次使用
+    assert breaker.allow() and breaker.state == CircuitBreaker.HALF_OPEN
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    print(breaker.info())
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# 响应压缩中间件（gzip及brotli）
+# 1. 只压缩允许的类型（如json、文本），已经压缩过的响应（设置了Content-Encoding，或者png等图片）不会再压缩
+# 2. 小于最小长度的响应不压缩；较大的响应在线程池中压缩，避免阻塞事件循环
+# 3. 流式响应：每个分块压缩之后立即输出，不会等待整个响应
+# 配置见settings_base.py中的COMPRESSION_*，brotli需要安装brotli包，没有安装时只使用gzip
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import zlib
+from typing import List, Optional
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from settings import COMPRESSION_MINIMUM_SIZE, COMPRESSION_LEVEL, COMPRESSION_BROTLI_QUALITY
+from settings import COMPRESSION_CONTENT_TYPES, COMPRESSION_ALGORITHMS
+from common.precomputed import parse_accept_encoding, accepts_encoding
+
+try:
+    import brotli
+except ImportError:     # brotli是可选依赖
+    brotli = None
+
+# 超过该长度的响应在线程池中压缩
+THREAD_MINIMUM_SIZE = 256 * 1024
+
+
+class _Compressor:
+    """压缩器：统一gzip及brotli的接口"""
+    def __init__(self, encoding: str, level: int, quality: int) -> None:
+        self.encoding = encoding
+        if encoding == 'br':
+            self._obj = brotli.Compressor(quality=quality)
+        else:
+            self._obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        """压缩数据，final为True时结束压缩；否则输出已经压缩的数据（流式响应）"""
+        if self.encoding == 'br':
+            out = self._obj.process(data)
+            return out + (self._obj.finish() if final else self._obj.flush())
+        out = self._obj.compress(data)
+        return out + self._obj.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class CompressionMiddleware:
+    """响应压缩中间件
+    Args:
+        minimum_size int: 最小压缩长度（字节）
+        level int: gzip压缩级别（1-9）
+        brotli_quality int: brotli压缩级别（0-11）
+        content_types List[str]: 允许压缩的类型（前缀匹配），如application/json, text/
+        algorithms List[str]: 使用的压缩算法，按优先级排列，可选br及gzip
+    """
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MINIMUM_SIZE,
+                 level: int = COMPRESSION_LEVEL, brotli_quality: int = COMPRESSION_BROTLI_QUALITY,
+                 content_types: List[str] = COMPRESSION_CONTENT_TYPES,
+                 algorithms: List[str] = COMPRESSION_ALGORITHMS) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.content_types = tuple(content_types)
+        self.algorithms = [name for name in algorithms
+                           if name == 'gzip' or (name == 'br' and brotli is not None)]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or scope['method'] == 'HEAD':
+            await self.app(scope, receive, send)
+            return
+        encoding = self._select_encoding(Headers(scope=scope).get('accept-encoding', ''))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = _CompressionResponder(self, encoding, send)
+        await self.app(scope, receive, responder.send)
+
+    def _select_encoding(self, accept_encoding: str) -> Optional[str]:
+        """按服务端的优先级选择客户端接受的压缩算法，q=0的算法不使用"""
+        accepted = parse_accept_encoding(accept_encoding)
+        for name in self.algorithms:
+            if accepts_encoding(accepted, name):
+                return name
+        return None
+
+    def compressible(self, headers: MutableHeaders, status: int) -> bool:
+        """判断响应是否需要压缩"""
+        if status < 200 or status in (204, 206, 304) or 'content-encoding' in headers:
+            return False
+        if 'no-transform' in headers.get('cache-control', ''):
+            return False
+        content_type = headers.get('content-type', '')
+        return content_type.startswith(self.content_types)
+
+
+class _CompressionResponder:
+    """处理单个请求的响应"""
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send: Send) -> None:
+        self.middleware = middleware
+        self.encoding = encoding
+        self._send = send
+        self.start_message: Optional[Message] = None
+        self.compressor: Optional[_Compressor] = None
+        self.passthrough = False
+
+    async def send(self, message: Message) -> None:
+        if self.passthrough:
+            await self._send(message)
+            return
+        if message['type'] == 'http.response.start':
+            headers = MutableHeaders(scope=message)
+            if not self.middleware.compressible(headers, message['status']):
+                self.passthrough = True
+                await self._send(message)
+                return
+            self.start_message = message     # 等待第一个分块，再决定是否压缩
+            return
+        if message['type'] != 'http.response.body':
+            await self._send(message)
+            return
+
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if self.compressor is None:
+            if not more_body and len(body) < self.middleware.minimum_size:
+                # 完整的响应，且长度较小，不压缩
+                self.passthrough = True
+                await self._send(self.start_message)
+                await self._send(message)
+                return
+            self.compressor = _Compressor(self.encoding, self.middleware.level,
+                                          self.middleware.brotli_quality)
+            headers = MutableHeaders(scope=self.start_message)
+            headers['Content-Encoding'] = self.encoding
+            headers.add_vary_header('Accept-Encoding')
+            etag = headers.get('etag')
+            if etag and not etag.startswith('W/'):    # 压缩后内容变化，强ETag改为弱ETag
+                headers['ETag'] = f'W/{etag}'
+            if more_body:    # 流式响应，长度未知
+                del headers['Content-Length']
+            else:
+                body = await self._compress(body, final=True)
+                headers['Content-Length'] = str(len(body))
+                await self._send(self.start_message)
+                await self._send({'type': 'http.response.body', 'body': body})
+                return
+            await self._send(self.start_message)
+
+        body = await self._compress(body, final=not more_body)
+        await self._send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+    async def _compress(self, data: bytes, final: bool) -> bytes:
+        if len(data) >= THREAD_MINIMUM_SIZE:
+            return await run_in_threadpool(self.compressor.compress, data, final)
+        return self.compressor.compress(data, final)
+
+
+if __name__ == '__main__':
+    # 在项目目录下执行：python -m common.compression
+    from fastapi import FastAPI
+    from fastapi.responses import Response, StreamingResponse
+    from fastapi.testclient import TestClient
+
+    app = FastAPI()
+
+    @app.get('/big')
+    async def big():
+        return [{'id': i, 'name': f'name {i}'} for i in range(10000)]
+
+    @app.get('/small')
+    async def small():
+        return {'a': 1}
+
+    @app.get('/png')
+    async def png():
+        return Response(b'\x89PNG' * 1000, media_type='image/png')
+
+    @app.get('/stream')
+    async def stream():
+        async def gen():
+            for i in range(100):
+                yield f'line {i}\n'.encode()
+        return StreamingResponse(gen(), media_type='text/plain')
+
+    app.add_middleware(CompressionMiddleware, algorithms=['gzip'])
+    client = TestClient(app)
+    resp = client.get('/big', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['content-encoding'] == 'gzip'
+    assert int(resp.headers['content-length']) < len(resp.content) / 5
+    assert 'content-encoding' not in client.get('/small', headers={'Accept-Encoding': 'gzip'}).headers
+    assert 'content-encoding' not in client.get('/png', headers={'Accept-Encoding': 'gzip'}).headers
+    resp = client.get('/stream', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['content-encoding'] == 'gzip' and resp.text.endswith('line 99\n')
+    assert 'content-encoding' not in client.get('/big', headers={'Accept-Encoding': 'identity'}).headers
+    assert 'content-encoding' not in client.get('/big', headers={'Accept-Encoding': 'gzip;q=0, br'}).headers
+    assert client.get('/big', headers={'Accept-Encoding': '*'}).headers['content-encoding'] == 'gzip'
+    assert 'content-encoding' not in client.get('/big', headers={'Accept-Encoding': '*;q=0'}).headers
+    print('ok')
@@ -4,38 +4,112 @@
 # Author: __author__
 # Email: __email__
 # Created Time: __created_time__
-from typing import Iterator
-from redis import Redis, ConnectionPool
+from typing import AsyncIterator, Iterator, Optional
+from fastapi import FastAPI
+from redis import Redis, BlockingConnectionPool
+from redis.asyncio import Redis as AsyncRedis
+from redis.asyncio import BlockingConnectionPool as AsyncConnectionPool
+
+from settings import REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT, REDIS_SOCKET_TIMEOUT
+from settings import REDIS_SOCKET_CONNECT_TIMEOUT, REDIS_HEALTH_CHECK_INTERVAL
 
 # redis pool
 _redis_pool = None
+# 异步redis pool，在应用启动时创建，关闭时释放
+_async_redis_pool: Optional[AsyncConnectionPool] = None
+# redis连接参数
+_redis_params: dict = {}
 
 
 def init_redis(host: str, port=6379, db=0):
     """配置redis """
     global _redis_pool
-    _redis_pool = ConnectionPool(host=host, port=port, db=db)
+    # 检查间隔(health_check_interval)的含义:
+    # 当连接在health_check_interval秒内没有使用下次使用时需要进行健康检查。
+    # 在内部是通过发送ping命令来实现
+    # 使用阻塞的连接池：连接数达到上限时等待空闲连接（最长REDIS_POOL_TIMEOUT秒），而不是直接抛出异常
+    _redis_params.update(host=host, port=port, db=db,
+                         max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT,
+                         socket_timeout=REDIS_SOCKET_TIMEOUT,
+                         socket_connect_timeout=REDIS_SOCKET_CONNECT_TIMEOUT,
+                         health_check_interval=REDIS_HEALTH_CHECK_INTERVAL)
+    _redis_pool = BlockingConnectionPool(**_redis_params)
+
+
+def init_redis_events(app: FastAPI):
+    """注册异步redis连接池的启动及关闭事件
+    启动时创建连接池并建立第一个连接（同时检查配置是否正确），关闭时释放所有连接
+    """
+    @app.on_event("startup")
+    async def startup_redis():
+        await open_async_redis()
+
+    @app.on_event("shutdown")
+    async def shutdown_redis():
+        await close_async_redis()
+
+
+async def open_async_redis():
+    """创建异步redis连接池"""
+    r = AsyncRedis(connection_pool=_get_async_pool())
+    await r.ping()
+
+
+async def close_async_redis():
+    """释放异步redis连接池"""
+    global _async_redis_pool
+    if _async_redis_pool is not None:
+        await _async_redis_pool.disconnect()
+        _async_redis_pool = None
+
+
+def _get_async_pool() -> AsyncConnectionPool:
+    global _async_redis_pool
+    if _async_redis_pool is None:
+        if not _redis_params:
+            raise Exception('redis尚未配置，请先调用init_redis')
+        _async_redis_pool = AsyncConnectionPool(**_redis_params)
+    return _async_redis_pool
 
 
 def get_redis() -> Iterator[Redis]:
     """获取redis操作对象
     每一个请求处理完毕后会关闭当前连接，不同的请求使用不同的连接
     """
-    # 检查间隔(health_check_interval)的含义:
-    # 当连接在health_check_interval秒内没有使用下次使用时需要进行健康检查。
-    # 在内部是通过发送ping命令来实现
-    r = Redis(connection_pool=_redis_pool, health_check_interval=30)
+    r = Redis(connection_pool=_redis_pool)
     try:
         yield r
     finally:
         r.close()
 
 
+async def get_async_redis() -> AsyncIterator[AsyncRedis]:
+    """获取异步redis操作对象，在async def的接口中应该使用该依赖
+    连接从连接池中获取，每个命令执行完毕后归还连接池
+    """
+    r = AsyncRedis(connection_pool=_get_async_pool())
+    try:
+        yield r
+    finally:
+        await r.aclose()
+
+
 if __name__ == '__main__':
+    # 在项目目录下执行: python -m common.connections 192.168.1.242
     import sys
+    import asyncio
     init_redis(sys.argv[1])
     r = get_redis()
     r = next(r)
     print(r)
     r.set('key', 'val', 10)
     assert str(r.get('key'), encoding='utf8') == 'val'
+
+    async def main():
+        await open_async_redis()
+        async for r in get_async_redis():
+            await r.set('key', 'val2', 10)
+            assert str(await r.get('key'), encoding='utf8') == 'val2'
+        await close_async_redis()
+
+    asyncio.run(main())
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+# 异常上报
+# 异常信息通过日志（loguru的enqueue模式，由后台线程写入文件）输出，不再同步写stdout；
+# 异常风暴时（如上游服务故障导致大量相同的异常），为了不拖垮整个worker：
+# 1. 去重：同一个窗口期内相同的异常堆栈只输出一次完整堆栈，之后只计数，窗口期结束时输出重复次数
+# 2. 限流：每秒输出完整堆栈的数量有上限，超过上限时只输出一行异常信息
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import time
+import threading
+import traceback
+from typing import Dict, Tuple
+
+from settings import ERROR_REPORT_WINDOW, ERROR_REPORT_MAX_PER_SECOND
+from common.logger import logger
+
+
+class _Entry:
+    __slots__ = ('expires_at', 'summary', 'suppressed')
+
+    def __init__(self, expires_at: float, summary: str) -> None:
+        self.expires_at = expires_at
+        self.summary = summary
+        self.suppressed = 0       # 窗口期内被省略的次数
+
+
+class ErrorReporter:
+    """异常上报（去重及限流）
+    Args:
+        window float: 去重的窗口期秒数
+        max_per_second int: 每秒最多输出的完整堆栈数量
+        max_keys int: 最多记录的异常数量，超过时提前清理
+    """
+    def __init__(self, window: float = 60, max_per_second: int = 10, max_keys: int = 1000) -> None:
+        self.window = window
+        self.max_per_second = max_per_second
+        self.max_keys = max_keys
+        self._entries: Dict[Tuple, _Entry] = {}
+        self._lock = threading.Lock()
+        self._second = 0
+        self._emitted = 0           # 当前这一秒已经输出的完整堆栈数量
+        self._last_sweep = time.monotonic()
+        # 统计信息
+        self.reported = 0
+        self.suppressed = 0
+        self.rate_limited = 0
+
+    def report(self, exc: BaseException, message: str = ''):
+        """上报异常，需要在捕获到异常之后调用
+        Args:
+            exc BaseException: 异常对象
+            message str: 附加的异常描述，如请求的路径
+        """
+        key = fingerprint(exc)
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at > now:
+                entry.suppressed += 1
+                self.suppressed += 1
+                return
+            self._entries[key] = _Entry(now + self.window, _summary(exc))
+            full = self._acquire(now)
+            self.reported += 1
+            if not full:
+                self.rate_limited += 1
+
+        # 日志sink的diagnose为False，堆栈中不会输出局部变量的值（可能包含请求数据、token等）
+        if full:
+            logger.opt(exception=exc).error(f"{message} {_summary(exc)}".strip())
+        else:
+            logger.error(f"{message} {_summary(exc)} (超出每秒{self.max_per_second}条的上限，省略堆栈)".strip())
+
+    def flush(self):
+        """输出所有还没有输出的重复次数，如应用关闭时"""
+        with self._lock:
+            entries, self._entries = self._entries, {}
+        for entry in entries.values():
+            _log_suppressed(entry)
+
+    def stats(self) -> dict:
+        return {
+            'keys': len(self._entries),
+            'reported': self.reported,
+            'suppressed': self.suppressed,
+            'rate_limited': self.rate_limited,
+        }
+
+    def _acquire(self, now: float) -> bool:
+        """每秒输出完整堆栈的限流"""
+        second = int(now)
+        if second != self._second:
+            self._second, self._emitted = second, 0
+        if self._emitted >= self.max_per_second:
+            return False
+        self._emitted += 1
+        return True
+
+    def _sweep(self, now: float):
+        """清理过期的异常，并输出窗口期内的重复次数（最多每秒执行一次）"""
+        if now - self._last_sweep < 1 and len(self._entries) < self.max_keys:
+            return
+        self._last_sweep = now
+        expired = [key for key, entry in self._entries.items() if entry.expires_at <= now]
+        if len(self._entries) - len(expired) >= self.max_keys:     # 超过上限时清理最早的一半
+            expired = list(self._entries)[:self.max_keys // 2]
+        for key in expired:
+            _log_suppressed(self._entries.pop(key))
+
+
+def fingerprint(exc: BaseException) -> Tuple:
+    """异常的指纹：异常类型及各层调用的位置
+    不需要格式化异常堆栈，代价很小；异常信息不参与计算，避免信息中带有ID等导致无法去重
+    """
+    frames = []
+    tb = exc.__traceback__
+    while tb is not None:
+        frames.append((tb.tb_frame.f_code.co_filename, tb.tb_lineno))
+        tb = tb.tb_next
+    return (type(exc).__qualname__, tuple(frames))
+
+
+def format_detail(exc: BaseException) -> str:
+    """异常的简要信息：最后一层调用的位置及异常信息，用于接口响应中的detail字段"""
+    lines = traceback.format_list(traceback.extract_tb(exc.__traceback__, limit=-1))
+    lines += traceback.format_exception_only(type(exc), exc)
+    return '\n'.join(''.join(lines).strip().split('\n')[-3:])
+
+
+def _summary(exc: BaseException) -> str:
+    return f"{type(exc).__name__}: {exc}"
+
+
+def _log_suppressed(entry: _Entry):
+    if entry.suppressed > 0:
+        logger.error(f"{entry.summary} (窗口期内重复{entry.suppressed}次，已省略)")
+
+
+# 全局的异常上报对象
+error_reporter = ErrorReporter(window=ERROR_REPORT_WINDOW, max_per_second=ERROR_REPORT_MAX_PER_SECOND)
+
+
+if __name__ == '__main__':
+    # 在项目目录下执行：python -m common.error_report
+    reporter = ErrorReporter(window=60, max_per_second=2)
+
+    def fail(i):
+        raise ValueError(f"error {i}")
+
+    for i in range(100):
+        try:
+            fail(i)
+        except ValueError as e:
+            reporter.report(e)
+    assert reporter.stats()['reported'] == 1
+    assert reporter.stats()['suppressed'] == 99
+
+    # 不同的异常位置，超过每秒上限的不输出完整堆栈
+    for i in range(5):
+        try:
+            exec("\n" * i + "1 / 0")
+        except ZeroDivisionError as e:
+            reporter.report(e)
+    assert reporter.stats()['rate_limited'] == 4, reporter.stats()
+
+    try:
+        {}['a']
+    except KeyError as e:
+        assert format_detail(e).endswith("KeyError: 'a'")
+    reporter.flush()
+    print(reporter.stats())
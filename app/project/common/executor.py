@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+#
+# 在线程池或进程池中执行阻塞/CPU密集型的函数，避免阻塞事件循环
+# 1. run_in_thread: 复制当前的上下文（TraceID、请求耗时等）到工作线程中执行
+# 2. run_in_process: 把TraceID传到子进程中恢复，函数及参数需要能被pickle
+# 两者都支持超时（timeout参数）和取消：还没开始执行的任务会被直接取消；
+# 已经开始执行的线程任务不能被强制中断，可以在函数中通过cancelled()判断调用方是否已经放弃等待，提前结束。
+#
+# 使用示例：
+#     from common.executor import run_in_thread, run_in_process
+#     data = await run_in_thread(parse_file, path, timeout=10)
+#     result = await run_in_process(predict, data, timeout=60)
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import os
+import asyncio
+import threading
+import contextvars
+from functools import partial
+from typing import Any, Callable, Optional
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from fastapi import FastAPI
+
+from settings import EXECUTOR_THREAD_WORKERS, EXECUTOR_PROCESS_WORKERS
+from exceptions import InternalException, status
+from common.logger import logger, TraceID
+
+_thread_executor: Optional[ThreadPoolExecutor] = None
+_process_executor: Optional[ProcessPoolExecutor] = None
+_lock = threading.Lock()
+# 应用关闭之后不再创建新的线程池及进程池（如shutdown时还在执行的后台任务），避免泄漏
+_closed = False
+# 工作线程中的取消标记，调用方超时或者被取消时设置
+_cancel_event: contextvars.ContextVar[Optional[threading.Event]] = contextvars.ContextVar(
+    'x_cancel_event', default=None)
+
+
+def init_executors(app: FastAPI):
+    """应用启动时创建线程池及进程池，关闭时释放"""
+    @app.on_event("startup")
+    async def startup_executors():
+        global _closed
+        _closed = False
+        get_thread_executor()
+        if EXECUTOR_PROCESS_WORKERS > 0:
+            get_process_executor()
+
+    @app.on_event("shutdown")
+    async def shutdown_executors():
+        shutdown()
+
+
+def get_thread_executor() -> ThreadPoolExecutor:
+    """获取共享的线程池，线程数由EXECUTOR_THREAD_WORKERS配置，已经关闭时抛出RuntimeError"""
+    global _thread_executor
+    if _thread_executor is None:
+        with _lock:
+            if _closed:
+                raise RuntimeError('线程池已经关闭')
+            if _thread_executor is None:
+                _thread_executor = ThreadPoolExecutor(max_workers=EXECUTOR_THREAD_WORKERS,
+                                                      thread_name_prefix='worker')
+    return _thread_executor
+
+
+def get_process_executor() -> ProcessPoolExecutor:
+    """获取共享的进程池，进程数由EXECUTOR_PROCESS_WORKERS配置，不大于0时为CPU核数，已经关闭时抛出RuntimeError"""
+    global _process_executor
+    if _process_executor is None:
+        with _lock:
+            if _closed:
+                raise RuntimeError('进程池已经关闭')
+            if _process_executor is None:
+                workers = EXECUTOR_PROCESS_WORKERS if EXECUTOR_PROCESS_WORKERS > 0 else os.cpu_count()
+                _process_executor = ProcessPoolExecutor(max_workers=workers)
+    return _process_executor
+
+
+def shutdown():
+    """关闭线程池及进程池，未开始执行的任务会被取消，之后不能再使用run_in_thread/run_in_process"""
+    global _thread_executor, _process_executor, _closed
+    with _lock:
+        _closed = True
+        if _thread_executor is not None:
+            _thread_executor.shutdown(wait=False, cancel_futures=True)
+            _thread_executor = None
+        if _process_executor is not None:
+            _process_executor.shutdown(wait=False, cancel_futures=True)
+            _process_executor = None
+
+
+def cancelled() -> bool:
+    """在run_in_thread执行的函数中调用，判断调用方是否已经超时或者被取消"""
+    event = _cancel_event.get()
+    return event is not None and event.is_set()
+
+
+async def run_in_thread(fn: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+    """在共享的线程池中执行函数
+    Args:
+        fn Callable: 需要执行的同步函数
+        timeout (float, optional): 超时秒数，超时时抛出504异常. Defaults to None.
+    Returns:
+        Any: 函数的返回值
+    """
+    event = threading.Event()
+    ctx = contextvars.copy_context()     # 工作线程中使用调用方的上下文，日志中的请求ID等保持一致
+    ctx.run(_cancel_event.set, event)
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(get_thread_executor(), partial(ctx.run, fn, *args, **kwargs))
+    return await _wait(future, timeout, event, fn)
+
+
+async def run_in_process(fn: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+    """在共享的进程池中执行函数，函数及参数需要能被pickle（如模块级别的函数）
+    注意：已经开始执行的任务超时之后，子进程仍然会执行完成，只是结果被丢弃
+    Args:
+        fn Callable: 需要执行的函数
+        timeout (float, optional): 超时秒数，超时时抛出504异常. Defaults to None.
+    Returns:
+        Any: 函数的返回值
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(get_process_executor(),
+                                  partial(_process_entry, TraceID.get(), fn, args, kwargs))
+    return await _wait(future, timeout, None, fn)
+
+
+async def _wait(future: asyncio.Future, timeout: Optional[float],
+                event: Optional[threading.Event], fn: Callable) -> Any:
+    """等待执行结果，超时或者被取消时通知工作线程"""
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"执行超时 : {_name(fn)} : timeout = {timeout}")
+        raise InternalException(status.HTTP_504_GATEWAY_TIMEOUT, message=f"执行超时: {_name(fn)}")
+    finally:
+        if event is not None:
+            event.set()
+
+
+def _process_entry(trace: dict, fn: Callable, args: tuple, kwargs: dict) -> Any:
+    """子进程的入口：恢复追踪ID之后再执行函数"""
+    TraceID.init(trace)
+    return fn(*args, **kwargs)
+
+
+def _name(fn: Callable) -> str:
+    return getattr(fn, '__qualname__', None) or repr(fn)
+
+
+def _slow(seconds: float) -> str:
+    """测试用：模拟耗时任务"""
+    import time
+    start = time.monotonic()
+    while time.monotonic() - start < seconds:
+        if cancelled():
+            return 'cancelled'
+        time.sleep(0.01)
+    return TraceID.get_trace_id()
+
+
+if __name__ == '__main__':
+    # 在项目目录下执行：python -m common.executor
+    async def main():
+        TraceID.set_trace('t123')
+        assert await run_in_thread(_slow, 0) == 't123'
+        assert await run_in_process(_slow, 0) == 't123'
+        try:
+            await run_in_thread(_slow, 5, timeout=0.1)
+            assert False
+        except InternalException as e:
+            assert e.code == status.HTTP_504_GATEWAY_TIMEOUT
+        shutdown()
+        try:    # 关闭之后不会重新创建线程池
+            await run_in_thread(_slow, 0)
+            assert False
+        except RuntimeError:
+            pass
+
+    asyncio.run(main())
+    print('ok')
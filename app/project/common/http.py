@@ -1,38 +1,169 @@
 # -*- coding: utf-8 -*-
 #
 # 网络请求接口封装
+# 同步请求使用共享的requests.Session，异步请求使用共享的httpx.AsyncClient，
+# 两者都会复用keep-alive连接，避免每次请求都重新建立TCP/TLS连接
 # Author: __author__
 # Email: __email__
 # Created Time: __created_time__
-import requests
+import copy
+import time
+import random
+import asyncio
+import threading
+from functools import partial
+from http.cookiejar import DefaultCookiePolicy
+from typing import Dict, Hashable, Optional
+from urllib.parse import urlsplit
 from traceback import format_exc
 
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
 from settings import REQUEST_ID_KEY
+from settings import HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE, HTTP_MAX_CONNECTIONS
+from settings import HTTP_KEEPALIVE_EXPIRY, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+from settings import HTTP_RETRY_BACKOFF, HTTP_RETRY_BACKOFF_MAX
+from settings import HTTP_BREAKER_ENABLED, HTTP_BREAKER_FAILURE_THRESHOLD
+from settings import HTTP_BREAKER_RECOVERY_TIMEOUT, HTTP_BREAKER_HALF_OPEN_CALLS
+from settings import HTTP_COALESCE_GET, HTTP_CACHE_MAXSIZE
 from exceptions import InternalException, status
 from common.logger import logger, TraceID
+from common.breaker import CircuitBreaker, get_breaker
+from common.singleflight import Group, AsyncGroup
+from common.http_cache import ResponseCache
+from common.timing import phase
+from common.metrics import observe_upstream
+
+# 共享的客户端，第一次使用时才创建
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+_async_client: Optional[httpx.AsyncClient] = None
+# 异步请求时每个host的并发连接限制
+_host_semaphores: Dict[str, asyncio.Semaphore] = {}
+# 相同GET请求的合并
+_get_group = Group()
+_async_get_group = AsyncGroup()
+# 这些参数之外的参数（如stream, cookies等）可能影响响应结果，这时不进行合并
+_COALESCE_KWARGS = {'url', 'params', 'headers', 'timeout'}
+# 共享的客户端不保存上游响应的cookie，否则会在之后所有调用方的请求中带上（不同用户之间泄露身份凭证）
+# 需要cookie时在每次调用时通过cookies参数或者Cookie头信息传入
+_NO_COOKIES = DefaultCookiePolicy(allowed_domains=[])
+# GET请求的响应缓存（调用时指定cache_ttl才会使用），带有身份凭证头信息的请求不缓存
+_NO_CACHE_HEADERS = {'authorization', 'proxy-authorization', 'cookie'}
+response_cache = ResponseCache(maxsize=HTTP_CACHE_MAXSIZE)
 
 
 def post(*args, retry: int = 2, **kwargs) -> requests.Response:
-    """基于requests.post实现
+    """基于requests.Session.post实现
     Args:
         retry (int, optional): 超时导致的失败重试的次数. Defaults to 2.
     Returns:
         requests.Response: _description_
     """
-    return _do_req(requests.post, *args, retry=retry, **kwargs)
+    return _do_req(get_session().post, *args, retry=retry, **kwargs)
 
 
-def get(*args, retry: int = 2, **kwargs) -> requests.Response:
-    """基于requests.get实现
+def get(*args, retry: int = 2, coalesce: bool = HTTP_COALESCE_GET, cache_ttl: float = 0,
+        **kwargs) -> requests.Response:
+    """基于requests.Session.get实现
     Args:
         retry (int, optional): 超时导致的失败重试的次数. Defaults to 2.
+        coalesce (bool, optional): 是否合并相同的并发请求，合并时多个调用方会共享同一个响应对象.
+        cache_ttl (float, optional): 响应缓存的秒数，大于0时启用缓存，过期后会使用ETag等进行重新验证. Defaults to 0.
+            带有Cookie, Authorization等身份凭证头信息的请求不会缓存，缓存统计见接口/status/http-cache.
     Returns:
         requests.Response: _description_
     """
-    return _do_req(requests.get, *args, retry=retry, **kwargs)
+    key = _coalesce_key('GET', args, kwargs) if coalesce or cache_ttl > 0 else None
+    if key is None:
+        return _do_req(get_session().get, *args, retry=retry, **kwargs)
+    fn = partial(_cached_do_req, key, cache_ttl) if cache_ttl > 0 and _cacheable(kwargs) else _do_req
+    if coalesce:
+        return _get_group.do(key, fn, get_session().get, *args, retry=retry, **kwargs)
+    return fn(get_session().get, *args, retry=retry, **kwargs)
 
 
-def _do_req(method, *args, retry: int = 2, **kwargs):
+async def async_post(*args, retry: int = 2, **kwargs) -> httpx.Response:
+    """基于httpx.AsyncClient.post实现，在async def的接口中应该使用该函数
+    参数和post基本一致，注意httpx不支持单次请求设置verify等客户端级别的参数
+    Args:
+        retry (int, optional): 超时导致的失败重试的次数. Defaults to 2.
+    Returns:
+        httpx.Response: _description_
+    """
+    return await _async_do_req(get_async_client().post, *args, retry=retry, **kwargs)
+
+
+async def async_get(*args, retry: int = 2, coalesce: bool = HTTP_COALESCE_GET, cache_ttl: float = 0,
+                    **kwargs) -> httpx.Response:
+    """基于httpx.AsyncClient.get实现，在async def的接口中应该使用该函数
+    Args:
+        retry (int, optional): 超时导致的失败重试的次数. Defaults to 2.
+        coalesce (bool, optional): 是否合并相同的并发请求，合并时多个调用方会共享同一个响应对象.
+        cache_ttl (float, optional): 响应缓存的秒数，大于0时启用缓存，过期后会使用ETag等进行重新验证. Defaults to 0.
+            带有Cookie, Authorization等身份凭证头信息的请求不会缓存，缓存统计见接口/status/http-cache.
+    Returns:
+        httpx.Response: _description_
+    """
+    key = _coalesce_key('GET', args, kwargs) if coalesce or cache_ttl > 0 else None
+    if key is None:
+        return await _async_do_req(get_async_client().get, *args, retry=retry, **kwargs)
+    if cache_ttl > 0 and _cacheable(kwargs):
+        fn = partial(_async_cached_do_req, key, cache_ttl)
+    else:
+        fn = _async_do_req
+    if coalesce:
+        return await _async_get_group.do(key, fn, get_async_client().get, *args, retry=retry, **kwargs)
+    return await fn(get_async_client().get, *args, retry=retry, **kwargs)
+
+
+def get_session() -> requests.Session:
+    """获取共享的同步请求会话（线程安全的懒加载）"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                session.cookies.set_policy(_NO_COOKIES)
+                # 重试由_do_req统一处理，这里不再重试
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS,
+                                      pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """获取共享的异步请求客户端"""
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS,
+                              max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                              keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+        timeout = httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        # requests默认会跟随重定向，这里保持一致
+        _async_client = httpx.AsyncClient(limits=limits, timeout=timeout, follow_redirects=True)
+        _async_client.cookies.jar.set_policy(_NO_COOKIES)
+    return _async_client
+
+
+async def close():
+    """关闭共享的客户端，释放连接，通常在应用shutdown时调用"""
+    global _session, _async_client
+    if _session is not None:
+        _session.close()
+        _session = None
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+    _host_semaphores.clear()
+
+
+def _prepare(kwargs: dict):
+    """请求参数的预处理：注入追踪ID"""
     # 设置用于全链路追踪的ID
     if "headers" in kwargs:    # 存在头信息
         if REQUEST_ID_KEY not in kwargs["headers"]:
@@ -42,33 +173,231 @@ def _do_req(method, *args, retry: int = 2, **kwargs):
             REQUEST_ID_KEY: TraceID.get_trace_id(),
         }
 
+
+def _coalesce_key(method: str, args: tuple, kwargs: dict) -> Optional[Hashable]:
+    """生成请求合并的key：请求方法、url、params、timeout及全部的头信息（追踪ID除外）
+    超时不同的请求不合并，避免超时较短的调用方等待超时较长的请求
+    存在其他可能影响响应结果的参数时返回None，表示不合并
+    """
+    if len(args) > 1 or not _COALESCE_KWARGS.issuperset(kwargs):
+        return None
+    url = args[0] if args else kwargs.get('url')
+    params = kwargs.get('params')
+    if isinstance(params, dict):
+        params = tuple(sorted((str(k), str(v)) for k, v in params.items()))
+    elif params is not None:
+        params = repr(params)
+    request_id_key = REQUEST_ID_KEY.lower()
+    headers = tuple(sorted((str(k).lower(), str(v)) for k, v in (kwargs.get('headers') or {}).items()
+                           if str(k).lower() != request_id_key))
+    return (method, str(url), params, repr(kwargs.get('timeout')), headers)
+
+
+def _cacheable(kwargs: dict) -> bool:
+    """带有身份凭证（如Cookie, Authorization）的请求，响应可能是用户私有的，不进行缓存"""
+    return not any(str(k).lower() in _NO_CACHE_HEADERS for k in (kwargs.get('headers') or {}))
+
+
+def _host(args: tuple, kwargs: dict) -> str:
+    """从请求参数中解释出上游服务的host"""
+    url = args[0] if args else kwargs['url']
+    return urlsplit(str(url)).netloc
+
+
+def _host_semaphore(host: str) -> asyncio.Semaphore:
+    """每个host的并发数限制，和同步请求的pool_maxsize保持一致"""
+    if host not in _host_semaphores:
+        _host_semaphores[host] = asyncio.Semaphore(HTTP_POOL_MAXSIZE)
+    return _host_semaphores[host]
+
+
+def _get_breaker(host: str) -> Optional[CircuitBreaker]:
+    """获取上游host对应的熔断器，没有开启熔断则返回None"""
+    if not HTTP_BREAKER_ENABLED:
+        return None
+    return get_breaker(host, failure_threshold=HTTP_BREAKER_FAILURE_THRESHOLD,
+                       recovery_timeout=HTTP_BREAKER_RECOVERY_TIMEOUT,
+                       half_open_calls=HTTP_BREAKER_HALF_OPEN_CALLS)
+
+
+def _check_breaker(breaker: Optional[CircuitBreaker], name: str, args: tuple) -> int:
+    """熔断状态下直接失败，不再请求上游服务；返回熔断器的放行凭证"""
+    if breaker is None:
+        return 0
+    token = breaker.acquire()
+    if token is None:
+        observe_upstream(breaker.name, 'breaker_open', 0)
+        logger.warning(f"{name}上游服务熔断中 : {args}")
+        raise InternalException(status.HTTP_504_GATEWAY_TIMEOUT, message=f"{name}上游服务熔断中: {args}")
+    return token
+
+
+def _record(breaker: Optional[CircuitBreaker], token: int, success: Optional[bool]):
+    """记录请求结果到熔断器，success为None表示请求没有结果（如被取消），只释放该请求占用的试探名额"""
+    if breaker is None:
+        return
+    if success is None:
+        breaker.release(token)
+    elif success:
+        breaker.record_success()
+    else:
+        breaker.record_failure()
+
+
+def _backoff(attempt: int) -> float:
+    """重试的退避时间（指数退避 + full jitter）"""
+    return random.uniform(0, min(HTTP_RETRY_BACKOFF_MAX, HTTP_RETRY_BACKOFF * 2 ** attempt))
+
+
+def _do_req(method, *args, retry: int = 2, **kwargs):
+    _prepare(kwargs)
+    kwargs.setdefault('timeout', (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    host = _host(args, kwargs)
+    breaker = _get_breaker(host)
+    attempt = 0
     while retry >= 0:
         retry -= 1
+        token = _check_breaker(breaker, method.__name__, args)
+        start = time.perf_counter()
+        success = None    # 放行之后无论如何（包括被取消）都要记录结果，否则半开状态的试探名额不会释放
         try:
-            resp: requests.Response = method(*args, **kwargs)
+            with phase('http'):
+                resp: requests.Response = method(*args, **kwargs)
+            success = resp.status_code < 500
+            observe_upstream(host, str(resp.status_code), time.perf_counter() - start)
             break
         except requests.exceptions.Timeout as e:    # 超时异常需要进行重试
-            if retry < 0:
-                logger.error(f"{method.__name__}超时异常 : {args} : retry = {retry} : {e}")
-                raise InternalException(status.HTTP_504_GATEWAY_TIMEOUT, message=f"{method.__name__}上游服务请求超时: {args}", detail=e)
-            logger.warning(f"{method.__name__}超时异常 : {args} : retry = {retry} : {e}")
-            continue
+            success = False
+            observe_upstream(host, 'timeout', time.perf_counter() - start)
+            _on_timeout(method.__name__, args, retry, e)
         except Exception as e:
-            msg = str(e)
-            logger.error(f"{method.__name__}请求异常 : {args} : retry = {retry} : {msg}\n{format_exc()}")
-            oom_err = _check_oom(msg, method.__name__, *args)
-            if oom_err:   # 超内存或显存异常
-                raise oom_err
-            # 其他的异常
-            raise InternalException(status.HTTP_500_INTERNAL_SERVER_ERROR, message=f"{method.__name__}上游服务请求异常: {args}", detail=msg)
-
-    if resp.status_code != 200:
-        oom_err = _check_oom(resp.text, method.__name__, *args)
+            success = False
+            observe_upstream(host, 'error', time.perf_counter() - start)
+            _on_error(method.__name__, args, retry, e)
+        finally:
+            _record(breaker, token, success)
+        time.sleep(_backoff(attempt))
+        attempt += 1
+
+    _check_resp(resp.status_code, resp.text, method.__name__, *args)
+    return resp
+
+
+async def _async_do_req(method, *args, retry: int = 2, **kwargs):
+    _prepare(kwargs)
+    host = _host(args, kwargs)
+    semaphore = _host_semaphore(host)
+    breaker = _get_breaker(host)
+    attempt = 0
+    while retry >= 0:
+        retry -= 1
+        token = _check_breaker(breaker, method.__name__, args)
+        start = time.perf_counter()
+        success = None    # 被取消（CancelledError）时只释放试探名额
+        try:
+            async with semaphore:
+                with phase('http'):
+                    resp: httpx.Response = await method(*args, **kwargs)
+            success = resp.status_code < 500
+            observe_upstream(host, str(resp.status_code), time.perf_counter() - start)
+            break
+        except httpx.TimeoutException as e:    # 超时异常需要进行重试
+            success = False
+            observe_upstream(host, 'timeout', time.perf_counter() - start)
+            _on_timeout(method.__name__, args, retry, e)
+        except Exception as e:
+            success = False
+            observe_upstream(host, 'error', time.perf_counter() - start)
+            _on_error(method.__name__, args, retry, e)
+        finally:
+            _record(breaker, token, success)
+        await asyncio.sleep(_backoff(attempt))
+        attempt += 1
+
+    _check_resp(resp.status_code, resp.text, method.__name__, *args)
+    return resp
+
+
+def _cache_lookup(key: Hashable, kwargs: dict):
+    """查询缓存，缓存过期时在请求头中加上条件请求的信息
+    Returns:
+        (缓存项, 是否可以直接使用)
+    """
+    entry = response_cache.get(key)
+    if entry is None:
+        return None, False
+    if entry.fresh:
+        return entry, True
+    validators = entry.validators()
+    if validators:     # 复制一份，避免修改调用方的头信息
+        kwargs['headers'] = {**(kwargs.get('headers') or {}), **validators}
+    return entry, False
+
+
+def _cache_store(key: Hashable, ttl: float, entry, resp):
+    """根据上游的响应更新缓存，返回最终的响应"""
+    if resp.status_code == 304 and entry is not None:
+        response_cache.refresh(entry, ttl)
+        return _copy_response(entry.response)
+    if resp.status_code == 200:
+        response_cache.set(key, resp, ttl)
+        return _copy_response(resp)
+    return resp
+
+
+def _copy_response(resp):
+    """缓存的响应对象被多个调用方共享，返回浅复制（响应体是不可变的bytes，头信息单独复制），
+    调用方修改头信息等属性不会影响缓存及其他调用方
+    """
+    resp = copy.copy(resp)
+    resp.headers = resp.headers.copy()
+    return resp
+
+
+def _cached_do_req(key: Hashable, ttl: float, method, *args, **kwargs):
+    entry, fresh = _cache_lookup(key, kwargs)
+    if fresh:
+        return _copy_response(entry.response)
+    resp = _do_req(method, *args, **kwargs)
+    return _cache_store(key, ttl, entry, resp)
+
+
+async def _async_cached_do_req(key: Hashable, ttl: float, method, *args, **kwargs):
+    entry, fresh = _cache_lookup(key, kwargs)
+    if fresh:
+        return _copy_response(entry.response)
+    resp = await _async_do_req(method, *args, **kwargs)
+    return _cache_store(key, ttl, entry, resp)
+
+
+def _on_timeout(name: str, args: tuple, retry: int, e: Exception):
+    """超时异常：重试次数用完则抛出异常"""
+    if retry < 0:
+        logger.error(f"{name}超时异常 : {args} : retry = {retry} : {e}")
+        raise InternalException(status.HTTP_504_GATEWAY_TIMEOUT, message=f"{name}上游服务请求超时: {args}", detail=e)
+    logger.warning(f"{name}超时异常 : {args} : retry = {retry} : {e}")
+
+
+def _on_error(name: str, args: tuple, retry: int, e: Exception):
+    """非超时异常：直接抛出"""
+    msg = str(e)
+    logger.error(f"{name}请求异常 : {args} : retry = {retry} : {msg}\n{format_exc()}")
+    oom_err = _check_oom(msg, name, *args)
+    if oom_err:   # 超内存或显存异常
+        raise oom_err
+    # 其他的异常
+    raise InternalException(status.HTTP_500_INTERNAL_SERVER_ERROR, message=f"{name}上游服务请求异常: {args}",
+                            detail=msg)
+
+
+def _check_resp(status_code: int, text: str, *args):
+    """检查响应值"""
+    if status_code != 200:
+        oom_err = _check_oom(text, *args)
         if oom_err:   # 超内存或显存异常
-            logger.error(f"{oom_err}: {resp.text}")
+            logger.error(f"{oom_err}: {text}")
             raise oom_err
         # 其他的异常
-    return resp
 
 
 def _check_oom(msg: str, *args):
@@ -87,7 +416,8 @@ def _check_oom(msg: str, *args):
     PleasecheckwhetherthereisanyotherprocessusingGPU0.
     1.Ifyes,pleasestopthem,orstartPaddlePaddleonanotherGPU.
     2.Ifno,pleasedecreasethebatchsizeofyourmodel.
-    Iftheabovewaysdonotsolvetheoutofmemoryproblem,youcantrytouseCUDAmanagedmemory.Thecommandis`exportFLAGS_use_cuda_managed_memory=false`. ...
+    Iftheabovewaysdonotsolvetheoutofmemoryproblem,youcantrytouseCUDAmanagedmemory.
+    Thecommandis`exportFLAGS_use_cuda_managed_memory=false`. ...
     Args:
         msg (str): 通常是异常信息字符串
         *args: 需要记录到异常信息的参数
@@ -99,3 +429,34 @@ def _check_oom(msg: str, *args):
             err_msg = f"上游服务请求时，超出内存导致错误: {args}"
         raise InternalException(status.HTTP_504_GATEWAY_TIMEOUT, message=err_msg)
     return None
+
+
+if __name__ == '__main__':
+    # 在项目目录下执行：python -m common.http
+    from common.mock_upstream import MockUpstream
+
+    upstream = MockUpstream().start_in_thread()
+    try:
+        # 上游响应的Set-Cookie不会被保存，也不会出现在之后的请求中
+        url = f'{upstream.url}/login?set_cookie=sid%3Dsecret'
+        assert 'sid=secret' in get(url).headers['set-cookie']
+        assert get(f'{upstream.url}/profile').json()['cookie'] == ''
+        assert get(f'{upstream.url}/profile', cookies={'a': '1'}).json()['cookie'] == 'a=1'
+        # 缓存命中时返回复制的响应对象
+        first = get(f'{upstream.url}/cached', cache_ttl=10)
+        first.headers['x-changed'] = '1'
+        second = get(f'{upstream.url}/cached', cache_ttl=10)
+        assert second is not first and 'x-changed' not in second.headers and second.json() == first.json()
+        assert response_cache.stats()['hits'] == 1, response_cache.stats()
+
+        async def main():
+            await async_get(url)
+            resp = await async_get(f'{upstream.url}/profile')
+            assert resp.json()['cookie'] == '', resp.json()
+            await close()
+
+        asyncio.run(main())
+        assert not get_session().cookies
+    finally:
+        upstream.stop_thread()
+    print('ok')
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+#
+# 上游GET请求的响应缓存（进程内，LRU + TTL）
+# 缓存过期之后，如果响应带有ETag或者Last-Modified，则使用条件请求进行重新验证，
+# 上游返回304时直接复用缓存的响应
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class CacheEntry:
+    """缓存项"""
+    __slots__ = ('response', 'expires_at', 'etag', 'last_modified')
+
+    def __init__(self, response: Any, ttl: float) -> None:
+        self.response = response
+        self.expires_at = time.monotonic() + ttl
+        self.etag = response.headers.get('etag')
+        self.last_modified = response.headers.get('last-modified')
+
+    @property
+    def fresh(self) -> bool:
+        return time.monotonic() < self.expires_at
+
+    def validators(self) -> Dict[str, str]:
+        """条件请求的头信息"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """线程安全的LRU响应缓存"""
+    def __init__(self, maxsize: int = 1024) -> None:
+        self.maxsize = maxsize
+        self._data: 'OrderedDict[Hashable, CacheEntry]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0            # 命中新鲜缓存
+        self.misses = 0          # 没有缓存或者缓存已过期
+        self.revalidations = 0   # 过期后经上游确认（304）仍然有效
+        self.evictions = 0       # 因容量限制被淘汰
+
+    def get(self, key: Hashable) -> Optional[CacheEntry]:
+        """获取缓存项（可能已经过期，过期的缓存项可以用于条件请求）"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+                if entry.fresh:
+                    self.hits += 1
+                    return entry
+            self.misses += 1
+            return entry
+
+    def set(self, key: Hashable, response: Any, ttl: float):
+        """写入缓存"""
+        with self._lock:
+            self._data[key] = CacheEntry(response, ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def refresh(self, entry: CacheEntry, ttl: float):
+        """上游返回304，延长缓存有效期"""
+        with self._lock:
+            entry.expires_at = time.monotonic() + ttl
+            self.revalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """缓存统计信息"""
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+            'evictions': self.evictions,
+        }
+
+
+if __name__ == '__main__':
+    class _Resp:
+        def __init__(self, etag=None):
+            self.headers = {'etag': etag} if etag else {}
+
+    cache = ResponseCache(maxsize=2)
+    assert cache.get('a') is None
+    cache.set('a', _Resp('"v1"'), ttl=10)
+    assert cache.get('a').fresh
+    cache.set('b', _Resp(), ttl=0)
+    entry = cache.get('b')
+    assert entry is not None and not entry.fresh and entry.validators() == {}
+    cache.set('c', _Resp(), ttl=10)     # a被淘汰
+    assert cache.get('a') is None
+    assert cache.stats()['evictions'] == 1
+    print(cache.stats())
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+#
+# 延迟导入
+# 较重的依赖（如PIL、深度学习框架等）可以延迟到第一次使用时才真正导入，减少应用的启动时间：
+#     from common.lazy import lazy_import
+#     image = lazy_import('captcha.image')     # 这里不会执行captcha.image模块的代码
+#     image.ImageCaptcha()                     # 第一次访问属性时才导入
+# 注意：父包（如captcha）会被立即导入，所以父包本身应该比较轻量
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import sys
+import importlib.util
+from types import ModuleType
+
+
+def lazy_import(name: str) -> ModuleType:
+    """延迟导入模块，模块已经导入过时直接返回
+    Args:
+        name str: 模块的完整名称，如captcha.image
+    Returns:
+        ModuleType: 模块对象，第一次访问其属性时才执行模块代码
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f'找不到模块: {name}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+if __name__ == '__main__':
+    # 在项目目录下执行：python -m common.lazy
+    json_tool = lazy_import('json.tool')
+    assert 'json.tool' in sys.modules
+    assert callable(json_tool.main)
+    print('ok')
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# JSON Lines日志输出
+# 写日志的线程只把记录放入缓冲区，由后台线程批量序列化并写入文件，
+# 写入频率由批量大小和刷新间隔共同决定，缓冲区有上限，写入跟不上时丢弃新的日志并计数
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import json
+import threading
+import traceback
+from pathlib import Path
+from datetime import datetime
+from typing import Optional
+from collections import deque
+
+
+class JsonLinesSink:
+    """批量写入的JSON Lines日志sink（用于loguru.add）
+    每天一个日志文件：{prefix}-YYYYMMDD.jsonl
+    后台线程在调用start或者第一次写入时才启动，创建实例没有副作用
+    """
+    def __init__(self, root_path: Path, prefix: str = 'app', batch_size: int = 200,
+                 flush_interval: float = 1, max_buffer: int = 100000) -> None:
+        self.root_path = Path(root_path)
+        self.prefix = prefix
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buffer: deque = deque()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._lock = threading.Lock()
+        self.written = 0         # 已写入的记录数
+        self.batches = 0         # 写入批次
+        self.overflow = 0        # 缓冲区已满而丢弃的记录数
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """启动后台写入线程（重复调用无影响）"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(target=self._run, name='log-sink', daemon=True)
+                self._thread.start()
+
+    def write(self, message):
+        """loguru调用该方法写入日志，这里只保存需要的字段，序列化在后台线程完成"""
+        if self._thread is None:
+            self.start()
+        if len(self._buffer) >= self.max_buffer:
+            self.overflow += 1
+            self._wakeup.set()
+            return
+        record = message.record
+        self._buffer.append({
+            'time': record['time'],
+            'level': record['level'].name,
+            'req_id': record['extra'].get('req_id', ''),
+            'trace': record['extra'].get('trace', ''),
+            'name': record['name'],
+            'function': record['function'],
+            'line': record['line'],
+            'message': record['message'],
+            'exception': record['exception'],
+        })
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def stop(self):
+        """loguru移除sink时调用，写入剩余的日志
+        注意：这里不能定义flush方法，否则loguru在每次write之后都会调用flush
+        """
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self._flush()
+
+    def _flush(self):
+        """批量写入缓冲区中的日志"""
+        with self._lock:
+            if not self._buffer:
+                return
+            lines = []
+            while self._buffer:
+                item = self._buffer.popleft()
+                item['time'] = item['time'].isoformat(timespec='milliseconds')
+                if item['exception'] is not None:
+                    item['exception'] = ''.join(traceback.format_exception(*item['exception']))
+                lines.append(json.dumps(item, ensure_ascii=False, default=str))
+            filename = self.root_path.joinpath(f"{self.prefix}-{datetime.now():%Y%m%d}.jsonl")
+            with open(filename, 'a', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            self.written += len(lines)
+            self.batches += 1
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._flush()
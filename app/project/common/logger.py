@@ -4,12 +4,16 @@
 # Author: __author__
 # Email: __email__
 # Created Time: __created_time__
+import random
 from uuid import uuid4
+from typing import Dict
 from pathlib import Path
 from loguru import logger
 from contextvars import ContextVar
 
-from settings import LOG_ROOT_PATH
+from settings import LOG_ROOT_PATH, LOG_JSON, LOG_SAMPLE_RATES
+from settings import LOG_JSON_BATCH_SIZE, LOG_JSON_FLUSH_INTERVAL, LOG_JSON_MAX_BUFFER
+from common.log_sink import JsonLinesSink
 
 # 业务使用的ID，如任务ID/批量任务ID/大文件id等
 # celery任务也可以通过业务ID进行关联
@@ -90,9 +94,36 @@ class TraceID:
         return _x_request_id.get(),
 
 
-def _logger_filter(record):
-    record['trace_msg'] = f"{_x_request_id.get()} | {_trace_id.get()}"
-    return record['trace_msg']
+def _logger_patcher(record):
+    """每条日志只计算一次追踪信息，所有sink共用"""
+    req_id, trace = _x_request_id.get(), _trace_id.get()
+    record['extra']['req_id'] = req_id
+    record['extra']['trace'] = trace
+    record['trace_msg'] = f"{req_id} | {trace}"
+
+
+# 采样丢弃的日志数量，key为日志级别
+_dropped: Dict[str, int] = {}
+
+
+def _sample_filter(record) -> bool:
+    """按日志级别采样，采样率见配置LOG_SAMPLE_RATES"""
+    level = record['level'].name
+    rate = LOG_SAMPLE_RATES.get(level)
+    if rate is None or rate >= 1 or random.random() < rate:
+        return True
+    _dropped[level] = _dropped.get(level, 0) + 1
+    return False
+
+
+def get_log_stats() -> dict:
+    """日志统计信息：采样丢弃的数量，JSON日志的写入数量及缓冲区满而丢弃的数量（见接口/status/logs）"""
+    data: dict = {'dropped': dict(_dropped)}
+    if _json_sink is not None:
+        data['written'] = _json_sink.written
+        data['batches'] = _json_sink.batches
+        data['overflow'] = _json_sink.overflow
+    return data
 
 
 log_path_root = Path(LOG_ROOT_PATH)
@@ -101,24 +132,36 @@ if not log_path_root.is_dir():
 
 # 每次重启会生成新的日志
 log_path_info = log_path_root.joinpath('info-{time:YYYYMMDD}.log')
-log_path_warning = log_path_root.joinpath(f'warning.log')
-log_path_error = log_path_root.joinpath(f'error.log')
+log_path_warning = log_path_root.joinpath('warning.log')
+log_path_error = log_path_root.joinpath('error.log')
 """
 https://cloud.tencent.com/developer/article/1849382
 backtrace (bool, optional) : 格式化的异常跟踪是否应该向上扩展，超出捕获点，以显示生成错误的完整堆栈跟踪。
 diagnose  (bool, optional) : 异常跟踪是否应该显示变量值以简化调试。在生产中，这应该设置为“False”，以避免泄漏敏感数据。
 """
+_filter = _sample_filter if LOG_SAMPLE_RATES else None
+log_format = ("{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {trace_msg} | "
+              "{name}:{function}:{line} - {message}")
 params = {
     "rotation": "50 MB", "encoding": 'utf-8', "enqueue": True, "backtrace": True,  # "compression": "gzip",
-    "filter": _logger_filter,
-    "format": "{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {trace_msg} | {name}:{function}:{line} - {message}",
+    "diagnose": False, "filter": _filter,
+    "format": log_format,
 }
 params_info = {
     "rotation": "daily", "encoding": 'utf-8', "enqueue": True, "backtrace": True,  # "compression": "gzip",
-    "filter": _logger_filter,
-    "format": "{time:YYYY-MM-DD HH:mm:ss.SSS} | {level: <8} | {trace_msg} | {name}:{function}:{line} - {message}",
+    "diagnose": False, "filter": _filter,
+    "format": log_format,
 }
 logger.remove()
-logger.add(log_path_info, level='INFO', retention='90 days', **params_info)
-logger.add(log_path_warning, level='WARNING', **params)
-logger.add(log_path_error, level='ERROR', **params)
+logger.configure(patcher=_logger_patcher)
+_json_sink = None
+if LOG_JSON:
+    # 高吞吐模式：所有级别的日志写入同一个JSON Lines文件，由后台线程批量写入，不再需要enqueue
+    _json_sink = JsonLinesSink(log_path_root, batch_size=LOG_JSON_BATCH_SIZE,
+                               flush_interval=LOG_JSON_FLUSH_INTERVAL, max_buffer=LOG_JSON_MAX_BUFFER)
+    logger.add(_json_sink, level='INFO', format="{message}", filter=_filter, catch=True)
+    _json_sink.start()
+else:
+    logger.add(log_path_info, level='INFO', retention='90 days', **params_info)
+    logger.add(log_path_warning, level='WARNING', **params)
+    logger.add(log_path_error, level='ERROR', **params)
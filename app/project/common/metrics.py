@@ -0,0 +1,484 @@
+# -*- coding: utf-8 -*-
+#
+# Prometheus格式的监控指标
+# 1. 接口：请求数、错误数（按exceptions.status中的自定义状态码区分）、耗时直方图、处理中的请求数
+# 2. 上游服务：请求数（按结果区分）、耗时直方图
+# 3. 准入控制：处理中及排队中的请求数、拒绝的请求数
+#
+# 多进程：每个worker进程把指标写入METRICS_DIR目录下自己的mmap文件（metrics-{pid}.db），
+# 序列的定义写入同名的json文件，/metrics接口读取目录下所有的文件进行汇总，所以访问任意一个worker都能得到完整的数据。
+# 指标文件的容量在启动时一次性分配，更新指标时只修改共享内存中的一个float64，不加锁：
+# 所有的更新都在事件循环线程中执行（其他线程的更新会通过call_soon_threadsafe转到事件循环线程），每个文件只有一个写入者。
+# 进程退出时（正常退出时由进程自己，异常退出时由fas serve的主进程），计数器和直方图合并到归档文件（metrics_archive.json），
+# 并删除该进程的指标文件，避免频繁替换进程时文件不断增加；fas serve启动时会清空METRICS_DIR目录
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import os
+import json
+import mmap
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+from bisect import bisect_left
+from pathlib import Path
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from settings import SYSTEM_CODE_BASE, METRICS_DIR, METRICS_CAPACITY, METRICS_BUCKETS
+
+try:
+    import fcntl
+except ImportError:     # 非Unix系统
+    fcntl = None
+
+# 序列的key：(指标名, 标签)
+SeriesKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+# 已经退出的进程的计数器和直方图的归档文件
+ARCHIVE_FILE = 'metrics_archive.json'
+
+_HELP = {
+    'http_requests_total': ('counter', '接口请求数'),
+    'http_request_errors_total': ('counter', '接口异常数'),
+    'http_request_duration_seconds': ('histogram', '接口耗时（秒）'),
+    'http_requests_in_progress': ('gauge', '正在处理中的请求数'),
+    'upstream_requests_total': ('counter', '上游服务请求数'),
+    'upstream_request_duration_seconds': ('histogram', '上游服务请求耗时（秒）'),
+    'admission_in_flight': ('gauge', '准入控制：正在处理的请求数'),
+    'admission_queue_depth': ('gauge', '准入控制：排队中的请求数'),
+    'admission_shed_total': ('counter', '准入控制：拒绝的请求数（按原因区分）'),
+    'metrics_dropped_total': ('counter', '超出指标容量而丢弃的更新次数'),
+}
+
+
+class MetricsFile:
+    """单个进程的指标文件
+    每个序列在文件中占用固定的位置：计数器和仪表盘占1个，直方图占len(buckets)+2个（各个桶、+Inf、总和）
+    """
+    def __init__(self, root_path: Path, capacity: int, buckets: List[float]) -> None:
+        self.buckets = list(buckets)
+        self.capacity = capacity
+        self.pid = os.getpid()
+        root_path.mkdir(parents=True, exist_ok=True)
+        self.path = root_path.joinpath(f'metrics-{self.pid}.db')
+        self.meta_path = root_path.joinpath(f'metrics-{self.pid}.json')
+        with open(self.path, 'wb') as f:
+            f.truncate(capacity * 8)
+        with open(self.path, 'r+b') as f:
+            self._mmap = mmap.mmap(f.fileno(), capacity * 8)
+        self.values = memoryview(self._mmap).cast('d')
+        self._index: Dict[SeriesKey, int] = {}
+        self._size = 1          # 第0个位置用于记录丢弃的更新次数
+        self._write_meta()
+
+    def slot(self, name: str, labels: tuple) -> int:
+        """获取序列的位置，第一次使用时分配；容量不足时返回0（丢弃）"""
+        key = (name, labels)
+        offset = self._index.get(key)
+        if offset is None:
+            size = len(self.buckets) + 2 if _HELP[name][0] == 'histogram' else 1
+            if self._size + size > self.capacity:
+                return 0
+            offset = self._index[key] = self._size
+            self._size += size
+            self._write_meta()
+        return offset
+
+    def inc(self, name: str, labels: tuple, value: float = 1):
+        offset = self.slot(name, labels)
+        self.values[offset] += value if offset else 1
+
+    def observe(self, name: str, labels: tuple, seconds: float):
+        offset = self.slot(name, labels)
+        if offset == 0:
+            self.values[0] += 1
+            return
+        self.values[offset + bisect_left(self.buckets, seconds)] += 1
+        self.values[offset + len(self.buckets) + 1] += seconds
+
+    def close(self):
+        self.values.release()
+        self._mmap.close()
+
+    def _write_meta(self):
+        """写入序列的定义（只在新增序列时执行）"""
+        series = [[name, list(labels), offset] for (name, labels), offset in self._index.items()]
+        tmp_path = self.meta_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'pid': self.pid, 'buckets': self.buckets, 'series': series}, f)
+        os.replace(tmp_path, self.meta_path)
+
+
+class _RequestState:
+    """一次请求的指标状态"""
+    __slots__ = ('code', 'in_progress', 'finished')
+
+    def __init__(self) -> None:
+        self.code: Optional[int] = None       # 自定义的异常状态码（响应给前端的完整code值）
+        self.in_progress: Optional[tuple] = None
+        self.finished = False
+
+
+_file: Optional[MetricsFile] = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[int] = None
+_state: ContextVar[Optional[_RequestState]] = ContextVar('x_metrics', default=None)
+
+
+def set_error_code(code: int):
+    """记录当前请求响应的自定义状态码（在ErrorResponse中调用）"""
+    state = _state.get()
+    if state is not None:
+        state.code = code
+
+
+def observe_upstream(host: str, outcome: str, seconds: float):
+    """记录上游服务请求
+    Args:
+        host str: 上游服务的host
+        outcome str: 请求结果，如：200, 500, timeout, error, breaker_open
+        seconds float: 请求耗时
+    """
+    if _file is None:
+        return
+    if _loop is not None and threading.get_ident() != _loop_thread:
+        # 同步请求通常在线程池中执行，转到事件循环线程中更新，保证每个文件只有一个写入者
+        _loop.call_soon_threadsafe(observe_upstream, host, outcome, seconds)
+        return
+    _file.inc('upstream_requests_total', (('host', host), ('outcome', outcome)))
+    if outcome != 'breaker_open':
+        _file.observe('upstream_request_duration_seconds', (('host', host),), seconds)
+
+
+def observe_admission(limiter: str, in_flight: float = 0, queued: float = 0, shed: str = ''):
+    """记录准入控制的变化（在事件循环线程中调用）
+    Args:
+        limiter str: 限流器的名称
+        in_flight float: 处理中请求数的变化
+        queued float: 排队中请求数的变化
+        shed str: 拒绝的原因：queue_full, queue_timeout
+    """
+    if _file is None:
+        return
+    labels = (('limiter', limiter),)
+    if in_flight:
+        _file.inc('admission_in_flight', labels, in_flight)
+    if queued:
+        _file.inc('admission_queue_depth', labels, queued)
+    if shed:
+        _file.inc('admission_shed_total', labels + (('reason', shed),))
+
+
+async def track_in_progress(request: Request):
+    """全局依赖项：路由匹配之后记录处理中的请求数"""
+    state = _state.get()
+    if _file is None or state is None or state.in_progress is not None:
+        return
+    state.in_progress = _route_labels(request.scope)
+    _file.inc('http_requests_in_progress', state.in_progress)
+
+
+class MetricsMiddleware:
+    """接口指标中间件"""
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or _file is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        state = _RequestState()
+        token = _state.set(state)
+        status_code = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                self._finish(scope, state, status_code, start)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception:
+            # 未捕获的异常由最外层的ServerErrorMiddleware处理，响应500
+            if state.code is None:
+                state.code = SYSTEM_CODE_BASE + 500
+            self._finish(scope, state, status_code, start)
+            raise
+        finally:
+            _state.reset(token)
+
+    @staticmethod
+    def _finish(scope: Scope, state: _RequestState, status_code: int, start: float):
+        """响应开始时记录指标，每个请求只记录一次"""
+        if state.finished:
+            return
+        state.finished = True
+        if state.in_progress is not None:
+            _file.inc('http_requests_in_progress', state.in_progress, -1)
+        labels = _route_labels(scope)
+        code = str(state.code) if state.code is not None else str(status_code)
+        _file.inc('http_requests_total', labels + (('code', code),))
+        if state.code is not None:
+            _file.inc('http_request_errors_total', labels + (('code', code),))
+        _file.observe('http_request_duration_seconds', labels, time.perf_counter() - start)
+
+
+def _route_labels(scope: Scope) -> tuple:
+    """使用路由的路径模板作为标签，避免路径参数导致序列数膨胀"""
+    return (('method', scope['method']), ('route', _route_path(scope)))
+
+
+def _route_path(scope: Scope) -> str:
+    """路由的路径模板，如/items/{item_id}"""
+    route = scope.get('route')
+    path = getattr(route, 'path_format', None)
+    if not path:
+        return 'unmatched'
+    # FastAPI 0.13x之后，include_router注册的路由的path_format不包含前缀，前缀（多层include时已经合并）
+    # 记录在匹配到的路由器上；较早的版本中path_format已经包含前缀，scope中也没有included_router
+    included = scope.get('fastapi', {}).get('included_router')
+    prefix = getattr(getattr(included, 'include_context', None), 'prefix', '')
+    return prefix + path
+
+
+def init_metrics(app: FastAPI):
+    """初始化监控指标：注册中间件及/metrics接口
+    处理中的请求数还需要将track_in_progress注册为全局依赖项
+    """
+    app.add_middleware(MetricsMiddleware)
+
+    @app.on_event("startup")
+    async def startup_metrics():
+        """在worker进程中创建指标文件"""
+        global _file, _loop, _loop_thread
+        _loop = asyncio.get_running_loop()
+        _loop_thread = threading.get_ident()
+        _file = MetricsFile(Path(METRICS_DIR), METRICS_CAPACITY, METRICS_BUCKETS)
+
+    @app.on_event("shutdown")
+    async def shutdown_metrics():
+        """计数合并到归档文件之后删除指标文件，已经退出的进程的计数仍然会被汇总"""
+        global _file
+        if _file is not None:
+            _file.close()
+            archive(Path(METRICS_DIR), _file.pid)
+            _file = None
+
+    @app.get("/metrics", include_in_schema=False)
+    async def metrics_api():
+        """Prometheus格式的监控指标（汇总所有worker进程）"""
+        # 读取及解释所有进程的文件（可能需要等待文件锁），在线程池中执行，不阻塞事件循环
+        text = await run_in_threadpool(collect, Path(METRICS_DIR))
+        return PlainTextResponse(text, media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def collect(root_path: Path) -> str:
+    """读取目录下所有进程的指标文件及归档文件，汇总为Prometheus文本格式
+    已经退出的进程：计数器和直方图继续参与汇总，仪表盘则忽略
+    """
+    with _lock(root_path, shared=True):
+        values, buckets = _read_archive(root_path)
+        buckets = buckets or list(METRICS_BUCKETS)
+        for meta_path in sorted(root_path.glob('metrics-*.json')):
+            pid = _meta_pid(meta_path)
+            alive = pid is not None and _pid_alive(pid)
+            buckets = _merge_file(values, meta_path, skip_gauges=not alive) or buckets
+
+    lines = []
+    for name, (kind, help_text) in _HELP.items():
+        series = [(labels, value) for (n, labels), value in values.items() if n == name]
+        if not series:
+            continue
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(series):
+            if kind != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {value[0]:g}')
+                continue
+            count = 0.0
+            for le, n in zip([*buckets, '+Inf'], value):
+                count += n
+                le = le if le == '+Inf' else f'{le:g}'
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", le),))} {count:g}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {value[-1]:g}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count:g}')
+    return '\n'.join(lines) + '\n'
+
+
+def archive(root_path: Path, pid: int):
+    """已经退出的进程：计数器和直方图合并到归档文件，然后删除该进程的指标文件"""
+    meta_path = root_path.joinpath(f'metrics-{pid}.json')
+    if not meta_path.exists():
+        return
+    with _lock(root_path):
+        values, buckets = _read_archive(root_path)
+        buckets = _merge_file(values, meta_path, skip_gauges=True) or buckets
+        if buckets is not None:
+            series = [[name, list(labels), value] for (name, labels), value in values.items()]
+            tmp_path = root_path.joinpath(ARCHIVE_FILE + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'buckets': buckets, 'series': series}, f)
+            os.replace(tmp_path, root_path.joinpath(ARCHIVE_FILE))
+        for path in (meta_path, meta_path.with_suffix('.db'), meta_path.with_suffix('.tmp')):
+            path.unlink(missing_ok=True)
+
+
+def archive_dead(root_path: Path):
+    """归档目录下所有已经退出的进程的指标文件（如进程被强制结束，没有执行shutdown）"""
+    for meta_path in root_path.glob('metrics-*.json'):
+        pid = _meta_pid(meta_path)
+        if pid is not None and not _pid_alive(pid):
+            archive(root_path, pid)
+
+
+def clear(root_path: Path):
+    """清空目录下的指标文件（在启动worker进程之前调用）"""
+    for pattern in ('metrics-*', ARCHIVE_FILE + '*'):
+        for path in root_path.glob(pattern):
+            path.unlink(missing_ok=True)
+
+
+@contextmanager
+def _lock(root_path: Path, shared: bool = False) -> Iterator[None]:
+    """读取时使用共享锁，归档时使用排他锁，避免汇总时同一个进程的计数被重复计算或者遗漏"""
+    if fcntl is None:
+        yield
+        return
+    root_path.mkdir(parents=True, exist_ok=True)
+    with open(root_path.joinpath('metrics.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_archive(root_path: Path) -> Tuple[Dict[SeriesKey, List[float]], Optional[List[float]]]:
+    """读取归档文件：(序列的值, 分桶)"""
+    try:
+        with open(root_path.joinpath(ARCHIVE_FILE), encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}, None
+    values = {(name, tuple(tuple(item) for item in labels)): value for name, labels, value in data['series']}
+    return values, data['buckets']
+
+
+def _merge_file(values: Dict[SeriesKey, List[float]], meta_path: Path,
+                skip_gauges: bool) -> Optional[List[float]]:
+    """把单个进程的指标文件累加到values中，返回分桶，文件不可读时返回None"""
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        with open(meta_path.with_suffix('.db'), 'rb') as f:
+            data = memoryview(f.read()).cast('d')
+    except (OSError, ValueError):     # 进程正在退出或者文件正在替换
+        return None
+    buckets = meta['buckets']
+    dropped = values.setdefault(('metrics_dropped_total', ()), [0.0])
+    dropped[0] += data[0]
+    for name, labels, offset in meta['series']:
+        kind = _HELP[name][0]
+        if kind == 'gauge' and skip_gauges:
+            continue
+        size = len(buckets) + 2 if kind == 'histogram' else 1
+        key = (name, tuple(tuple(item) for item in labels))
+        total = values.setdefault(key, [0.0] * size)
+        for i in range(size):
+            total[i] += data[offset + i]
+    return buckets
+
+
+def _meta_pid(meta_path: Path) -> Optional[int]:
+    """从文件名中解释出进程ID"""
+    try:
+        return int(meta_path.stem.split('-', 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    items = []
+    for k, v in labels:
+        v = str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+        items.append(f'{k}="{v}"')
+    return '{' + ','.join(items) + '}'
+
+
+def _pid_alive(pid: int) -> bool:
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+if __name__ == '__main__':
+    # 在项目目录下执行：python -m common.metrics
+    import tempfile
+    from fastapi import APIRouter
+    from fastapi.testclient import TestClient
+
+    # 路由的标签使用完整的路径模板（包括include_router的前缀，多层include时前缀合并）
+    inner, outer = APIRouter(), APIRouter()
+
+    @inner.get('/items/{item_id}')
+    async def item_api(item_id: int, request: Request):
+        return {'route': _route_path(request.scope)}
+
+    outer.include_router(inner, prefix='/shop')
+    route_app = FastAPI()
+    route_app.include_router(outer, prefix='/api/v1')
+    route_app.include_router(inner)
+    client = TestClient(route_app)
+    assert client.get('/api/v1/shop/items/3').json()['route'] == '/api/v1/shop/items/{item_id}'
+    assert client.get('/items/3').json()['route'] == '/items/{item_id}'
+
+    root = Path(tempfile.mkdtemp())
+    _file = MetricsFile(root, capacity=64, buckets=[0.1, 1])
+    _file.inc('http_requests_total', (('method', 'GET'), ('route', '/a'), ('code', '200')))
+    _file.observe('http_request_duration_seconds', (('method', 'GET'), ('route', '/a')), 0.05)
+    _file.observe('http_request_duration_seconds', (('method', 'GET'), ('route', '/a')), 5)
+    observe_upstream('example.com', '200', 0.2)
+    text = collect(root)
+    print(text)
+    assert 'http_requests_total{method="GET",route="/a",code="200"} 1' in text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/a",le="0.1"} 1' in text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/a",le="+Inf"} 2' in text
+    assert 'upstream_requests_total{host="example.com",outcome="200"} 1' in text
+    # 容量不足时丢弃
+    for i in range(100):
+        _file.inc('http_requests_total', (('method', 'GET'), ('route', f'/{i}'), ('code', '200')))
+    assert 'metrics_dropped_total' in collect(root)
+    # 进程退出：计数合并到归档文件，仪表盘忽略，指标文件删除
+    _file.inc('http_requests_in_progress', (('method', 'GET'), ('route', '/a')))
+    _file.close()
+    archive(root, _file.pid)
+    assert not list(root.glob('metrics-*')), list(root.iterdir())
+    text = collect(root)
+    assert 'http_requests_total{method="GET",route="/a",code="200"} 1' in text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/a",le="+Inf"} 2' in text
+    assert 'http_requests_in_progress' not in text
+    _file = MetricsFile(root, capacity=64, buckets=[0.1, 1])
+    _file.inc('http_requests_total', (('method', 'GET'), ('route', '/a'), ('code', '200')))
+    assert 'http_requests_total{method="GET",route="/a",code="200"} 2' in collect(root)
+    _file.close()
+    clear(root)
+    assert collect(root) == '\n', collect(root)
+    print('ok')
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+#
+# 模拟上游服务：用于在本地测试common/http.py在各种故障下的表现（重试、超时、OOM等），以及配合fas bench压测
+# 只依赖标准库，直接基于asyncio实现HTTP/1.1，以便模拟连接重置、响应体缓慢等异常
+# 每个请求的行为由查询参数指定，没有指定的参数使用启动时的默认值：
+#     latency: 响应延迟（秒），可以是固定值，或者分布：uniform:0.05:0.2, normal:0.1:0.02, exp:0.1, lognormal:0.1:0.5
+#     error_rate/error_status: 返回5xx的概率及状态码（默认500）
+#     oom_rate/oom: 返回Paddle显存（或内存）不足异常的概率及类型：gpu, gpu_traceback, cpu
+#     timeout_rate: 不响应（直到客户端超时断开）的概率
+#     reset_rate: 直接重置连接（RST）的概率
+#     slow_body: 响应体分块输出的总耗时（秒），用于测试读超时
+#     size: 响应体的大小（字节）
+#     set_cookie: 响应头Set-Cookie的值，响应体中的cookie字段为请求头Cookie的值，用于检查客户端是否保存了cookie
+# 示例：
+#     # 启动：默认延迟为均匀分布50~200ms，5%的请求返回503
+#     python -m common.mock_upstream --port 9000 --latency uniform:0.05:0.2 \
+#         --error_rate 0.05 --error_status 503
+#     curl "http://127.0.0.1:9000/predict?oom_rate=1&oom=gpu"
+#     curl "http://127.0.0.1:9000/__stats"     # 各种结果的计数
+#     # 使用common/http.py请求模拟服务，输出重试、超时及OOM的处理结果
+#     python -m common.mock_upstream --check
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import json
+import math
+import time
+import random
+import socket
+import struct
+import asyncio
+import argparse
+import threading
+from typing import Callable, Dict, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+# Paddle显存（或内存）不足时的异常信息，common.http._check_oom据此识别OOM异常
+OOM_MESSAGES = {
+    'gpu': (
+        "ResourceExhaustedError: \n\n"
+        "Out of memory error on GPU 0. Cannot allocate 1.819336GB memory on GPU 0, "
+        "9.243896GB memory has been allocated and available memory is only 1.517273GB.\n\n"
+        "Please check whether there is any other process using GPU 0.\n"
+        "1. If yes, please stop them, or start PaddlePaddle on another GPU.\n"
+        "2. If no, please decrease the batch size of your model. \n"
+    ),
+    'gpu_traceback': (
+        "Traceback(mostrecentcalllast):\n"
+        "...ResourceExhaustedError:\n"
+        "OutofmemoryerroronGPU0.Cannotallocate2.181519GBmemoryonGPU0,8.634033GBmemoryhasbeenallocated"
+        "andavailablememoryisonly2.124084GB.\n"
+        "PleasecheckwhetherthereisanyotherprocessusingGPU0.\n"
+        "1.Ifyes,pleasestopthem,orstartPaddlePaddleonanotherGPU.\n"
+        "2.Ifno,pleasedecreasethebatchsizeofyourmodel.\n"
+        "Iftheabovewaysdonotsolvetheoutofmemoryproblem,youcantrytouseCUDAmanagedmemory."
+        "Thecommandis`exportFLAGS_use_cuda_managed_memory=false`.\n"
+    ),
+    'cpu': (
+        "ResourceExhaustedError: \n\n"
+        "Out of memory error on CPU. Cannot allocate 2.000000GB memory on CPU, "
+        "available memory is only 1.024000GB.\n"
+    ),
+}
+
+DEFAULTS = {
+    'latency': '0', 'error_rate': '0', 'error_status': '500', 'oom_rate': '0', 'oom': 'gpu',
+    'timeout_rate': '0', 'reset_rate': '0', 'slow_body': '0', 'size': '64', 'set_cookie': '',
+}
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error', 502: 'Bad Gateway',
+           503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """解释延迟的配置，返回生成延迟（秒）的函数"""
+    name, _, params = spec.partition(':')
+    if not params:
+        value = float(name)
+        return lambda: value
+    args = [float(val) for val in params.split(':')]
+    dists = {
+        'uniform': lambda: random.uniform(args[0], args[1]),
+        'normal': lambda: random.gauss(args[0], args[1]),
+        'exp': lambda: random.expovariate(1 / args[0]),
+        'lognormal': lambda: random.lognormvariate(math.log(args[0]), args[1]),
+    }
+    if name not in dists:
+        raise ValueError(f'不支持的延迟分布: {name}')
+    return lambda: max(0.0, dists[name]())
+
+
+class MockUpstream:
+    """模拟上游服务
+    Args:
+        host str: 监听地址
+        port int: 监听端口，0表示随机端口（启动后见self.port）
+        **defaults: 请求的默认行为，见文件头的说明
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, **defaults) -> None:
+        self.host = host
+        self.port = port
+        self.defaults = {**DEFAULTS, **{k: str(v) for k, v in defaults.items() if v is not None}}
+        self.stats: Dict[str, int] = {}
+        # 连接处理任务 -> 连接
+        self._handlers: Dict[asyncio.Task, asyncio.StreamWriter] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+        # keep-alive连接不会随监听关闭而断开，需要主动关闭
+        for writer in self._handlers.values():
+            writer.transport.abort()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    def start_in_thread(self) -> 'MockUpstream':
+        """在独立线程的事件循环中运行，避免与被测代码（或者压测客户端）争用事件循环"""
+        started = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(self.start())
+            started.set()
+            self._loop.run_forever()
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name='mock-upstream', daemon=True)
+        self._thread.start()
+        started.wait()
+        return self
+
+    def stop_thread(self):
+        if self._loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+
+    def _count(self, outcome: str):
+        self.stats[outcome] = self.stats.get(outcome, 0) + 1
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """处理一个连接上的请求（支持keep-alive）"""
+        task = asyncio.current_task()
+        self._handlers[task] = writer
+        try:
+            while True:
+                request = await _read_request(reader)
+                if request is None:
+                    break
+                keep_alive = await self._respond(request, reader, writer)
+                if not keep_alive:
+                    break
+        except ValueError:      # 请求行或者请求头格式错误
+            self._count('400')
+            await _write(writer, 400, json.dumps({'code': 400, 'message': '请求格式错误'}).encode())
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._handlers.pop(task, None)
+            if not writer.is_closing():
+                writer.close()
+
+    async def _respond(self, request: Dict, reader: asyncio.StreamReader,
+                       writer: asyncio.StreamWriter) -> bool:
+        """按配置输出响应，返回是否保持连接"""
+        if request['path'] == '/__stats':
+            await _write(writer, 200, json.dumps(self.stats).encode())
+            return request['keep_alive']
+        opts = {**self.defaults, **request['query']}
+        await asyncio.sleep(parse_latency(opts['latency'])())
+        if random.random() < float(opts['reset_rate']):
+            self._count('reset')
+            _reset(writer)
+            return False
+        if random.random() < float(opts['timeout_rate']):
+            self._count('timeout')
+            await reader.read()     # 一直不响应，直到客户端超时断开
+            return False
+        if random.random() < float(opts['oom_rate']):
+            self._count('oom')
+            await _write(writer, 500, OOM_MESSAGES[opts['oom']].encode(), media_type='text/plain')
+            return request['keep_alive']
+        if random.random() < float(opts['error_rate']):
+            status = int(opts['error_status'])
+            self._count(str(status))
+            await _write(writer, status, json.dumps({'code': status, 'message': '模拟的上游异常'}).encode())
+            return request['keep_alive']
+        body = json.dumps({'path': request['path'], 'cookie': request['headers'].get('cookie', ''),
+                           'data': 'x' * int(opts['size'])}).encode()
+        self._count('200')
+        headers = {'Set-Cookie': f"{opts['set_cookie']}; Path=/"} if opts['set_cookie'] else None
+        await _write(writer, 200, body, slow_body=float(opts['slow_body']), headers=headers)
+        return request['keep_alive']
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[Dict]:
+    """读取请求，连接关闭时返回None，请求格式错误时抛出ValueError"""
+    line = await reader.readline()
+    if not line:
+        return None
+    method, target, version = line.decode('latin-1').split()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length:
+        await reader.readexactly(length)
+    url = urlsplit(target)
+    connection = headers.get('connection', '').lower()
+    keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+    return {'method': method, 'path': url.path, 'query': dict(parse_qsl(url.query)), 'headers': headers,
+            'keep_alive': keep_alive}
+
+
+async def _write(writer: asyncio.StreamWriter, status: int, body: bytes,
+                 media_type: str = 'application/json', slow_body: float = 0,
+                 headers: Optional[Dict[str, str]] = None):
+    extra = ''.join(f'{key}: {value}\r\n' for key, value in (headers or {}).items())
+    head = (f'HTTP/1.1 {status} {REASONS.get(status, "Unknown")}\r\n'
+            f'Content-Type: {media_type}\r\nContent-Length: {len(body)}\r\n{extra}\r\n')
+    writer.write(head.encode('latin-1'))
+    if slow_body <= 0:
+        writer.write(body)
+        await writer.drain()
+        return
+    # 响应体分10块输出，总耗时为slow_body秒
+    await writer.drain()
+    chunk = max(1, len(body) // 10 + 1)
+    for i in range(0, len(body), chunk):
+        await asyncio.sleep(slow_body / 10)
+        writer.write(body[i:i + chunk])
+        await writer.drain()
+
+
+def _reset(writer: asyncio.StreamWriter):
+    """设置SO_LINGER为0后关闭连接，客户端会收到RST（Connection reset by peer）"""
+    sock = writer.get_extra_info('socket')
+    if sock is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    writer.transport.abort()
+
+
+def check_http(concurrency: int = 20):
+    """使用common.http请求模拟服务，输出各种故障下的处理结果及耗时"""
+    from concurrent.futures import ThreadPoolExecutor
+    from common import http
+    from exceptions import BaseException as AppException
+
+    # 每个场景使用独立的模拟服务（端口不同），避免前一个场景触发的熔断影响后面的场景
+    cases = [
+        ('正常', 'latency=uniform:0.01:0.05'),
+        ('5xx', 'error_rate=1&error_status=503'),
+        ('GPU OOM', 'oom_rate=1&oom=gpu'),
+        ('GPU OOM(traceback)', 'oom_rate=1&oom=gpu_traceback'),
+        ('CPU OOM', 'oom_rate=1&oom=cpu'),
+        ('超时', 'timeout_rate=1'),
+        ('响应体缓慢', 'slow_body=2'),
+        ('连接重置', 'reset_rate=1'),
+        ('混合', 'latency=exp:0.02&error_rate=0.1&oom_rate=0.05&timeout_rate=0.05&reset_rate=0.05'),
+    ]
+
+    def call(url: str) -> str:
+        try:
+            resp = http.get(url, timeout=(1, 0.5), coalesce=False)
+            return str(resp.status_code)
+        except AppException as e:
+            return f'{e.code}:{e.message[:16]}'
+
+    stats: Dict[str, int] = {}
+    with ThreadPoolExecutor(concurrency) as pool:
+        for name, query in cases:
+            server = MockUpstream().start_in_thread()
+            start = time.perf_counter()
+            results: Dict[str, int] = {}
+            try:
+                for res in pool.map(call, [f'{server.url}/predict?{query}'] * concurrency):
+                    results[res] = results.get(res, 0) + 1
+            finally:
+                server.stop_thread()
+            print(f'{name:<20} {time.perf_counter() - start:6.2f}s  {results}  上游: {server.stats}')
+            for key, cnt in server.stats.items():
+                stats[key] = stats.get(key, 0) + cnt
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='模拟上游服务')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    for key, value in DEFAULTS.items():
+        parser.add_argument(f'--{key}', default=value)
+    parser.add_argument('--check', action='store_true', help='使用common.http请求模拟服务，并输出结果')
+    options = vars(parser.parse_args())
+    if options.pop('check'):
+        # 在项目目录下执行：python -m common.mock_upstream --check
+        stats = check_http()
+        assert stats['oom'] > 0 and stats['timeout'] > 0 and stats['reset'] > 0
+        # 格式错误的请求返回400
+        server = MockUpstream().start_in_thread()
+        with socket.create_connection((server.host, server.port)) as sock:
+            sock.sendall(b'GARBAGE\r\n\r\n')
+            assert sock.recv(1024).startswith(b'HTTP/1.1 400 '), 'malformed request'
+        server.stop_thread()
+    else:
+        upstream = MockUpstream(**options)
+
+        async def main():
+            await upstream.start()
+            print(f'mock upstream: {upstream.url}')
+            await asyncio.Event().wait()
+
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
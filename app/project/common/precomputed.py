@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+#
+# 预先计算的响应
+# 对于内容在运行期间不会变化的接口（如OpenAPI文档、状态码列表），在启动时一次性序列化及gzip压缩，
+# 请求时直接输出，并根据ETag返回304
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import gzip
+import hashlib
+from typing import Dict, Optional
+
+from fastapi import Request
+from fastapi.responses import Response
+
+
+def make_etag(body: bytes) -> str:
+    """根据内容生成强ETag"""
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """判断请求头If-None-Match是否匹配（按RFC 7232，使用弱比较）"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return etag in tags or f'W/{etag}' in tags
+
+
+def parse_accept_encoding(accept_encoding: str) -> Dict[str, float]:
+    """解析请求头Accept-Encoding：编码 -> q值，q值为0表示客户端不接受该编码"""
+    accepted: Dict[str, float] = {}
+    for item in accept_encoding.lower().split(','):
+        name, *params = [part.strip() for part in item.split(';')]
+        if not name:
+            continue
+        q = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[name] = q
+    return accepted
+
+
+def accepts_encoding(accepted: Dict[str, float], encoding: str) -> bool:
+    """客户端是否接受该编码（支持通配符*）
+    Args:
+        accepted Dict[str, float]: parse_accept_encoding的返回值
+    """
+    return accepted.get(encoding, accepted.get('*', 0)) > 0
+
+
+def accepts_gzip(request: Request) -> bool:
+    """客户端是否接受gzip（gzip;q=0表示不接受）"""
+    return accepts_encoding(parse_accept_encoding(request.headers.get('accept-encoding', '')), 'gzip')
+
+
+class PrecomputedResponse:
+    """预先计算的响应：原始内容及gzip压缩的内容，各自有不同的ETag"""
+    def __init__(self, body: bytes, media_type: str = 'application/json',
+                 cache_control: str = 'no-cache') -> None:
+        self.body = body
+        self.gzip_body = gzip.compress(body, compresslevel=9, mtime=0)
+        self.media_type = media_type
+        self.etag = make_etag(body)
+        self.gzip_etag = self.etag[:-1] + '-gzip"'
+        self.headers: Dict[str, str] = {'Vary': 'Accept-Encoding', 'Cache-Control': cache_control}
+
+    def response(self, request: Request) -> Response:
+        """根据请求头生成响应：304、gzip压缩或者原始内容"""
+        gzipped = accepts_gzip(request) and len(self.gzip_body) < len(self.body)
+        etag = self.gzip_etag if gzipped else self.etag
+        headers = {**self.headers, 'ETag': etag}
+        if_none_match = request.headers.get('if-none-match')
+        if etag_matches(if_none_match, self.etag) or etag_matches(if_none_match, self.gzip_etag):
+            return Response(status_code=304, headers=headers)
+        if gzipped:
+            headers['Content-Encoding'] = 'gzip'
+            return Response(self.gzip_body, media_type=self.media_type, headers=headers)
+        return Response(self.body, media_type=self.media_type, headers=headers)
+
+
+if __name__ == '__main__':
+    # 在项目目录下执行：python -m common.precomputed
+    resp = PrecomputedResponse(b'{"a":1}' * 100)
+    assert gzip.decompress(resp.gzip_body) == resp.body
+    assert etag_matches(f'W/{resp.etag}, "x"', resp.etag)
+    assert not etag_matches('"x"', resp.etag)
+    assert accepts_encoding(parse_accept_encoding('br, gzip;q=0.5'), 'gzip')
+    assert not accepts_encoding(parse_accept_encoding('gzip;q=0, br'), 'gzip')
+    assert not accepts_encoding(parse_accept_encoding('x-gzip'), 'gzip')
+    print(resp.etag, resp.gzip_etag, len(resp.body), len(resp.gzip_body))
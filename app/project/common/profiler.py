@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+#
+# 单个请求的采样分析（profile）
+# 1. 采样：后台线程定时（PROFILE_INTERVAL）读取事件循环线程的调用栈，只记录正在执行被分析请求的样本，
+#    其他并发请求的耗时不会计入；同步接口（在线程池中执行）及run_in_thread中的代码不在采样范围内
+# 2. 触发：请求头X-Profile，DEBUG模式下任意值即可；否则需要使用PROFILE_SECRET签名（见sign_header）
+#    也可以通过管理接口POST /debug/profiles/sample在一段时间内随机分析N个请求（只对处理该请求的进程生效）
+# 3. 输出：在线程池中保存到PROFILE_DIR，文件名为服务端生成的ID（时间戳+随机数，见响应头X-Profile-Id），请求ID只记录在文件内容中，
+#    格式为speedscope（https://www.speedscope.app/），
+#    也可以输出为折叠栈格式（collapsed），用于flamegraph.pl生成火焰图
+#
+# 生成签名的请求头：
+#     python -m common.profiler sign
+#     curl -H "X-Profile: <签名>" http://127.0.0.1:8000/test/1
+#     curl -H "X-Profile: <签名>" http://127.0.0.1:8000/debug/profiles/<X-Profile-Id> > profile.json
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import sys
+import hmac
+import json
+import time
+import random
+import hashlib
+import threading
+from uuid import uuid4
+from pathlib import Path
+from types import FrameType
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from settings import REQUEST_ID_KEY
+from settings import PROFILE_SECRET, PROFILE_DIR, PROFILE_INTERVAL, PROFILE_SIGNATURE_TTL, PROFILE_MAX_FILES
+from settings import PROFILE_MAX_SAMPLES
+from exceptions import InternalException, status
+from common.logger import logger, TraceID
+from common.responses import FastJSONResponse
+from common.executor import run_in_thread
+
+PROFILE_HEADER = 'x-profile'
+ADMIN_PATH = '/debug/profiles'
+# 调用栈中的一帧：(函数名, 文件, 行号)
+FrameKey = Tuple[str, str, int]
+
+
+def sign_header(secret: str = PROFILE_SECRET, ttl: int = PROFILE_SIGNATURE_TTL) -> str:
+    """生成请求头X-Profile的值：过期时间戳.签名"""
+    expires = str(int(time.time()) + ttl)
+    return f'{expires}.{_signature(secret, expires)}'
+
+
+def verify_header(value: Optional[str], debug: bool, secret: str = PROFILE_SECRET) -> bool:
+    """校验请求头X-Profile：DEBUG模式下只需要存在；否则需要签名正确且没有过期"""
+    if not value:
+        return False
+    if debug:
+        return True
+    expires, _, signature = value.partition('.')
+    if not secret or not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, _signature(secret, expires))
+
+
+def _signature(secret: str, expires: str) -> str:
+    return hmac.new(secret.encode(), expires.encode(), hashlib.sha256).hexdigest()
+
+
+class Profile:
+    """一个请求的采样结果"""
+    def __init__(self, profile_id: str, name: str, marker: FrameType, request_id: str = '',
+                 max_samples: int = PROFILE_MAX_SAMPLES) -> None:
+        self.profile_id = profile_id
+        self.name = name
+        self.request_id = request_id
+        self.marker = marker     # 中间件的栈帧，采样时只记录该帧之上的调用栈
+        self.start = time.perf_counter()
+        self.end = 0.0
+        self.last = self.start
+        self.samples: List[Tuple[FrameKey, ...]] = []
+        self.weights: List[float] = []
+        self.max_samples = max_samples
+        self.truncated = False   # 样本数达到上限后不再记录
+        self.trace_id = ''
+
+    def add(self, stack: Tuple[FrameKey, ...], now: float):
+        if len(self.samples) >= self.max_samples:
+            self.truncated = True
+            return
+        self.samples.append(stack)
+        self.weights.append(now - self.last)
+        self.last = now
+
+    def to_speedscope(self) -> dict:
+        frames: Dict[FrameKey, int] = {}
+        samples = [[frames.setdefault(key, len(frames)) for key in stack] for stack in self.samples]
+        title = self.name
+        if self.request_id:
+            title += f' req={self.request_id}'
+        if self.trace_id:
+            title += f' trace={self.trace_id}'
+        if self.truncated:
+            title += ' truncated'
+        return {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': f'{title} ({self.profile_id})',
+            'exporter': 'fastapi-start',
+            'shared': {'frames': [{'name': name, 'file': file, 'line': line} for name, file, line in frames]},
+            'profiles': [{
+                'type': 'sampled', 'name': title, 'unit': 'seconds',
+                'startValue': 0, 'endValue': (self.end or self.last) - self.start,
+                'samples': samples, 'weights': self.weights,
+            }],
+        }
+
+    def to_collapsed(self) -> str:
+        """折叠栈格式：每行为“根;...;叶 耗时（微秒）”"""
+        counts: Dict[str, float] = {}
+        for stack, weight in zip(self.samples, self.weights):
+            key = ';'.join(f'{name} ({Path(file).name}:{line})' for name, file, line in stack)
+            counts[key] = counts.get(key, 0.0) + weight
+        return '\n'.join(f'{key} {int(value * 1e6)}' for key, value in counts.items())
+
+
+class Sampler:
+    """采样线程：只在有请求需要分析时运行"""
+    def __init__(self, interval: float = PROFILE_INTERVAL) -> None:
+        self.interval = interval
+        self.active: Dict[str, Profile] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._target_thread = 0     # 事件循环所在的线程
+
+    def start(self, profile: Profile):
+        with self._lock:
+            self._target_thread = threading.get_ident()
+            self.active[profile.profile_id] = profile
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+                self._thread.start()
+
+    def stop(self, profile: Profile):
+        profile.end = time.perf_counter()
+        with self._lock:
+            self.active.pop(profile.profile_id, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self.active:
+                    self._thread = None
+                    return
+                profiles = list(self.active.values())
+            frame = sys._current_frames().get(self._target_thread)
+            if frame is None:
+                continue
+            now = time.perf_counter()
+            stack: List[FrameType] = []
+            while frame is not None:
+                stack.append(frame)
+                frame = frame.f_back
+            for profile in profiles:
+                if profile.marker in stack:     # 当前正在执行该请求
+                    above = stack[:stack.index(profile.marker)]
+                    profile.add(tuple(_frame_key(f) for f in reversed(above)), now)
+                else:
+                    profile.last = now      # 等待io等，不计入样本
+
+
+def _frame_key(frame: FrameType) -> FrameKey:
+    code = frame.f_code
+    return (getattr(code, 'co_qualname', code.co_name), code.co_filename, frame.f_lineno)
+
+
+class RandomSampling:
+    """随机分析的配置：在window秒内，每个请求按rate的概率分析，最多count个"""
+    def __init__(self) -> None:
+        self.remaining = 0
+        self.deadline = 0.0
+        self.rate = 0.0
+        self.profile_ids: List[str] = []
+
+    def arm(self, count: int, window: float, rate: float):
+        self.remaining, self.deadline, self.rate = count, time.time() + window, rate
+        self.profile_ids = []
+
+    def take(self) -> bool:
+        if self.remaining <= 0 or time.time() > self.deadline or random.random() >= self.rate:
+            return False
+        self.remaining -= 1
+        return True
+
+
+sampler = Sampler()
+random_sampling = RandomSampling()
+
+
+class ProfilerMiddleware:
+    """请求分析中间件：满足条件的请求在响应头中返回X-Profile-Id，分析结果保存到PROFILE_DIR"""
+    def __init__(self, app: ASGIApp, debug: bool = False, profile_dir: Path = PROFILE_DIR) -> None:
+        self.app = app
+        self.debug = debug
+        self.profile_dir = Path(profile_dir)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http' or scope['path'].startswith(ADMIN_PATH):
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        sampled = False
+        if not verify_header(headers.get(PROFILE_HEADER), self.debug):
+            sampled = random_sampling.take()
+            if not sampled:
+                await self.app(scope, receive, send)
+                return
+
+        # 文件名不使用客户端传入的请求ID，避免覆盖其他请求的分析结果
+        profile_id = f'{int(time.time() * 1000)}-{uuid4().hex[:12]}'
+        profile = Profile(profile_id, f"{scope['method']} {scope['path']}", sys._getframe(),
+                          request_id=headers.get(REQUEST_ID_KEY, ''))
+        if sampled:
+            random_sampling.profile_ids.append(profile_id)
+
+        async def send_wrapper(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                MutableHeaders(scope=message)['X-Profile-Id'] = profile_id
+            await send(message)
+
+        sampler.start(profile)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            sampler.stop(profile)
+            profile.trace_id = TraceID.get_trace_id()
+            # 响应已经发送，保存失败（如线程池已关闭）只记录日志
+            try:
+                await run_in_thread(self._save, profile)
+            except Exception as e:
+                logger.error(f"请求分析结果保存失败 : {profile.name} : {profile.profile_id} : {e!r}")
+
+    def _save(self, profile: Profile):
+        """序列化及写入文件（在线程池中执行，不阻塞事件循环）"""
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        path = self.profile_dir.joinpath(f'{profile.profile_id}.speedscope.json')
+        with open(path, 'w', encoding='utf8') as f:
+            json.dump(profile.to_speedscope(), f)
+        with open(path.with_name(f'{profile.profile_id}.collapsed.txt'), 'w', encoding='utf8') as f:
+            f.write(profile.to_collapsed())
+        logger.info(f"请求分析 : {profile.name} : {path} : {len(profile.samples)}个样本")
+        # 只保留最近的分析结果
+        files = sorted(self.profile_dir.glob('*.speedscope.json'), key=lambda p: p.stat().st_mtime)
+        for old in files[:-PROFILE_MAX_FILES]:
+            old.unlink(missing_ok=True)
+            old.with_name(old.name.replace('.speedscope.json', '.collapsed.txt')).unlink(missing_ok=True)
+
+
+def init_profiler(app: FastAPI, debug: bool = False, profile_dir: Path = PROFILE_DIR):
+    """注册请求分析中间件及管理接口（管理接口同样需要请求头X-Profile）"""
+    app.add_middleware(ProfilerMiddleware, debug=debug, profile_dir=profile_dir)
+
+    def check(request: Request):
+        if not verify_header(request.headers.get(PROFILE_HEADER), debug):
+            raise InternalException(status.HTTP_401_UNAUTHORIZED, message='请求头X-Profile校验不通过')
+
+    @app.post(f"{ADMIN_PATH}/sample", include_in_schema=False)
+    async def profile_sample_api(request: Request, count: int = 10, window: float = 60, rate: float = 0.1):
+        """在window秒内随机分析count个请求（每个请求被分析的概率为rate）"""
+        check(request)
+        random_sampling.arm(count, window, rate)
+        return {'count': count, 'window': window, 'rate': rate}
+
+    @app.get(ADMIN_PATH, include_in_schema=False)
+    async def profile_list_api(request: Request):
+        """最近的分析结果，sampled为随机分析得到的结果"""
+        check(request)
+        files = sorted(Path(profile_dir).glob('*.speedscope.json'),
+                       key=lambda p: p.stat().st_mtime, reverse=True)
+        return {'profiles': [p.name.split('.')[0] for p in files],
+                'sampled': random_sampling.profile_ids, 'remaining': max(0, random_sampling.remaining)}
+
+    @app.get(ADMIN_PATH + "/{profile_id}", include_in_schema=False)
+    async def profile_get_api(request: Request, profile_id: str, format: str = 'speedscope'):
+        """获取分析结果，format: speedscope或者collapsed"""
+        check(request)
+        if not profile_id.replace('-', '').replace('_', '').isalnum():
+            raise InternalException(status.HTTP_400_BAD_REQUEST, message='profile_id格式错误')
+        suffix = '.collapsed.txt' if format == 'collapsed' else '.speedscope.json'
+        path = Path(profile_dir).joinpath(profile_id + suffix)
+        if not path.is_file():
+            raise InternalException(status.HTTP_404_NOT_FOUND, message=f'分析结果不存在: {profile_id}')
+        with open(path, 'rb') as f:
+            data = f.read()
+        if format == 'collapsed':
+            return PlainTextResponse(data)
+        return FastJSONResponse(data)
+
+
+if __name__ == '__main__':
+    # 在项目目录下执行：python -m common.profiler [sign]
+    if sys.argv[1:] == ['sign']:
+        print(sign_header())
+        sys.exit(0)
+    import asyncio
+    import tempfile
+    from fastapi.testclient import TestClient
+
+    assert verify_header(sign_header('secret'), debug=False, secret='secret')
+    assert not verify_header(sign_header('secret'), debug=False, secret='other')
+    assert not verify_header('1.abc', debug=False, secret='secret')
+
+    def busy(seconds: float):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+    app = FastAPI()
+
+    @app.get('/slow')
+    async def slow():
+        busy(0.1)
+        await asyncio.sleep(0.05)
+        busy(0.1)
+        return {'ok': True}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        init_profiler(app, debug=True, profile_dir=Path(tmp))
+        client = TestClient(app)
+        assert 'x-profile-id' not in client.get('/slow').headers
+        resp = client.get('/slow', headers={'X-Profile': '1', REQUEST_ID_KEY: '../req-1'})
+        profile_id = resp.headers['x-profile-id']
+        assert 'req' not in profile_id, profile_id
+        data = client.get(f"/debug/profiles/{profile_id}", headers={'X-Profile': '1'}).json()
+        assert 'req=../req-1' in data['name'], data['name']
+        names = {frame['name'] for frame in data['shared']['frames']}
+        assert any(name.endswith('busy') for name in names), names
+        total = sum(data['profiles'][0]['weights'])
+        assert 0.1 < total < 0.35, total    # sleep的时间不计入
+        client.post('/debug/profiles/sample?count=2&window=10&rate=1', headers={'X-Profile': '1'})
+        ids = [client.get('/slow').headers.get('x-profile-id') for _ in range(3)]
+        assert ids[0] and ids[1] and ids[2] is None
+        assert len(client.get('/debug/profiles', headers={'X-Profile': '1'}).json()['profiles']) == 3
+
+    # 保存失败时不影响响应
+    with tempfile.NamedTemporaryFile() as tmp:
+        app2 = FastAPI()
+        app2.get('/slow')(slow)
+        init_profiler(app2, debug=True, profile_dir=Path(tmp.name))
+        assert TestClient(app2).get('/slow', headers={'X-Profile': '1'}).status_code == 200
+
+    # 样本数上限
+    profile = Profile('1', 'test', sys._getframe(), max_samples=2)
+    for i in range(3):
+        profile.add((('f', 'x.py', i),), profile.start + i)
+    assert len(profile.samples) == len(profile.weights) == 2 and profile.truncated
+    assert profile.to_speedscope()['name'].endswith('truncated (1)')
+    print('ok')
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+#
+# 高性能的JSON响应
+# 1. FastJSONResponse: 使用orjson序列化（没有安装orjson或者配置为json时使用标准库），作为app默认的响应类型
+# 2. trusted: 标记可信的接口，返回值不再按照response_model重新校验及转换，直接序列化输出
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import json
+import asyncio
+from functools import wraps
+from typing import Any, Callable
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+
+from settings import JSON_ENCODER
+
+try:
+    import orjson
+except ImportError:     # orjson是可选依赖
+    orjson = None
+
+# 是否使用orjson进行序列化
+use_orjson = orjson is not None and JSON_ENCODER == 'orjson'
+
+
+def _default(obj: Any) -> Any:
+    """序列化不支持的类型时（如pydantic模型），转换为可以序列化的类型"""
+    return jsonable_encoder(obj)
+
+
+def dumps(content: Any) -> bytes:
+    """序列化为JSON（utf8编码，不转义中文）"""
+    if use_orjson:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(',', ':'),
+                      default=_default).encode('utf-8')
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON响应，序列化方式由配置JSON_ENCODER决定
+    用法和JSONResponse一致，content为bytes时认为已经序列化过，直接输出
+    """
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
+
+
+def trusted(func: Callable) -> Callable:
+    """标记可信的接口：返回值直接序列化输出，不再按response_model进行校验及转换
+    适合返回数据量大、且数据结构由代码保证的接口（如列表接口），response_model仍然用于生成文档。
+    注意：返回值中多余的字段也会被输出；路由装饰器中的status_code，以及通过Response参数设置的头信息不会生效。
+    用法（需要放在路由装饰器的下面）：
+        @router.get("/items", response_model=List[Item])
+        @trusted
+        async def list_items():
+            ...
+    """
+    if asyncio.iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            return _to_response(await func(*args, **kwargs))
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return _to_response(func(*args, **kwargs))
+    return wrapper
+
+
+def _to_response(content: Any) -> Response:
+    if isinstance(content, Response):
+        return content
+    return FastJSONResponse(content)
+
+
+if __name__ == '__main__':
+    # 在项目目录下执行：python -m common.responses
+    from datetime import date
+    from pydantic import BaseModel
+
+    class Item(BaseModel):
+        name: str
+        day: date
+
+    body = FastJSONResponse({'items': [Item(name='测试', day=date(2022, 1, 1))], 1: None}).body
+    print(body.decode('utf-8'))
+    assert json.loads(body) == {'items': [{'name': '测试', 'day': '2022-01-01'}], '1': None}
+    assert FastJSONResponse(b'{"a":1}').body == b'{"a":1}'
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# 模块路由的自动加载
+# 模块目录为项目根目录下的*_module，路由文件为router.py，路由对象为router
+# 加载的模块由配置ROUTER_MODULES指定，配置ROUTER_AUTO_DISCOVER为True时，自动加载所有的模块
+# ROUTER_MODULES的每一项可以是模块名，或者字典：
+#     ROUTER_MODULES = [
+#         'test_module',      # 前缀默认为/test，标签默认为模块README.md中的标题
+#         {'name': 'captcha_module', 'prefix': '/captcha', 'tags': ['验证码模块']},
+#         {'name': 'ocr_module', 'admission': {'max_concurrency': 10, 'max_queue': 20}},   # 该模块的并发限制
+#     ]
+# 模块中较重的依赖可以使用common.lazy.lazy_import延迟到第一次使用时才导入
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import time
+import importlib
+from pathlib import Path
+from typing import Dict, List, Union
+
+from fastapi import Depends, FastAPI
+
+from settings import ROOT_PATH, ROUTER_MODULES, ROUTER_AUTO_DISCOVER, ROUTER_LOG_IMPORT_TIME
+from common.logger import logger
+from common.admission import get_limiter
+
+MODULE_SUFFIX = '_module'
+
+
+def discover_modules(root_path: Path = ROOT_PATH) -> List[str]:
+    """查找项目目录下所有包含router.py的模块"""
+    return sorted(path.parent.name for path in Path(root_path).glob(f'*{MODULE_SUFFIX}/router.py'))
+
+
+def module_configs(modules: List[Union[str, Dict]] = ROUTER_MODULES,
+                   auto_discover: bool = ROUTER_AUTO_DISCOVER, root_path: Path = ROOT_PATH) -> List[Dict]:
+    """生成模块的加载配置：name, prefix, tags
+    自动发现的模块排在配置的模块之后，配置中的参数优先
+    """
+    configs: Dict[str, Dict] = {}
+    items = list(modules)
+    if auto_discover:
+        items += discover_modules(root_path)
+    for item in items:
+        cfg = {'name': item} if isinstance(item, str) else dict(item)
+        name = cfg['name']
+        if not name.endswith(MODULE_SUFFIX):
+            name = cfg['name'] = name + MODULE_SUFFIX
+        if name in configs:
+            continue
+        cfg.setdefault('prefix', '/' + name[:-len(MODULE_SUFFIX)])
+        if 'tags' not in cfg:
+            cfg['tags'] = [_module_title(Path(root_path).joinpath(name, 'README.md')) or name]
+        configs[name] = cfg
+    return list(configs.values())
+
+
+def include_routers(app: FastAPI, modules: List[Union[str, Dict]] = ROUTER_MODULES,
+                    auto_discover: bool = ROUTER_AUTO_DISCOVER,
+                    log_import_time: bool = ROUTER_LOG_IMPORT_TIME):
+    """加载模块的路由
+    Args:
+        modules List[Union[str, Dict]]: 需要加载的模块，格式见文件头的说明，admission为该模块的并发限制参数
+        auto_discover bool: 是否自动加载项目目录下所有的模块
+        log_import_time bool: 是否在日志中记录每个模块的导入耗时，用于排查启动慢的模块
+    """
+    total = 0.0
+    for cfg in module_configs(modules, auto_discover):
+        start = time.perf_counter()
+        module = importlib.import_module(f"{cfg['name']}.router")
+        seconds = time.perf_counter() - start
+        total += seconds
+        # 按模块的并发限制，参数见common.admission.AdmissionLimiter
+        dependencies = [Depends(get_limiter(cfg['name'], **cfg['admission']))] if cfg.get('admission') else []
+        app.include_router(module.router, prefix=cfg['prefix'], tags=cfg['tags'], dependencies=dependencies)
+        if log_import_time:
+            logger.info(f"加载模块 : {cfg['name']} : prefix = {cfg['prefix']} : 导入耗时 {seconds * 1000:.1f}ms")
+    if log_import_time:
+        logger.info(f"加载模块完成 : 总导入耗时 {total * 1000:.1f}ms")
+
+
+def _module_title(readme: Path) -> str:
+    """模块的标题：README.md的第一行，如：# 验证码模块-模块说明"""
+    if not readme.is_file():
+        return ''
+    with open(readme, encoding='utf8') as f:
+        title = f.readline().strip('# \n').strip()
+    return title.split('-模块说明')[0].strip()
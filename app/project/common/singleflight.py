@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+#
+# 请求合并（singleflight）
+# 相同key的并发调用只会真正执行一次，其他调用等待并共享该次执行的结果（或异常）
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import asyncio
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class _Call:
+    """一次正在进行中的调用"""
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class Group:
+    """同步版本，用于多线程环境（如普通def接口所在的线程池）"""
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.coalesced = 0      # 被合并（没有真正执行）的调用次数
+
+    def do(self, key: Hashable, fn: Callable, *args, **kwargs) -> Any:
+        """执行fn，如果相同key的调用正在进行中，则等待其结果"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+class AsyncGroup:
+    """异步版本，用于同一个事件循环中的协程"""
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable, *args, **kwargs) -> Any:
+        """执行协程函数fn，如果相同key的调用正在进行中，则等待其结果
+        真正的执行放在独立的task中，某个调用方被取消不会影响其他等待者
+        """
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(fn(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Future):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()    # 避免所有等待者都被取消时出现异常未被获取的警告
+
+
+if __name__ == '__main__':
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+
+    calls = []
+
+    def slow(x):
+        calls.append(x)
+        time.sleep(0.1)
+        return x * 2
+
+    group = Group()
+    with ThreadPoolExecutor(10) as pool:
+        results = list(pool.map(lambda _: group.do('k', slow, 1), range(10)))
+    assert results == [2] * 10
+    assert len(calls) == 1 and group.coalesced == 9
+
+    async def aslow(x):
+        calls.append(x)
+        await asyncio.sleep(0.1)
+        return x * 2
+
+    async def main():
+        agroup = AsyncGroup()
+        results = await asyncio.gather(*[agroup.do('k', aslow, 2) for _ in range(10)])
+        assert results == [4] * 10
+        assert agroup.coalesced == 9
+
+    asyncio.run(main())
+    assert len(calls) == 2
+    print('ok')
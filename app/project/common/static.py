@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# 静态文件
+# 1. 存在预先压缩的文件（如swagger-ui-bundle.js.br、swagger-ui-bundle.js.gz）时，按Accept-Encoding输出压缩后的文件
+# 2. 使用文件内容的hash作为ETag，并设置长期缓存（Cache-Control: immutable）
+# 长期缓存需要在引用静态文件的地址中带上版本号（见version方法），文件内容变化时地址随之变化
+# 压缩文件在初始化项目（fas project init）时生成，也可以使用gzip -k -9及brotli -k生成
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import os
+import hashlib
+from typing import Dict, Optional, Tuple
+
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.types import Scope
+
+from settings import STATIC_CACHE_CONTROL
+from common.precomputed import etag_matches, parse_accept_encoding, accepts_encoding
+
+# 支持的压缩格式，按优先级排列：(Content-Encoding, 文件后缀)
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """支持预先压缩文件及长期缓存的静态文件"""
+    def __init__(self, *args, cache_control: str = STATIC_CACHE_CONTROL, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+        # (文件路径, 修改时间, 大小) -> 内容hash
+        self._digests: Dict[Tuple[str, float, int], str] = {}
+
+    def version(self, path: str) -> str:
+        """静态文件的版本号（内容hash的前12位），用于拼接静态文件的地址，如：/static/a.js?v=xxx"""
+        full_path, stat_result = self.lookup_path(path)
+        if stat_result is None:
+            return ''
+        return self._digest(full_path, stat_result)[:12]
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope,
+                      status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        digest = self._digest(full_path, stat_result)
+        encoding, encoded_path = self._select_encoding(full_path, stat_result, request_headers)
+        etag = f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+        headers = {'ETag': etag, 'Cache-Control': self.cache_control, 'Vary': 'Accept-Encoding'}
+        if status_code == 200 and etag_matches(request_headers.get('if-none-match'), etag):
+            return Response(status_code=304, headers=headers)
+
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if encoding is None:
+            response.headers.update(headers)
+            return response
+        # 压缩文件：保留原文件的类型，加上压缩编码
+        headers['Content-Encoding'] = encoding
+        return FileResponse(encoded_path, status_code=status_code, headers=headers,
+                            media_type=response.media_type)
+
+    def _digest(self, full_path: str, stat_result: os.stat_result) -> str:
+        """文件内容的hash，文件没有变化时只计算一次"""
+        key = (str(full_path), stat_result.st_mtime, stat_result.st_size)
+        digest = self._digests.get(key)
+        if digest is None:
+            sha = hashlib.sha256()
+            with open(full_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+            digest = self._digests[key] = sha.hexdigest()[:32]
+        return digest
+
+    @staticmethod
+    def _select_encoding(full_path: str, stat_result: os.stat_result,
+                         request_headers: Headers) -> Tuple[Optional[str], Optional[str]]:
+        """选择客户端支持的压缩格式，压缩文件需要存在且不早于原文件"""
+        accepted = parse_accept_encoding(request_headers.get('accept-encoding', ''))
+        for encoding, suffix in ENCODINGS:
+            if not accepts_encoding(accepted, encoding):
+                continue
+            encoded_path = f'{full_path}{suffix}'
+            try:
+                encoded_stat = os.stat(encoded_path)
+            except OSError:
+                continue
+            if encoded_stat.st_mtime >= stat_result.st_mtime:
+                return encoding, encoded_path
+        return None, None
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# 请求耗时统计
+# 纯ASGI中间件（不经过BaseHTTPMiddleware，不影响流式响应），在响应头中注入：
+# 1. X-Process-Time: 请求总耗时（秒）
+# 2. Server-Timing: 各阶段的耗时（毫秒），如：routing;dur=0.3, handler;dur=25.1, http;dur=20.4, total;dur=25.6
+# 其中routing及handler阶段需要将mark_handler_start注册为全局依赖项
+#
+# 在业务代码中记录阶段耗时：
+#     from common.timing import phase
+#     with phase('redis'):
+#         await redis.get(key)
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+from starlette.datastructures import MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# 当前请求的耗时记录，同一个请求中共享同一个对象（包括在线程池中执行的同步接口）
+_timing: ContextVar[Optional['RequestTiming']] = ContextVar('x_timing', default=None)
+
+
+class RequestTiming:
+    """一次请求的耗时记录"""
+    __slots__ = ('start', 'handler_start', 'phases')
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        self.handler_start = 0.0
+        self.phases: Dict[str, float] = {}     # 各阶段的耗时（秒）
+
+    def server_timing(self, now: float) -> str:
+        """生成Server-Timing头，routing和handler以开始发送响应的时间为截止"""
+        items = []
+        if self.handler_start:
+            items.append(('routing', self.handler_start - self.start))
+            items.append(('handler', now - self.handler_start))
+        items.extend(self.phases.items())
+        items.append(('total', now - self.start))
+        return ', '.join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in items)
+
+
+def record(name: str, seconds: float):
+    """记录某个阶段的耗时，同一个阶段多次记录时会累加"""
+    timing = _timing.get()
+    if timing is not None:
+        timing.phases[name] = timing.phases.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """记录代码块的耗时
+    常用的阶段：http（上游请求），redis，db
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+async def mark_handler_start():
+    """全局依赖项：标记接口开始处理的时间
+    在此之前的耗时（中间件、路由匹配、请求体读取）记为routing，之后到开始发送响应记为handler
+    """
+    timing = _timing.get()
+    if timing is not None and not timing.handler_start:
+        timing.handler_start = time.perf_counter()
+
+
+class TimingMiddleware:
+    """请求耗时中间件"""
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming()
+        token = _timing.set(timing)
+
+        async def send_wrapper(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                now = time.perf_counter()
+                headers = MutableHeaders(scope=message)
+                headers.append('X-Process-Time', str(now - timing.start))
+                headers.append('Server-Timing', timing.server_timing(now))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _timing.reset(token)
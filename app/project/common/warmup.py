@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# 应用预热及健康检查
+# 1. 预热：应用启动后在后台执行，预先建立数据库及redis连接、生成OpenAPI文档，并执行注册的预热函数（如加载模型、预热缓存）
+#    某一步失败时按指数退避重试该步骤（已完成的步骤不重复执行），依赖服务恢复之后即可就绪
+# 2. /health/live: 存活检查，进程能处理请求即返回200
+# 3. /health/ready: 就绪检查，预热完成且依赖服务正常时返回200，否则返回503，负载均衡应该根据该接口决定是否转发请求
+#    依赖服务（redis、数据库及注册的检查函数）在后台定时检查，接口直接返回缓存的检查结果（包括耗时）
+#
+# 注册预热函数及检查函数（同步函数会在线程池中执行）：
+#     from common.warmup import register_warmup, register_health_check
+#     @register_warmup
+#     def load_model():
+#         ...
+#     @register_health_check('model')
+#     async def check_model():
+#         ...     # 抛出异常表示检查不通过
+# Author: __author__
+# Email: __email__
+# Created Time: __created_time__
+import time
+import asyncio
+from typing import Callable, Dict, List, Tuple
+
+from fastapi import FastAPI
+
+from settings import WARMUP_DB_CONNECTIONS, WARMUP_REDIS_CONNECTIONS
+from settings import WARMUP_RETRY_DELAY, WARMUP_RETRY_MAX_DELAY
+from settings import HEALTH_CHECK_INTERVAL, HEALTH_CHECK_TIMEOUT, HEALTH_CHECK_DB
+from common.logger import logger
+from common.responses import FastJSONResponse
+from common.executor import run_in_thread
+
+# 注册的预热函数：(名称, 函数)
+_warmups: List[Tuple[str, Callable]] = []
+# 注册的健康检查函数：名称 -> 函数
+_checks: Dict[str, Callable] = {}
+# 预热状态
+_state = {'ready': False, 'error': '', 'seconds': 0.0}
+# 缓存的检查结果：名称 -> {ok, latency_ms, error, checked_at}
+_results: Dict[str, dict] = {}
+_tasks: List[asyncio.Task] = []
+
+
+def register_warmup(fn: Callable = None, *, name: str = None):
+    """注册预热函数（可以作为装饰器使用），按注册顺序执行"""
+    def decorator(fn: Callable) -> Callable:
+        _warmups.append((name or fn.__qualname__, fn))
+        return fn
+    return decorator(fn) if fn is not None else decorator
+
+
+def register_health_check(name: str):
+    """注册健康检查函数（装饰器），函数抛出异常或者返回False表示检查不通过"""
+    def decorator(fn: Callable) -> Callable:
+        _checks[name] = fn
+        return fn
+    return decorator
+
+
+def is_ready() -> bool:
+    return _state['ready']
+
+
+def init_warmup(app: FastAPI):
+    """注册预热及健康检查：启动后在后台预热，并定时检查依赖服务"""
+    @app.on_event("startup")
+    async def startup_warmup():
+        _tasks.append(asyncio.create_task(_run_warmup(app)))
+        _tasks.append(asyncio.create_task(_run_checks()))
+
+    @app.on_event("shutdown")
+    async def shutdown_warmup():
+        for task in _tasks:
+            task.cancel()
+        await asyncio.gather(*_tasks, return_exceptions=True)
+        _tasks.clear()
+
+    @app.get("/health/live", summary='存活检查')
+    async def health_live_api():
+        """进程存活即返回200"""
+        return {'status': 'ok'}
+
+    @app.get("/health/ready", summary='就绪检查')
+    async def health_ready_api():
+        """预热完成且依赖服务正常时返回200，否则返回503\n
+        checks中为各个依赖服务最近一次的检查结果（后台定时检查）及耗时（毫秒）
+        """
+        ok = _state['ready'] and all(item['ok'] for item in _results.values())
+        content = {'ready': _state['ready'], 'warmup': _state, 'checks': _results}
+        return FastJSONResponse(content, status_code=200 if ok else 503)
+
+
+async def _run_warmup(app: FastAPI):
+    """依次执行预热，全部成功之后才标记为就绪"""
+    start = time.perf_counter()
+    steps: List[Tuple[str, Callable]] = [('openapi', app.openapi)]
+    if WARMUP_REDIS_CONNECTIONS > 0 and _redis_configured():
+        steps.append(('redis', _warmup_redis))
+    if WARMUP_DB_CONNECTIONS > 0:
+        steps.append(('db', _warmup_db))
+    for name, fn in steps + _warmups:
+        step_start = time.perf_counter()
+        delay = WARMUP_RETRY_DELAY
+        while True:
+            try:
+                await _call(fn)
+                break
+            except Exception as e:
+                _state['error'] = f'{name}: {e}'
+                logger.exception(f"预热失败 : {name} : {e} : {delay}秒后重试")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, WARMUP_RETRY_MAX_DELAY)
+        _state['error'] = ''
+        logger.info(f"预热完成 : {name} : {(time.perf_counter() - step_start) * 1000:.1f}ms")
+    # 第一次依赖检查完成之后再标记为就绪
+    await _check_all()
+    _state['seconds'] = round(time.perf_counter() - start, 3)
+    _state['ready'] = True
+    logger.info(f"应用预热完成 : {_state['seconds']}s")
+
+
+async def _run_checks():
+    """定时检查依赖服务"""
+    while True:
+        await _check_all()
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+
+
+async def _check_all():
+    checks: Dict[str, Callable] = {}
+    if _redis_configured():
+        checks['redis'] = _check_redis
+    if HEALTH_CHECK_DB:
+        checks['db'] = _check_db
+    checks.update(_checks)
+    names = list(checks)
+    results = await asyncio.gather(*[_check(checks[name]) for name in names])
+    _results.update(zip(names, results))
+
+
+async def _check(fn: Callable) -> dict:
+    start = time.perf_counter()
+    error = ''
+    try:
+        ok = await asyncio.wait_for(_call(fn), HEALTH_CHECK_TIMEOUT) is not False
+    except asyncio.TimeoutError:
+        ok, error = False, f'超时（{HEALTH_CHECK_TIMEOUT}秒）'
+    except Exception as e:
+        ok, error = False, str(e)
+    return {'ok': ok, 'latency_ms': round((time.perf_counter() - start) * 1000, 2),
+            'error': error, 'checked_at': time.time()}
+
+
+async def _call(fn: Callable):
+    """执行函数：异步函数直接执行，同步函数在线程池中执行"""
+    if asyncio.iscoroutinefunction(fn):
+        return await fn()
+    return await run_in_thread(fn)
+
+
+def _redis_configured() -> bool:
+    from common.connections import _redis_params
+    return bool(_redis_params)
+
+
+async def _warmup_redis():
+    """预先建立redis连接：并发执行ping，连接池会建立相应数量的连接"""
+    from common.connections import get_async_redis
+    async for redis in get_async_redis():
+        await asyncio.gather(*[redis.ping() for _ in range(WARMUP_REDIS_CONNECTIONS)])
+
+
+async def _check_redis():
+    from common.connections import get_async_redis
+    async for redis in get_async_redis():
+        await redis.ping()
+
+
+def _warmup_db():
+    """预先建立数据库连接：同时占用多个连接之后再归还连接池"""
+    from sqlalchemy import text
+    from database import engine
+    conns: List = []
+    try:
+        for _ in range(WARMUP_DB_CONNECTIONS):
+            conn = engine.connect()
+            conns.append(conn)
+            conn.execute(text('SELECT 1'))
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+def _check_db():
+    from sqlalchemy import text
+    from database import engine
+    with engine.connect() as conn:
+        conn.execute(text('SELECT 1'))
+
+
+if __name__ == '__main__':
+    # 在项目目录下执行：python -m common.warmup
+    from fastapi.testclient import TestClient
+
+    WARMUP_RETRY_DELAY = 0.01  # noqa: F811  缩短重试间隔
+    calls = []
+
+    @register_warmup
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ConnectionError('依赖服务未启动')
+
+    app = FastAPI()
+    init_warmup(app)
+    with TestClient(app) as client:
+        for _ in range(100):
+            if client.get('/health/ready').status_code == 200:
+                break
+            time.sleep(0.01)
+        data = client.get('/health/ready').json()
+        assert data['ready'] and not data['warmup']['error'], data
+        assert len(calls) == 3, calls
+    print('ok')
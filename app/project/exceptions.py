@@ -10,12 +10,14 @@
 # Created Time: __created_time__
 from fastapi import FastAPI
 from fastapi import status as fastapiStatus, HTTPException
-from fastapi.responses import JSONResponse
 from fastapi.exceptions import RequestValidationError
 from pydantic import ValidationError
-from traceback import format_exc
-from typing import Any
+from http import HTTPStatus
+from typing import Any, Dict, Optional, Tuple
 from settings import SYSTEM_CODE_BASE
+from common.metrics import set_error_code
+from common.error_report import error_reporter, format_detail
+from common.responses import FastJSONResponse, dumps
 
 # 状态码基数应该符合这两个条件
 assert SYSTEM_CODE_BASE >= 1000
@@ -23,10 +25,9 @@ assert SYSTEM_CODE_BASE % 1000 == 0
 
 
 def init_exception(app: FastAPI):
-    """初始化异常处理"""
-    def get_detail(msg: str) -> str:
-        return '\n'.join(msg.strip().split('\n')[-3:])
-
+    """初始化异常处理
+    异常信息通过error_reporter输出到日志（去重及限流），不会阻塞事件循环
+    """
     @app.exception_handler(RequestValidationError)
     async def validation_exception_handler(request, exc: Exception):
         """请求参数异常"""
@@ -40,40 +41,42 @@ def init_exception(app: FastAPI):
     @app.exception_handler(BaseException)
     async def base_exception_handler(request, exc: BaseException):
         """捕获自定义异常"""
-        # 把异常的详细信息打印到控制台，也可以在此实现将日志写入到对应的文件系统等
-        print(format_exc(), flush=True)
-        return ErrorResponse(exc.code, message=exc.message, detail=exc.detail)
+        # 把异常的详细信息写入日志，也可以在此实现将异常上报到对应的系统等
+        error_reporter.report(exc, request.url.path)
+        return ErrorResponse(exc.code, message=exc.message, detail=exc.detail, headers=exc.headers)
 
     @app.exception_handler(HTTPException)
     async def http_exception_handler(request, exc: HTTPException):
         """捕获FastAPI异常"""
-        print(format_exc(), flush=True)
-        return ErrorResponse(exc.status_code, message=str(exc.detail), detail=exc.detail)
+        error_reporter.report(exc, request.url.path)
+        return ErrorResponse(exc.status_code, message=str(exc.detail), detail=exc.detail, headers=exc.headers)
 
     @app.exception_handler(Exception)
     async def allexception_handler(request, exc: Exception):
         """捕获所有其他的异常
         """
-        msg = format_exc()
-        print(msg, flush=True)
+        error_reporter.report(exc, request.url.path)
         return ErrorResponse(status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            message='内部异常', detail=get_detail(msg))
+                            message='内部异常', detail=format_detail(exc))
 
     @app.exception_handler(KeyError)
     async def keyerror_handler(request, exc: KeyError):
         """捕获所有其他的异常"""
-        msg = format_exc()
-        print(msg, flush=True)
+        error_reporter.report(exc, request.url.path)
         return ErrorResponse(status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            message='内部异常', detail=get_detail(msg))
+                            message='内部异常', detail=format_detail(exc))
 
     @app.exception_handler(ValueError)
     async def valueerror_handler(request, exc: ValueError):
         """捕获所有其他的异常"""
-        msg = format_exc()
-        print(msg, flush=True)
+        error_reporter.report(exc, request.url.path)
         return ErrorResponse(status.HTTP_500_INTERNAL_SERVER_ERROR,
-                            message='内部异常', detail=get_detail(msg))
+                            message='内部异常', detail=format_detail(exc))
+
+    @app.on_event("shutdown")
+    async def shutdown_error_reporter():
+        """输出窗口期内还没有输出的重复次数"""
+        error_reporter.flush()
 
 
 class status:
@@ -86,10 +89,13 @@ class status:
     HTTP_404_NOT_FOUND = fastapiStatus.HTTP_404_NOT_FOUND
     # 5XX：来自服务器端错误的响应
     HTTP_500_INTERNAL_SERVER_ERROR = fastapiStatus.HTTP_500_INTERNAL_SERVER_ERROR
+    # 过载时拒绝请求，见common/admission.py
+    HTTP_503_SERVICE_UNAVAILABLE = fastapiStatus.HTTP_503_SERVICE_UNAVAILABLE
     HTTP_504_GATEWAY_TIMEOUT = fastapiStatus.HTTP_504_GATEWAY_TIMEOUT
     # 自定义常量值应该取值在600-999
     HTTP_600_ID_NOT_EXISTED = 600    # 示例
 
+
 # 状态码对应的异常信息(默认)
 messages = {
     # 4XX
@@ -99,6 +105,7 @@ messages = {
     status.HTTP_404_NOT_FOUND: '请求的资源不存在',
     # 5XX
     status.HTTP_500_INTERNAL_SERVER_ERROR: '服务器内部错误',
+    status.HTTP_503_SERVICE_UNAVAILABLE: '服务繁忙，请稍后重试',
     status.HTTP_504_GATEWAY_TIMEOUT: '请求上游服务时超时',
     # 600-999
     status.HTTP_600_ID_NOT_EXISTED: '请求ID不存在',
@@ -122,16 +129,18 @@ class BaseException(HTTPException):
     异常都使用这个类型或者其子类进行抛出，会被统一进行处理和响应。
     对于嵌套的异常处理，如果捕获到这个类型的，则直接raise即可，其他的异常则可以进行进一步的处理。
     """
-    def __init__(self, code: int, message: str = None, detail: Any = None) -> None:
+    def __init__(self, code: int, message: str = None, detail: Any = None,
+                 headers: Optional[Dict[str, str]] = None) -> None:
         """
         :param code 必须是在在status中定义好的值
         :param message 异常信息，通常可以展示给前端用户看
         :param detail 详细异常信息，通常是用于开发排查问题
+        :param headers 响应头，如503时的Retry-After
         """
         self.code = code
         self.message = message if message else messages[code]
         status_code = code if code < 600 else fastapiStatus.HTTP_500_INTERNAL_SERVER_ERROR
-        super().__init__(status_code, detail)
+        super().__init__(status_code, detail, headers=headers)
 
     def __str__(self) -> str:
         return f"code={self.code} message={self.message}\n detail={self.detail}"
@@ -144,7 +153,7 @@ class InternalException(BaseException):
     pass
 
 
-class ErrorResponse(JSONResponse):
+class ErrorResponse(FastJSONResponse):
     """接口异常响应类型
     通常只需要在中间件捕获异常的时候使用。
     异常时可以指定一个状态，这个状态码应该尽量重用http标准的状态码，
@@ -167,26 +176,53 @@ class ErrorResponse(JSONResponse):
     其中：
     code值是完整的异常状态码，message是异常描述信息。
     """
-    def __init__(self, code: int, message: str = None, detail: Any = None) -> None:
+    def __init__(self, code: int, message: str = None, detail: Any = None,
+                 headers: Optional[Dict[str, str]] = None) -> None:
         """
         :param code 响应状态码，正常取值0-999，若该值与1000的余数大于等于600，则http code会自动重置为500。若该值大于等于1000，则该值可能来自上游接口
         :param message 异常信息，通常是用于展示给用户。如果该值为空，则会默认为code值对应的异常信息
         :param detail 详细的异常信息，通常用于开发者排除定位问题使用
+        :param headers 响应头
         """
         if code >= 1000:    # 指定的code值，可能来自上游服务的异常
-            super().__init__(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            set_error_code(code)
+            super().__init__(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, headers=headers,
                              content={"code": code, 'message': message, 'detail': detail})
             return
         # http的状态码大于600会报错，超过600响应为内部错误
         status_code = code if code < 600 else status.HTTP_500_INTERNAL_SERVER_ERROR
         message = messages[code] if message is None else message
-        super().__init__(status_code=status_code,
+        set_error_code(SYSTEM_CODE_BASE + code)     # 用于监控指标的状态码标签
+        body = None
+        if detail is None or isinstance(detail, str):
+            body = _error_bodies.get((code, message, detail))
+        if body is not None:    # 使用预先序列化的响应体
+            super().__init__(status_code=status_code, content=body, headers=headers)
+            return
+        super().__init__(status_code=status_code, headers=headers,
                          content={"code": SYSTEM_CODE_BASE + code,
                                   'message': message, 'detail': detail})
 
 
+def _build_error_bodies() -> Dict[Tuple[int, str, Any], bytes]:
+    """预先序列化固定状态码的异常响应体：使用默认的异常信息，detail为空或者为http状态码的默认描述
+    （抛出异常时没有指定detail，HTTPException会把detail设置为http状态码的默认描述）
+    """
+    bodies = {}
+    for code, message in messages.items():
+        phrase = HTTPStatus(code if code < 600 else status.HTTP_500_INTERNAL_SERVER_ERROR).phrase
+        for detail in (None, phrase):
+            bodies[(code, message, detail)] = dumps({"code": SYSTEM_CODE_BASE + code,
+                                                     'message': message, 'detail': detail})
+    return bodies
+
+
+_error_bodies = _build_error_bodies()
+
+
 if __name__ == "__main__":
     resp = ErrorResponse(status.HTTP_403_FORBIDDEN, message='接口请求参数错误')
     print(resp.body)
     resp = ErrorResponse(status.HTTP_600_ID_NOT_EXISTED)
     print(resp.body)
+    assert resp.body is _error_bodies[(status.HTTP_600_ID_NOT_EXISTED, '请求ID不存在', None)]
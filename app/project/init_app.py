@@ -4,21 +4,46 @@
 # Author: caiyingyao
 # Email: cyy0523xc@gmail.com
 # Created Time: 2022-06-09
-from typing import List
-from fastapi import FastAPI
+from typing import Callable, Dict, List
+from fastapi import FastAPI, Depends, Request
 from fastapi.openapi.docs import (
+    get_redoc_html,
     get_swagger_ui_html,
     get_swagger_ui_oauth2_redirect_html,
 )
-from fastapi.staticfiles import StaticFiles
 
 from schema import VersionResp, StatusCodeResp
 from exceptions import get_status
 from exceptions import init_exception
+from common.logger import get_log_stats
+from common.http import response_cache
+from common.timing import TimingMiddleware, mark_handler_start
+from common.metrics import init_metrics, track_in_progress
+from common.executor import init_executors
+from common.warmup import init_warmup
+from common.responses import FastJSONResponse, dumps
+from common.precomputed import PrecomputedResponse
+from common.static import PrecompressedStaticFiles
+from common.compression import CompressionMiddleware
+from common.routers import include_routers
+from common.profiler import init_profiler
+from common.admission import init_admission
 
 
-def init_app(version='1.0', title='接口文档', description='描述文档', debug=False) -> FastAPI:
-    """初始化app"""
+def init_app(version='1.0', title='接口文档', description='描述文档', debug=False,
+             metrics=False, compression=False, profiler=False, admission=False) -> FastAPI:
+    """初始化app
+    Args:
+        metrics bool: 是否开启监控指标（Prometheus格式的/metrics接口）
+        compression bool: 是否开启响应压缩，压缩参数见配置COMPRESSION_*
+        profiler bool: 是否开启请求分析（请求头X-Profile触发），非debug模式下需要配置PROFILE_SECRET
+        admission bool: 是否开启全局的并发限制（过载保护），参数见配置ADMISSION_*
+    """
+    # 全局依赖项
+    dependencies = [Depends(mark_handler_start)]    # 用于统计路由及接口处理的耗时
+    if metrics:
+        dependencies.append(Depends(track_in_progress))     # 用于统计处理中的请求数
+
     # *****************************************************
     # 解决接口文档的静态文件问题
     # *****************************************************
@@ -28,19 +53,64 @@ def init_app(version='1.0', title='接口文档', description='描述文档', de
         description=description,
         version=version,
         docs_url=None,      # 关闭原有的文档地址
+        redoc_url=None,
+        openapi_url=None,   # OpenAPI文档在启动时生成，见下面的openapi_api
         responses={'default': {"description": "异常相应值见文档说明"}},
+        dependencies=dependencies,
+        default_response_class=FastJSONResponse,    # 使用orjson序列化
     )
-    app.mount("/static", StaticFiles(directory="static"), name="static")
+    # 静态文件：优先输出预先压缩的文件，并长期缓存（地址中带上内容hash作为版本号）
+    static_files = PrecompressedStaticFiles(directory="static")
+    app.mount("/static", static_files, name="static")
+    openapi_url = "/openapi.json"
+    # 启动时生成的响应：OpenAPI文档、文档页面及状态码列表，内容在运行期间不会变化
+    # 启动事件没有执行时（如测试中没有触发startup），在第一次请求时生成
+    precomputed: Dict[str, PrecomputedResponse] = {}
 
-    @app.get("/docs", include_in_schema=False)
-    async def custom_swagger_ui_html():
-        return get_swagger_ui_html(
-            openapi_url=app.openapi_url,
+    def build_docs() -> PrecomputedResponse:
+        docs = get_swagger_ui_html(
+            openapi_url=openapi_url,
             title=app.title + " - 接口文档",
             oauth2_redirect_url=app.swagger_ui_oauth2_redirect_url,
-            swagger_js_url="/static/swagger-ui-bundle.js",
-            swagger_css_url="/static/swagger-ui.css",
+            swagger_js_url=f"/static/swagger-ui-bundle.js?v={static_files.version('swagger-ui-bundle.js')}",
+            swagger_css_url=f"/static/swagger-ui.css?v={static_files.version('swagger-ui.css')}",
         )
+        return PrecomputedResponse(docs.body, media_type='text/html')
+
+    def build_redoc() -> PrecomputedResponse:
+        redoc = get_redoc_html(openapi_url=openapi_url, title=app.title + " - ReDoc")
+        return PrecomputedResponse(redoc.body, media_type='text/html')
+
+    builders: Dict[str, Callable[[], PrecomputedResponse]] = {
+        'openapi': lambda: PrecomputedResponse(dumps(app.openapi())),
+        'docs': build_docs,
+        'redoc': build_redoc,
+        'status': lambda: PrecomputedResponse(dumps(get_status())),
+    }
+
+    def get_precomputed(name: str) -> PrecomputedResponse:
+        resp = precomputed.get(name)
+        if resp is None:
+            resp = precomputed[name] = builders[name]()
+        return resp
+
+    @app.on_event("startup")
+    async def startup_precompute():
+        """所有路由注册完成之后，生成文档及状态码列表，并预先压缩"""
+        for name, build in builders.items():
+            precomputed[name] = build()
+
+    @app.get(openapi_url, include_in_schema=False)
+    async def openapi_api(request: Request):
+        return get_precomputed('openapi').response(request)
+
+    @app.get("/docs", include_in_schema=False)
+    async def custom_swagger_ui_html(request: Request):
+        return get_precomputed('docs').response(request)
+
+    @app.get("/redoc", include_in_schema=False)
+    async def redoc_html(request: Request):
+        return get_precomputed('redoc').response(request)
 
     @app.get(app.swagger_ui_oauth2_redirect_url, include_in_schema=False)
     async def swagger_ui_redirect():
@@ -51,6 +121,30 @@ def init_app(version='1.0', title='接口文档', description='描述文档', de
     # 初始化异常处理
     init_exception(app)
 
+    # 请求分析（在最内层，只分析接口本身）
+    if profiler:
+        init_profiler(app, debug=debug)
+
+    # 响应压缩（在耗时统计的中间件之内，压缩的耗时也会被统计）
+    if compression:
+        app.add_middleware(CompressionMiddleware)
+
+    # 准入控制：超出并发限制的请求排队，队列满或者排队超时则快速拒绝（排队耗时记入Server-Timing的queue）
+    init_admission(app, enabled=admission)
+
+    # 统一在响应头里注入执行时间（X-Process-Time）及各阶段耗时（Server-Timing）
+    app.add_middleware(TimingMiddleware)
+
+    # 监控指标
+    if metrics:
+        init_metrics(app)
+
+    # 阻塞或CPU密集型任务使用的线程池及进程池（common.executor.run_in_thread/run_in_process）
+    init_executors(app)
+
+    # 启动后在后台预热（连接池、OpenAPI文档及注册的预热函数），预热完成之前/health/ready返回503
+    init_warmup(app)
+
     @app.get("/version", summary='获取系统版本号',
             response_model=VersionResp)
     async def version_api():
@@ -59,10 +153,29 @@ def init_app(version='1.0', title='接口文档', description='描述文档', de
 
     @app.get("/status/code", summary='获取接口的异常状态码及说明',
             response_model=List[StatusCodeResp])
-    async def status_code_api():
+    async def status_code_api(request: Request):
         """获取系统的异常状态值及相应的说明\n
         该接口通常用于开发阶段，用于查询各个状态值及其意义
         """
-        return get_status()
+        return get_precomputed('status').response(request)
+
+    @app.get("/status/logs", include_in_schema=False)
+    async def log_stats_api():
+        """日志统计：采样丢弃的数量，JSON日志的写入数量及缓冲区满而丢弃的数量（当前进程）"""
+        return get_log_stats()
+
+    @app.get("/status/http-cache", include_in_schema=False)
+    async def http_cache_stats_api():
+        """上游GET请求响应缓存的命中、未命中、重新验证及淘汰次数（当前进程）"""
+        return response_cache.stats()
+
+    # 加载配置ROUTER_MODULES中的模块路由
+    include_routers(app)
+
+    @app.on_event("shutdown")
+    async def shutdown_http():
+        """释放上游请求的共享连接池"""
+        from common.http import close as close_http
+        await close_http()
 
     return app
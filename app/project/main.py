@@ -6,9 +6,7 @@
 # Created Time: __created_time__
 # from fastapi import Depends
 # from fastapi.middleware.cors import CORSMiddleware
-import time
-from fastapi import Request
-from settings import DEBUG
+from settings import DEBUG, METRICS_ENABLED, COMPRESSION_ENABLED, PROFILE_SECRET, ADMISSION_ENABLED
 from utils import parse_readme
 from schema import VersionResp
 from exceptions import status, InternalException
@@ -17,7 +15,9 @@ from init_app import init_app
 # 初始化app
 version = "0.5.0"     # 系统版本号
 title, description = parse_readme()
-app = init_app(version=version, title=title, description=description, debug=DEBUG)
+app = init_app(version=version, title=title, description=description, debug=DEBUG,
+               metrics=METRICS_ENABLED, compression=COMPRESSION_ENABLED,
+               profiler=DEBUG or bool(PROFILE_SECRET), admission=ADMISSION_ENABLED)
 
 # 跨域问题
 """
@@ -32,21 +32,13 @@ app.add_middleware(
 """
 
 
-@app.middleware("http")
-async def add_process_time_header(request: Request, call_next):
-    """统一在响应体里注入执行时间的字段"""
-    start_time = time.time()
-    response = await call_next(request)
-    process_time = time.time() - start_time
-    response.headers["X-Process-Time"] = str(process_time)
-    return response
-
-
 # redis连接
-# from common.connections import init_redis
+# from common.connections import init_redis, init_redis_events
 # init_redis('192.168.1.242')   # 配置redis host
+# init_redis_events(app)        # 启动时创建异步连接池，关闭时释放
 
 # 加载模块路由
+# 也可以在配置ROUTER_MODULES中指定需要加载的模块，由init_app自动加载
 # from test_module.router import router as test_router
 # app.include_router(test_router, prefix="/test", tags=["测试模块"])
 
@@ -31,3 +31,172 @@ LOG_ROOT_PATH = ROOT_PATH.joinpath("logs")
 
 # 用于追踪的请求ID字段
 REQUEST_ID_KEY = "x-request-id"
+
+# *****************************************************
+# 上游http请求配置，在common/http.py中使用
+# *****************************************************
+# 连接池：缓存的host连接池数量，及每个host的最大连接数
+HTTP_POOL_CONNECTIONS = 20
+HTTP_POOL_MAXSIZE = 50
+# 异步客户端的总连接数上限
+HTTP_MAX_CONNECTIONS = 200
+# 空闲的keep-alive连接保留的秒数（异步客户端）
+HTTP_KEEPALIVE_EXPIRY = 30
+# 默认的连接超时及读超时秒数（调用时传入timeout参数则以参数为准）
+HTTP_CONNECT_TIMEOUT = 3
+HTTP_READ_TIMEOUT = 30
+# 超时重试的退避时间：min(最大值, 基数 * 2^重试次数)，在此范围内随机取值（full jitter）
+HTTP_RETRY_BACKOFF = 0.1
+HTTP_RETRY_BACKOFF_MAX = 2
+# 每个上游host的熔断器：连续失败多少次后熔断，熔断多少秒后进入半开状态，半开状态的试探请求数
+HTTP_BREAKER_ENABLED = True
+HTTP_BREAKER_FAILURE_THRESHOLD = 5
+HTTP_BREAKER_RECOVERY_TIMEOUT = 30
+HTTP_BREAKER_HALF_OPEN_CALLS = 1
+# 相同的GET请求并发时只请求一次上游服务（请求合并），其他请求共享结果（包括领头请求的追踪ID）
+# 合并的key由请求方法、url、params及全部头信息（追踪ID除外）组成，默认不开启，也可以在调用get时指定coalesce参数
+HTTP_COALESCE_GET = False
+# GET请求响应缓存的最大条目数（调用get时指定cache_ttl参数才会启用缓存）
+HTTP_CACHE_MAXSIZE = 1024
+
+# *****************************************************
+# redis连接池配置，在common/connections.py中使用
+# *****************************************************
+# 连接池的最大连接数（同步和异步连接池分别计算）
+REDIS_MAX_CONNECTIONS = 50
+# 连接数达到上限时，等待空闲连接的最长秒数，超时则抛出redis.ConnectionError
+REDIS_POOL_TIMEOUT = 5
+# 命令执行超时及建立连接超时的秒数
+REDIS_SOCKET_TIMEOUT = 5
+REDIS_SOCKET_CONNECT_TIMEOUT = 3
+# 连接空闲超过该秒数之后，下次使用前会先用ping进行健康检查
+REDIS_HEALTH_CHECK_INTERVAL = 30
+
+# *****************************************************
+# 日志配置，在common/logger.py中使用
+# *****************************************************
+# 高吞吐日志模式：所有日志以JSON Lines格式写入logs/app-YYYYMMDD.jsonl，由后台线程批量写入
+LOG_JSON = False
+# 批量写入的记录数，及最长的刷新间隔秒数
+LOG_JSON_BATCH_SIZE = 200
+LOG_JSON_FLUSH_INTERVAL = 1
+# 缓冲区最多保存的记录数，写入文件跟不上时丢弃新的日志（丢弃数量见接口/status/logs）
+LOG_JSON_MAX_BUFFER = 100000
+# 按日志级别采样，如{'INFO': 0.1}表示只保留10%的INFO日志，没有配置的级别全部保留
+LOG_SAMPLE_RATES = {}
+
+# *****************************************************
+# 监控指标配置，在common/metrics.py中使用
+# *****************************************************
+# 是否注册Prometheus格式的/metrics接口
+METRICS_ENABLED = False
+# 指标文件目录，多个worker进程的指标写入各自的文件，/metrics接口汇总目录下的所有文件
+# 进程退出时计数合并到归档文件并删除该进程的文件，fas serve启动时会清空该目录
+METRICS_DIR = ROOT_PATH.joinpath("metrics")
+# 每个进程的指标容量（float64的个数），每个接口大约占用30个
+METRICS_CAPACITY = 65536
+# 耗时直方图的分桶（秒）
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# *****************************************************
+# 线程池及进程池配置，在common/executor.py中使用
+# *****************************************************
+# run_in_thread使用的线程数，None表示使用默认值：min(32, CPU核数 + 4)
+EXECUTOR_THREAD_WORKERS = None
+# run_in_process使用的进程数，大于0时在应用启动时创建；不大于0时在第一次使用时按CPU核数创建
+EXECUTOR_PROCESS_WORKERS = 0
+
+# *****************************************************
+# 异常上报配置，在common/error_report.py中使用
+# *****************************************************
+# 相同的异常堆栈在该窗口期（秒）内只输出一次，之后只计数，窗口期结束时输出重复次数
+ERROR_REPORT_WINDOW = 60
+# 每秒最多输出的完整异常堆栈数量，超过时只输出一行异常信息
+ERROR_REPORT_MAX_PER_SECOND = 10
+
+# *****************************************************
+# JSON响应配置，在common/responses.py中使用
+# *****************************************************
+# 响应的序列化方式：orjson或者json（标准库），没有安装orjson时使用标准库
+JSON_ENCODER = 'orjson'
+
+# *****************************************************
+# 静态文件配置，在common/static.py中使用
+# *****************************************************
+# 静态文件的缓存头，地址中带有内容hash作为版本号，所以可以长期缓存
+STATIC_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# *****************************************************
+# 响应压缩配置，在common/compression.py中使用
+# *****************************************************
+# 是否开启响应压缩
+COMPRESSION_ENABLED = False
+# 小于该长度（字节）的响应不压缩
+COMPRESSION_MINIMUM_SIZE = 1024
+# gzip压缩级别（1-9），及brotli压缩级别（0-11），级别越高压缩率越高，但是越耗CPU
+COMPRESSION_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 4
+# 允许压缩的响应类型（前缀匹配），图片等已经压缩过的类型不需要再压缩
+COMPRESSION_CONTENT_TYPES = ['application/json', 'text/', 'application/javascript', 'image/svg+xml']
+# 压缩算法，按优先级排列：br（需要安装brotli）, gzip
+COMPRESSION_ALGORITHMS = ['br', 'gzip']
+
+# *****************************************************
+# 模块路由配置，在common/routers.py中使用
+# *****************************************************
+# 需要加载的模块（*_module/router.py），可以是模块名，或者包含name, prefix, tags的字典，如：
+# ROUTER_MODULES = ['test_module', {'name': 'captcha_module', 'prefix': '/captcha', 'tags': ['验证码模块']}]
+# 前缀默认为模块名去掉_module，标签默认为模块README.md中的标题；admission为该模块的并发限制，如：{'max_concurrency': 10}
+ROUTER_MODULES = []
+# 是否自动加载项目目录下所有的模块
+ROUTER_AUTO_DISCOVER = False
+# 是否在日志中记录每个模块的导入耗时
+ROUTER_LOG_IMPORT_TIME = False
+
+# *****************************************************
+# 预热及健康检查配置，在common/warmup.py中使用
+# *****************************************************
+# 启动时预先建立的连接数，0表示不预热（redis需要先调用init_redis）
+WARMUP_REDIS_CONNECTIONS = 0
+WARMUP_DB_CONNECTIONS = 0
+# 预热失败后的重试间隔（秒），每次失败翻倍，最大为WARMUP_RETRY_MAX_DELAY
+WARMUP_RETRY_DELAY = 1
+WARMUP_RETRY_MAX_DELAY = 30
+# 依赖服务的检查间隔（秒），/health/ready返回最近一次的检查结果
+HEALTH_CHECK_INTERVAL = 10
+# 单个依赖服务的检查超时（秒）
+HEALTH_CHECK_TIMEOUT = 2
+# 是否检查数据库（执行SELECT 1）；redis在调用init_redis之后自动检查
+HEALTH_CHECK_DB = False
+
+# *****************************************************
+# 请求分析配置，在common/profiler.py中使用
+# *****************************************************
+# 请求头X-Profile的签名密钥，非DEBUG模式下需要签名才能触发分析；为空且非DEBUG模式时不开启请求分析
+PROFILE_SECRET = ''
+# 签名的有效期（秒）
+PROFILE_SIGNATURE_TTL = 300
+# 分析结果的保存目录，及最多保留的数量
+PROFILE_DIR = ROOT_PATH.joinpath("profiles")
+PROFILE_MAX_FILES = 100
+# 采样间隔（秒）
+PROFILE_INTERVAL = 0.002
+# 单个请求最多保留的样本数，超过后不再采样（避免长请求占用过多内存）
+PROFILE_MAX_SAMPLES = 50000
+
+# *****************************************************
+# 准入控制配置，在common/admission.py中使用
+# *****************************************************
+# 是否开启全局的并发限制（按路由的限制见ROUTER_MODULES中的admission参数）
+ADMISSION_ENABLED = False
+# 每个进程最多同时处理的请求数，应该根据压测结果（fas bench）设置
+ADMISSION_MAX_CONCURRENCY = 100
+# 等待队列的长度，队列满时直接拒绝
+ADMISSION_MAX_QUEUE = 100
+# 最长排队时间（秒），超过时拒绝
+ADMISSION_QUEUE_TIMEOUT = 1
+# 拒绝时响应头Retry-After的值（秒）
+ADMISSION_RETRY_AFTER = 1
+# 不受全局并发限制的路径（按路径段前缀匹配，/status包括/status/xxx，不包括/statusx）
+ADMISSION_EXCLUDE_PATHS = ['/health', '/metrics', '/status', '/version', '/debug',
+                           '/docs', '/redoc', '/openapi.json', '/static']
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+#
+# 生产环境启动命令：fas serve
+# 1. 工作进程数默认按可用的CPU核数计算（考虑了CPU亲和性及容器的CPU限制）
+# 2. 安装了uvloop及httptools时自动使用
+# 3. Linux下每个工作进程使用SO_REUSEPORT独立监听端口，由内核分配连接；其他系统由主进程监听端口并共享给预先启动的工作进程（pre-fork）
+# 4. 平滑重启：向主进程发送HUP信号，先启动新的工作进程，再优雅地停止旧的工作进程
+# 5. 工作进程处理的请求数超过max_requests，或者内存（RSS）超过max_memory时，自动平滑替换该进程
+# 6. 开启监控指标时，启动前清空指标目录，工作进程退出后归档其指标文件
+# 7. 工作进程启动后很快异常退出时，按指数退避延迟重启；连续多次快速失败（如代码或配置错误）则退出
+# Author: caiyingyao
+# Email: cyy0523xc@gmail.com
+# Created Time: 2026-10-18
+import os
+import sys
+import time
+import random
+import signal
+import socket
+import multiprocessing
+from pathlib import Path
+from types import ModuleType
+from typing import Dict, List, Optional
+
+# 主进程的检查间隔（秒）
+CHECK_INTERVAL = 1.0
+# 工作进程启动后在该时间（秒）内异常退出，记为一次快速失败
+FAST_FAILURE_SECONDS = 10
+# 同一个工作进程连续快速失败的次数达到该值时，主进程退出
+MAX_FAST_FAILURES = 5
+# 重启工作进程的最长延迟（秒），延迟为1, 2, 4...秒
+RESPAWN_BACKOFF_MAX = 30
+
+
+def cpu_count() -> int:
+    """可用的CPU核数：考虑CPU亲和性及cgroup（容器）的CPU限制"""
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:     # 非Linux系统
+        count = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota:
+        count = min(count, max(1, int(quota + 0.5)))
+    return count
+
+
+def _cgroup_cpu_quota() -> Optional[float]:
+    """容器的CPU限制（核数），没有限制时返回None"""
+    try:    # cgroup v2
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()[:2]
+        return None if quota == 'max' else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:    # cgroup v1
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+            quota = int(f.read())
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+            period = int(f.read())
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def rss_mb(pid: int) -> Optional[float]:
+    """进程的内存占用（RSS，MB），无法获取时返回None"""
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss / 1024 / 1024
+    except Exception:
+        return None
+
+
+def serve(app: str = 'main:app', host: str = '0.0.0.0', port: int = 8000, workers: int = 0,
+          reuse_port: bool = True, max_requests: int = 0, max_requests_jitter: int = 0,
+          max_memory: int = 0, graceful_timeout: int = 30, backlog: int = 2048,
+          log_level: str = 'info', app_dir: str = '.'):
+    """生产环境启动http服务（需要在项目的app目录下执行）
+
+    Examples:
+        fas serve
+        fas serve --port=8080 --workers=4
+        # 每个工作进程处理10000~11000个请求，或者内存超过1024MB时自动替换
+        fas serve --max_requests=10000 --max_requests_jitter=1000 --max_memory=1024
+        # 平滑重启（如更新代码之后）
+        kill -HUP <主进程pid>
+    开发环境请使用：uvicorn main:app --reload
+    Args:
+        app str: 应用的路径，格式为module:attr
+        host str: 监听的地址
+        port int: 监听的端口
+        workers int: 工作进程数，不大于0时按可用的CPU核数计算
+        reuse_port bool: 是否使用SO_REUSEPORT（仅Linux），否则由主进程监听端口
+        max_requests int: 每个工作进程处理的最大请求数，超过时替换该进程，0表示不限制
+        max_requests_jitter int: 最大请求数的随机增量，避免所有进程同时重启
+        max_memory int: 每个工作进程的最大内存（RSS，MB），超过时替换该进程，0表示不限制
+        graceful_timeout int: 停止工作进程时，等待处理中的请求完成的最长时间（秒）
+        backlog int: 监听队列的长度
+        log_level str: 日志级别
+        app_dir str: 应用所在的目录
+    """
+    try:
+        import uvicorn    # noqa: F401
+    except ImportError:
+        print('请先安装uvicorn：pip install uvicorn[standard]')
+        return
+    if workers <= 0:
+        workers = cpu_count()
+    if reuse_port and not (sys.platform.startswith('linux') and hasattr(socket, 'SO_REUSEPORT')):
+        reuse_port = False
+    options = {
+        'app': app, 'host': host, 'port': port, 'backlog': backlog, 'log_level': log_level,
+        'timeout_graceful_shutdown': graceful_timeout, 'app_dir': os.path.abspath(app_dir),
+    }
+    print(f'workers: {workers}, loop: {_available("uvloop") or "asyncio"}, '
+          f'http: {_available("httptools") or "h11"}, mode: {"SO_REUSEPORT" if reuse_port else "pre-fork"}')
+    supervisor = Supervisor(options, workers, reuse_port, max_requests, max_requests_jitter,
+                            max_memory, graceful_timeout, metrics=_load_metrics(options['app_dir']))
+    if not supervisor.run():
+        sys.exit(1)
+
+
+def _available(name: str) -> str:
+    try:
+        __import__(name)
+    except ImportError:
+        return ''
+    return name
+
+
+def _load_metrics(app_dir: str) -> Optional[ModuleType]:
+    """导入项目的监控指标模块（用于清理及归档指标文件），没有开启监控指标时返回None"""
+    if app_dir not in sys.path:
+        sys.path.insert(0, app_dir)
+    try:
+        from settings import METRICS_ENABLED
+        if not METRICS_ENABLED:
+            return None
+        from common import metrics
+    except Exception as e:
+        print(f'load metrics failed: {e}')
+        return None
+    return metrics
+
+
+class Supervisor:
+    """主进程：管理工作进程的启动、替换及停止"""
+    def __init__(self, options: Dict, workers: int, reuse_port: bool, max_requests: int,
+                 max_requests_jitter: int, max_memory: int, graceful_timeout: int,
+                 metrics: Optional[ModuleType] = None):
+        self.options = options
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.max_memory = max_memory
+        self.graceful_timeout = graceful_timeout
+        self.metrics = metrics
+        self.ctx = multiprocessing.get_context('spawn')    # 工作进程重新导入应用，平滑重启时加载新代码
+        self.sock: Optional[socket.socket] = None
+        # 每个位置一个工作进程，等待重启时为None
+        self.processes: List[Optional[multiprocessing.Process]] = []
+        self.started: List[float] = []         # 每个位置的工作进程的启动时间
+        self.failures: List[int] = []          # 每个位置连续快速失败的次数
+        self.respawn_at: List[float] = []      # 每个位置等待重启的时间
+        # 正在停止的进程：进程 -> 强制结束的时间
+        self.stopping: Dict[multiprocessing.Process, float] = {}
+        self.should_exit = False
+        self.should_reload = False
+        self.failed = False
+
+    def run(self) -> bool:
+        """运行直到收到退出信号，工作进程连续快速失败而退出时返回False"""
+        if not self.reuse_port:
+            self.sock = _bind_socket(self.options['host'], self.options['port'],
+                                     self.options['backlog'], reuse_port=False)
+        signal.signal(signal.SIGINT, self._handle_exit)
+        signal.signal(signal.SIGTERM, self._handle_exit)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._handle_reload)
+        print(f'master pid: {os.getpid()}, listen: http://{self.options["host"]}:{self.options["port"]}')
+        if self.metrics is not None:    # 上一次运行的计数不再累加
+            self.metrics.clear(Path(self.metrics.METRICS_DIR))
+        now = time.monotonic()
+        self.processes = [self._spawn() for _ in range(self.workers)]
+        self.started = [now] * self.workers
+        self.failures = [0] * self.workers
+        self.respawn_at = [0.0] * self.workers
+        try:
+            while not self.should_exit:
+                time.sleep(CHECK_INTERVAL)
+                if self.should_reload:
+                    self.should_reload = False
+                    self._reload()
+                self._check_workers()
+                self._reap_stopping()
+        finally:
+            self._shutdown()
+        return not self.failed
+
+    def _handle_exit(self, signum, frame):
+        self.should_exit = True
+
+    def _handle_reload(self, signum, frame):
+        self.should_reload = True
+
+    def _spawn(self) -> multiprocessing.Process:
+        limit = self.max_requests
+        if limit > 0 and self.max_requests_jitter > 0:
+            limit += random.randint(0, self.max_requests_jitter)
+        options = dict(self.options, limit_max_requests=limit or None)
+        process = self.ctx.Process(target=_run_worker, args=(options, self.sock, self.reuse_port))
+        process.start()
+        return process
+
+    def _reload(self):
+        """平滑重启：先启动全部新进程，再停止旧进程"""
+        print(f'reload workers: {[p.pid for p in self.processes if p is not None]}')
+        old, self.processes = self.processes, [self._spawn() for _ in range(self.workers)]
+        self.started = [time.monotonic()] * self.workers
+        self.failures = [0] * self.workers
+        for process in old:
+            if process is not None:
+                self._stop(process)
+
+    def _check_workers(self):
+        """替换已经退出（如达到最大请求数）或者内存超限的工作进程"""
+        now = time.monotonic()
+        for i, process in enumerate(self.processes):
+            if process is None:
+                if now >= self.respawn_at[i]:
+                    self.processes[i] = self._spawn()
+                    self.started[i] = now
+                continue
+            if not process.is_alive():
+                process.join()
+                self._archive_metrics(process)
+                self._respawn(i, process, now)
+                if self.failed:
+                    return
+                continue
+            if self.max_memory > 0:
+                memory = rss_mb(process.pid)
+                if memory is not None and memory > self.max_memory:
+                    print(f'worker memory {memory:.0f}MB > {self.max_memory}MB: '
+                          f'pid {process.pid}, restarting')
+                    self.processes[i] = self._spawn()
+                    self.started[i] = now
+                    self._stop(process)
+
+    def _respawn(self, i: int, process: multiprocessing.Process, now: float):
+        """重启已经退出的工作进程：快速失败时按指数退避延迟重启，连续失败次数过多时退出"""
+        if process.exitcode != 0 and now - self.started[i] < FAST_FAILURE_SECONDS:
+            self.failures[i] += 1
+        else:
+            self.failures[i] = 0
+        if self.failures[i] >= MAX_FAST_FAILURES:
+            print(f'worker exited: pid {process.pid}, exitcode {process.exitcode}, '
+                  f'failed {self.failures[i]} times in a row, giving up')
+            self.failed = True
+            self.should_exit = True
+            self.processes[i] = None
+            return
+        delay = min(RESPAWN_BACKOFF_MAX, 2 ** (self.failures[i] - 1)) if self.failures[i] else 0
+        print(f'worker exited: pid {process.pid}, exitcode {process.exitcode}, restarting in {delay}s')
+        if delay:
+            self.processes[i] = None
+            self.respawn_at[i] = now + delay
+        else:
+            self.processes[i] = self._spawn()
+            self.started[i] = now
+
+    def _stop(self, process: multiprocessing.Process):
+        """优雅地停止工作进程：先发送TERM信号，超时之后再强制结束"""
+        if process.is_alive():
+            process.terminate()
+        self.stopping[process] = time.monotonic() + self.graceful_timeout + 5
+
+    def _reap_stopping(self):
+        now = time.monotonic()
+        for process, deadline in list(self.stopping.items()):
+            if not process.is_alive():
+                process.join()
+                self._archive_metrics(process)
+                del self.stopping[process]
+            elif now > deadline:
+                process.kill()
+
+    def _archive_metrics(self, process: multiprocessing.Process):
+        """工作进程被强制结束时没有归档自己的指标文件，由主进程归档"""
+        if self.metrics is not None:
+            self.metrics.archive(Path(self.metrics.METRICS_DIR), process.pid)
+
+    def _shutdown(self):
+        print('shutting down workers')
+        for process in self.processes:
+            if process is not None:
+                self._stop(process)
+        self.processes = []
+        while self.stopping:
+            self._reap_stopping()
+            time.sleep(0.1)
+        if self.sock is not None:
+            self.sock.close()
+
+
+def _bind_socket(host: str, port: int, backlog: int, reuse_port: bool) -> socket.socket:
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _run_worker(options: Dict, sock: Optional[socket.socket], reuse_port: bool):
+    """工作进程的入口"""
+    import uvicorn
+    sys.path.insert(0, options.pop('app_dir'))
+    if reuse_port:
+        sock = _bind_socket(options['host'], options['port'], options['backlog'], reuse_port=True)
+    config = uvicorn.Config(**options)
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
@@ -5,6 +5,8 @@
 # Created Time: 2021年06月08日 星期二
 import re
 import os
+import gzip
+import shutil
 from datetime import datetime
 from typing import Dict, Tuple, List, Optional, Any
 
@@ -39,6 +41,26 @@ def shell(cmd: str, cd: Optional[str] = None) -> str:
     return res
 
 
+def compress_file(path: str) -> List[str]:
+    """生成预先压缩的文件：path.gz，及path.br（需要安装brotli）
+    Returns:
+        List[str]: 生成的文件列表
+    """
+    files = [f'{path}.gz']
+    with open(path, 'rb') as src, gzip.GzipFile(files[0], 'wb', compresslevel=9, mtime=0) as dst:
+        shutil.copyfileobj(src, dst)
+    try:
+        import brotli
+    except ImportError:    # brotli是可选依赖
+        return files
+    with open(path, 'rb') as f:
+        data = brotli.compress(f.read(), quality=11)
+    files.append(f'{path}.br')
+    with open(files[1], 'wb') as f:
+        f.write(data)
+    return files
+
+
 def get_user_from_git() -> Tuple[str, str]:
     """从git中获取用户名和邮箱"""
     username = shell('git config user.name')